@@ -0,0 +1,606 @@
+#!/usr/bin/env python
+"""
+Deletes images that are older than a given date from gcr.io repositories, while
+always keeping a minimum number of images in each, along with any images that
+the keep policies (--keep-tag, --keep-last, --protect-tag) apply to.
+
+This talks to the registry's HTTP API directly, over a single pooled session,
+and deletes many images at once; forking `gcloud container images delete` for
+each image costs seconds apiece. With --registry-path, every repository under
+the path is pruned, and all of them share the same workers and request rate.
+
+The images to delete can also be written to a plan file (--plan-file), to be
+reviewed, and then deleted later (--apply) without listing the repositories again.
+"""
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, NamedTuple, Optional, Pattern, Set, Tuple
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Asked for when looking up the digest a tag points to, so that the registry
+# doesn't convert the manifest (which would change its digest).
+MANIFEST_MEDIA_TYPES = (
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+)
+# Multi-platform images, whose children are images of their own.
+MANIFEST_LIST_MEDIA_TYPES = (
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+)
+
+
+def parse_date(value: str) -> datetime:
+    return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+
+def parse_keep_last(value: str) -> Tuple[str, int]:
+    prefix, _, count = value.rpartition(':')
+    if not count.isdigit():
+        raise ArgumentTypeError(f"Expected 'PREFIX:COUNT', got '{value}'")
+    return prefix, int(count)
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser('Prune old images from gcr.io repositories.')
+    parser.add_argument(
+        '--repository', '-r',
+        help='The full gcr.io path to the docker image, e.g., gcr.io/uwit-mci-iam/app-name'
+    )
+    parser.add_argument(
+        '--registry-path', '-R',
+        help='Prune every repository under this gcr.io path (e.g., gcr.io/uwit-mci-iam), '
+             'instead of a single --repository.'
+    )
+    parser.add_argument(
+        '--before-date', '-d', type=parse_date,
+        help="Images created before this date (in the format of 'YYYY-MM-DD') are pruned."
+    )
+    parser.add_argument(
+        '--min-images', '-m', type=int, default=10,
+        help='The minimum number of images to preserve in each repository. '
+             'Even if images are older than --before-date, they will be '
+             'preserved if there are no others available.'
+    )
+    parser.add_argument(
+        '--keep-tag', '-k', action='append', default=[], type=re.compile,
+        help='Never prune images with a tag that matches this regular expression. '
+             'Can be given more than once.'
+    )
+    parser.add_argument(
+        '--keep-last', '-l', action='append', default=[], type=parse_keep_last,
+        metavar='PREFIX:COUNT',
+        help='Never prune the newest COUNT images with a tag that starts with PREFIX '
+             '(e.g., "release-:5"). Can be given more than once.'
+    )
+    parser.add_argument(
+        '--protect-tag', '-t', action='append', default=[],
+        help='Never prune the image with this tag, nor (for a multi-platform '
+             'image) the images it refers to. Can be given more than once.'
+    )
+    parser.add_argument(
+        '--dry-run', '-x', action='store_true',
+        help="Run the script but don't actually delete anything"
+    )
+    parser.add_argument(
+        '--workers', '-w', type=int, default=8,
+        help='The number of requests to make at once, across all repositories.'
+    )
+    parser.add_argument(
+        '--max-requests-per-second', '-q', type=float,
+        help='Limit the requests made to the registry, across all repositories. '
+             'Unlimited by default; rate-limited requests are always retried.'
+    )
+    parser.add_argument(
+        '--plan-file', '-p',
+        help='Instead of deleting anything, write the images that would be '
+             'deleted to this JSON file, for --apply.'
+    )
+    parser.add_argument(
+        '--apply', '-a', metavar='PLAN_FILE',
+        help='Delete the images in a plan written by --plan-file, without '
+             'listing the repositories again. Other options, except --dry-run, '
+             '--workers and --max-requests-per-second, are ignored.'
+    )
+    parser.add_argument('--debug', '-g', action='store_true')
+    return parser
+
+
+class Image(NamedTuple):
+    digest: str
+    tags: List[str]
+    created: datetime
+    media_type: str = ''
+
+    def to_json(self) -> Dict:
+        return {
+            'digest': self.digest,
+            'tags': self.tags,
+            'created': self.created.isoformat(),
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'Image':
+        return cls(
+            digest=data['digest'],
+            tags=data['tags'],
+            created=datetime.fromisoformat(data['created']),
+        )
+
+
+class Policy(NamedTuple):
+    before_date: datetime
+    min_images: int
+    keep_tags: List[Pattern] = []
+    keep_last: List[Tuple[str, int]] = []
+    protected_tags: List[str] = []
+
+
+def get_access_token() -> str:
+    token = os.environ.get('GOOGLE_OAUTH_ACCESS_TOKEN')
+    if not token:
+        token = subprocess.check_output(
+            ['gcloud', 'auth', 'print-access-token'], text=True
+        ).strip()
+    return token
+
+
+class RateLimitedSession(requests.Session):
+    """
+    A session that spaces out its requests, across every thread using it.
+    """
+
+    def __init__(self, max_requests_per_second: Optional[float] = None):
+        super().__init__()
+        self.interval = 1 / max_requests_per_second if max_requests_per_second else 0
+        self._next_request_at = 0.0
+        self._lock = threading.Lock()
+
+    def request(self, *args, **kwargs) -> requests.Response:
+        if self.interval:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._next_request_at - now
+                self._next_request_at = max(now, self._next_request_at) + self.interval
+            if wait > 0:
+                time.sleep(wait)
+        return super().request(*args, **kwargs)
+
+
+def make_session(
+    access_token: str, pool_size: int = 8, max_requests_per_second: Optional[float] = None
+) -> requests.Session:
+    """
+    :return: A session that can be shared by the clients of every repository.
+    """
+    session = RateLimitedSession(max_requests_per_second)
+    session.auth = ('oauth2accesstoken', access_token)
+    # Retries requests that are rate-limited (honoring Retry-After) or that
+    # hit a transient server error, including deletes.
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    session.mount(
+        'https://',
+        HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry),
+    )
+    return session
+
+
+class RegistryClient:
+    """
+    A client for the docker registry v2 API of a single gcr.io repository.
+    """
+
+    def __init__(self, repository: str, session: requests.Session):
+        self.repository = repository
+        host, _, name = repository.partition('/')
+        self.base_url = f'https://{host}/v2/{name}/'
+        self.session = session
+        # Manifests can't change, so what each one refers to is only looked up once.
+        self._child_digests: Dict[str, List[str]] = {}
+
+    def iter_listing_pages(self, page_size: int = 1000) -> Iterator[Dict]:
+        url = urljoin(self.base_url, f'tags/list?n={page_size}')
+        while url:
+            response = self.session.get(url, timeout=60)
+            response.raise_for_status()
+            yield response.json()
+            next_url = response.links.get('next', {}).get('url')
+            url = urljoin(response.url, next_url) if next_url else None
+
+    @staticmethod
+    def get_listed_images(listing: Dict) -> List[Image]:
+        """
+        :return: The images on a page of the listing. An image whose tags span
+            pages may be listed on more than one.
+        """
+        # gcr.io adds the details of every manifest to the tag listing.
+        images = []
+        for digest, manifest in listing.get('manifest', {}).items():
+            timestamp_ms = int(manifest.get('timeCreatedMs') or 0) or int(
+                manifest.get('timeUploadedMs') or 0
+            )
+            images.append(Image(
+                digest=digest,
+                tags=manifest.get('tag', []),
+                created=datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc),
+                media_type=manifest.get('mediaType', ''),
+            ))
+        return images
+
+    def iter_image_pages(self, page_size: int = 1000) -> Iterator[List[Image]]:
+        """
+        Lists the repository one page at a time. An image whose tags span
+        pages may be listed more than once.
+        """
+        for listing in self.iter_listing_pages(page_size):
+            yield self.get_listed_images(listing)
+
+    def list_repository(self) -> Tuple[List[Image], List[str]]:
+        """
+        Lists the repository once, for both its images and the repositories
+        under it (gcr.io lists them along with the tags).
+        :return: Every image (i.e., unique digest) in the repository, with all
+            of its tags; and the full paths of the repositories directly under it.
+        """
+        images: Dict[str, Image] = {}
+        children = []
+        for listing in self.iter_listing_pages():
+            for image in self.get_listed_images(listing):
+                seen = images.get(image.digest)
+                if seen:
+                    tags = seen.tags + [t for t in image.tags if t not in seen.tags]
+                    image = seen._replace(tags=tags)
+                images[image.digest] = image
+            children.extend(
+                f'{self.repository}/{child}' for child in listing.get('child', [])
+            )
+        return list(images.values()), children
+
+    def list_images(self) -> List[Image]:
+        """
+        :return: Every image (i.e., unique digest) in the repository, with all
+            of its tags.
+        """
+        return self.list_repository()[0]
+
+    def get_child_digests(self, digest: str) -> List[str]:
+        """
+        :return: The digests of the images that a multi-platform image refers to.
+        """
+        if digest not in self._child_digests:
+            response = self.session.get(
+                urljoin(self.base_url, f'manifests/{digest}'),
+                headers={'Accept': ', '.join(MANIFEST_LIST_MEDIA_TYPES)},
+                timeout=60,
+            )
+            response.raise_for_status()
+            self._child_digests[digest] = [
+                child['digest'] for child in response.json().get('manifests', [])
+            ]
+        return self._child_digests[digest]
+
+    def get_tagged_digest(self, tag: str) -> Optional[str]:
+        """
+        :return: The digest that the tag currently points to, if any.
+        """
+        response = self.session.head(
+            urljoin(self.base_url, f'manifests/{tag}'),
+            headers={'Accept': ', '.join(MANIFEST_MEDIA_TYPES)},
+            timeout=60,
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.headers.get('Docker-Content-Digest')
+
+    def _delete_manifest(self, reference: str):
+        response = self.session.delete(
+            urljoin(self.base_url, f'manifests/{reference}'), timeout=60
+        )
+        # A retried delete may find that its first attempt worked.
+        if response.status_code != 404:
+            response.raise_for_status()
+
+    def delete_image(self, image: Image, verify_tags: bool = False):
+        """
+        Deletes the image's tags, then the image itself (like
+        `gcloud container images delete --force-delete-tags`).
+        :param verify_tags: Leave alone any tag that no longer points to the
+            image (e.g., when applying a plan that was made a while ago).
+        """
+        for tag in image.tags:
+            if verify_tags and self.get_tagged_digest(tag) != image.digest:
+                logging.warning(
+                    f'Not deleting tag {tag}; it no longer points to {image.digest}'
+                )
+                continue
+            self._delete_manifest(tag)
+        self._delete_manifest(image.digest)
+
+
+def get_referenced_digests(
+    client: RegistryClient, images: List[Image], digests: Set[str]
+) -> Set[str]:
+    """
+    :return: The digests of the images that the multi-platform images among
+        `digests` refer to.
+    """
+    referenced = set()
+    for image in images:
+        if image.digest in digests and image.media_type in MANIFEST_LIST_MEDIA_TYPES:
+            referenced.update(client.get_child_digests(image.digest))
+    return referenced
+
+
+def get_kept_digests(images: List[Image], policy: Policy) -> Set[str]:
+    """
+    :return: The digests of the images that the policy's keep rules apply to.
+    """
+    kept = set()
+    protected_tags = set(policy.protected_tags)
+    for image in images:
+        if protected_tags.intersection(image.tags) or any(
+            pattern.search(tag) for pattern in policy.keep_tags for tag in image.tags
+        ):
+            kept.add(image.digest)
+    newest_first = sorted(images, key=lambda image: image.created, reverse=True)
+    for prefix, count in policy.keep_last:
+        kept.update(
+            image.digest
+            for image in [
+                image for image in newest_first
+                if any(tag.startswith(prefix) for tag in image.tags)
+            ][:count]
+        )
+    return kept
+
+
+def select_images(
+    images: List[Image], policy: Policy, kept_digests: Set[str] = frozenset()
+) -> List[Image]:
+    """
+    :return: The images to delete, oldest first: those created before the
+        policy's `before_date` that it doesn't keep, except for as many as it
+        takes to keep `min_images`.
+    """
+    max_deletions = max(len(images) - policy.min_images, 0)
+    candidates = sorted(
+        (
+            image for image in images
+            if image.created < policy.before_date and image.digest not in kept_digests
+        ),
+        key=lambda image: image.created,
+    )
+    if len(candidates) > max_deletions:
+        logging.warning(
+            f'Maximum number of digest deletions ({max_deletions}) reached.'
+        )
+    return candidates[:max_deletions]
+
+
+def plan_repository(
+    client: RegistryClient, policy: Policy, images: Optional[List[Image]] = None
+) -> Dict:
+    """
+    :param images: The images in the repository, if it has already been listed.
+    """
+    if images is None:
+        images = client.list_images()
+    kept_digests = get_kept_digests(images, policy)
+    selected = []
+    # gcr.io's listing doesn't say which images a multi-platform image refers
+    # to, so each takes a request to find out; that's only worth it if the
+    # policy could delete anything.
+    if len(images) > policy.min_images and any(
+        image.created < policy.before_date and image.digest not in kept_digests
+        for image in images
+    ):
+        kept_digests |= get_referenced_digests(client, images, kept_digests)
+        selected = select_images(images, policy, kept_digests)
+    # Every multi-platform image that is not deleted (e.g., because it is too
+    # new, or is needed for --min-images) keeps the images it refers to, which
+    # may be multi-platform images themselves.
+    deleted = {image.digest for image in selected}
+    while deleted:
+        remaining = {image.digest for image in images} - deleted
+        referenced = deleted & get_referenced_digests(client, images, remaining)
+        if not referenced:
+            break
+        deleted -= referenced
+    return {
+        'repository': client.repository,
+        'imageCount': len(images),
+        'delete': [image.to_json() for image in selected if image.digest in deleted],
+    }
+
+
+def make_plan(
+    repositories: List[str],
+    session: requests.Session,
+    policy: Policy,
+    workers: int,
+    recursive: bool = False,
+) -> Dict:
+    """
+    :param recursive: Also plan every repository under the given ones, as
+        they are found in the same listings that the plans are made from.
+    :return: The plan. A repository that could not be planned is recorded
+        with its `error` (and nothing to delete), and the others go ahead.
+    """
+    def plan(repository: str) -> Tuple[Dict, List[str]]:
+        client = RegistryClient(repository, session)
+        try:
+            images, children = client.list_repository()
+            return plan_repository(client, policy, images), children
+        except requests.RequestException as e:
+            logging.error(f'Could not plan {repository}: {e}')
+            return {'repository': repository, 'error': str(e), 'delete': []}, []
+
+    repository_plans = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Parents first, in the order they were found.
+        pending = [executor.submit(plan, repository) for repository in repositories]
+        while pending:
+            repository_plan, children = pending.pop(0).result()
+            repository_plans.append(repository_plan)
+            if recursive:
+                pending.extend(executor.submit(plan, child) for child in children)
+    return {
+        'beforeDate': policy.before_date.date().isoformat(),
+        'minImages': policy.min_images,
+        'createdAt': datetime.now(tz=timezone.utc).isoformat(),
+        'repositories': repository_plans,
+    }
+
+
+def delete_images(
+    jobs: List[Tuple[RegistryClient, Image]], workers: int, verify_tags: bool = False
+) -> List[Tuple[RegistryClient, Image]]:
+    """
+    :param jobs: The images to delete, and the clients of their repositories.
+    :return: The jobs whose images could not be deleted.
+    """
+    def delete(job: Tuple[RegistryClient, Image]) -> Optional[Tuple[RegistryClient, Image]]:
+        client, image = job
+        try:
+            client.delete_image(image, verify_tags=verify_tags)
+            logging.info(f'Deleted {client.repository}@{image.digest}')
+        except requests.RequestException as e:
+            logging.error(f'Could not delete {client.repository}@{image.digest}: {e}')
+            return job
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [job for job in executor.map(delete, jobs) if job]
+
+
+def set_output(name: str, value):
+    output_file = os.environ.get('GITHUB_OUTPUT')
+    if output_file:
+        with open(output_file, 'a') as outf:
+            print(f'{name}={value}', file=outf)
+
+
+def main(args) -> int:
+    session = make_session(
+        get_access_token(),
+        pool_size=args.workers,
+        max_requests_per_second=args.max_requests_per_second,
+    )
+    if args.apply:
+        with open(args.apply) as f:
+            plan = json.load(f)
+        if 'repositories' not in plan:  # Written for a single --repository.
+            plan['repositories'] = [
+                {key: plan.pop(key) for key in ('repository', 'imageCount', 'delete')}
+            ]
+        logging.info(f'Applying plan from {plan["createdAt"]}')
+    else:
+        if not (args.repository or args.registry_path) or not args.before_date:
+            logging.error(
+                '--repository (or --registry-path) and --before-date are required, '
+                'unless --apply is used.'
+            )
+            return 2
+        policy = Policy(
+            before_date=args.before_date,
+            min_images=args.min_images,
+            keep_tags=args.keep_tag,
+            keep_last=args.keep_last,
+            protected_tags=args.protect_tag,
+        )
+        plan = make_plan(
+            [args.registry_path or args.repository],
+            session,
+            policy,
+            args.workers,
+            recursive=bool(args.registry_path),
+        )
+        if args.registry_path:
+            logging.info(
+                f'Found {len(plan["repositories"])} repositories under {args.registry_path}'
+            )
+
+    jobs = []
+    errors = [
+        repository_plan for repository_plan in plan['repositories']
+        if repository_plan.get('error')
+    ]
+    for repository_plan in plan['repositories']:
+        if repository_plan.get('error'):
+            logging.error(
+                f'Skipping {repository_plan["repository"]}, which could not be '
+                f'planned: {repository_plan["error"]}'
+            )
+            continue
+        client = RegistryClient(repository_plan['repository'], session)
+        jobs.extend((client, Image.from_json(image)) for image in repository_plan['delete'])
+        logging.info(
+            f'{len(repository_plan["delete"])} of {repository_plan["imageCount"]} '
+            f'images to delete in {client.repository}'
+        )
+    # The rest of the plan is carried out (or written) anyway, but the run fails.
+    status = 1 if errors else 0
+
+    if args.plan_file and not args.apply:
+        with open(args.plan_file, 'w') as f:
+            json.dump(plan, f, indent=2)
+        logging.info(f'Wrote a plan to delete {len(jobs)} images to {args.plan_file}')
+        set_output('plan-file', args.plan_file)
+        return status
+
+    if args.dry_run:
+        logging.warning('[DRY RUN] No images will actually be deleted!')
+        for client, image in jobs:
+            print(f'[NOT RUNNING] delete {client.repository}@{image.digest} (tags: {image.tags})')
+        logging.info(f'[DID NOT] Deleted {len(jobs)} images')
+        return status
+
+    started = time.perf_counter()
+    # A plan's tags may have been moved to other images since it was made.
+    failed = delete_images(jobs, args.workers, verify_tags=bool(args.apply))
+    elapsed = time.perf_counter() - started
+    deleted = len(jobs) - len(failed)
+    logging.info(
+        f'Deleted {deleted} images in {len(plan["repositories"])} repositories in '
+        f'{elapsed:.1f}s ({deleted / elapsed if elapsed else 0:.1f} images/s)'
+    )
+    set_output('deleted-count', deleted)
+    if errors:
+        logging.error(f'Failed to plan {len(errors)} repositories.')
+    if failed:
+        logging.error(f'Failed to delete {len(failed)} images.')
+        return 1
+    return status
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(message)s',
+        stream=sys.stderr,
+    )
+    sys.exit(main(args))
@@ -0,0 +1,104 @@
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+from prune_gcr import MANIFEST_LIST_MEDIA_TYPES, Image, Policy, plan_repository
+
+NOW = datetime(2026, 1, 31, tzinfo=timezone.utc)
+MANIFEST_LIST = MANIFEST_LIST_MEDIA_TYPES[0]
+
+
+def image(digest: str, days_old: int, *tags: str, media_type: str = '') -> Image:
+    return Image(digest, list(tags), NOW - timedelta(days=days_old), media_type)
+
+
+class FakeRegistryClient:
+    """
+    Stands in for a RegistryClient, counting the manifests it is asked about.
+    """
+
+    def __init__(self, images: List[Image], children: Dict[str, List[str]] = None):
+        self.repository = 'gcr.io/project/repo'
+        self.images = images
+        self.children = children or {}
+        self.child_lookups = 0
+
+    def list_images(self) -> List[Image]:
+        return self.images
+
+    def get_child_digests(self, digest: str) -> List[str]:
+        self.child_lookups += 1
+        return self.children.get(digest, [])
+
+
+def get_deleted(client: FakeRegistryClient, **policy) -> List[str]:
+    plan = plan_repository(client, Policy(before_date=NOW, **policy))
+    return [image['digest'] for image in plan['delete']]
+
+
+def test_oldest_are_deleted_down_to_min_images():
+    client = FakeRegistryClient([image(f'sha:{i}', i + 1) for i in range(5)])
+    assert get_deleted(client, min_images=2) == ['sha:4', 'sha:3', 'sha:2']
+
+
+def test_keep_tags_and_protected_tags():
+    client = FakeRegistryClient([
+        image('sha:release', 9, 'release-1.0'),
+        image('sha:latest', 8, 'latest'),
+        image('sha:old', 7, 'pr-1'),
+    ])
+    deleted = get_deleted(
+        client, min_images=0, keep_tags=[re.compile(r'^release-')],
+        protected_tags=['latest'],
+    )
+    assert deleted == ['sha:old']
+
+
+def test_keep_last_keeps_the_newest_with_each_prefix():
+    client = FakeRegistryClient([
+        image('sha:pr-old', 9, 'pr-1'),
+        image('sha:pr-new', 8, 'pr-2'),
+        image('sha:dev-old', 7, 'dev-1'),
+        image('sha:dev-new', 6, 'dev-2'),
+    ])
+    deleted = get_deleted(client, min_images=0, keep_last=[('pr-', 1), ('dev-', 1)])
+    assert deleted == ['sha:pr-old', 'sha:dev-old']
+
+
+def test_images_referred_to_by_a_kept_multi_platform_image_are_kept():
+    client = FakeRegistryClient(
+        [
+            image('sha:index', 9, 'latest', media_type=MANIFEST_LIST),
+            image('sha:amd64', 9),
+            image('sha:arm64', 9),
+            image('sha:orphan', 9),
+        ],
+        children={'sha:index': ['sha:amd64', 'sha:arm64']},
+    )
+    deleted = get_deleted(client, min_images=0, protected_tags=['latest'])
+    assert deleted == ['sha:orphan']
+
+
+def test_images_referred_to_by_a_multi_platform_image_too_new_to_delete_are_kept():
+    client = FakeRegistryClient(
+        [
+            image('sha:index', -1, media_type=MANIFEST_LIST),
+            image('sha:amd64', 9),
+            image('sha:orphan', 9),
+        ],
+        children={'sha:index': ['sha:amd64']},
+    )
+    assert get_deleted(client, min_images=0) == ['sha:orphan']
+
+
+def test_nothing_is_looked_up_when_the_policy_keeps_everything():
+    client = FakeRegistryClient(
+        [
+            image('sha:index', 9, 'latest', media_type=MANIFEST_LIST),
+            image('sha:new', -1),
+        ],
+        children={'sha:index': ['sha:child']},
+    )
+    assert get_deleted(client, min_images=0, protected_tags=['latest']) == []
+    assert get_deleted(client, min_images=5) == []
+    assert client.child_lookups == 0
@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 
+import json
 import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from github import Github
+import requests
 from argparse import ArgumentParser
 import os
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from github_api import GITHUB_API_URL, make_session, set_budget_output
 
 
 def get_parser() -> ArgumentParser:
@@ -15,6 +22,31 @@ def get_parser() -> ArgumentParser:
     parser.add_argument('--github-token', default=os.environ.get('GITHUB_TOKEN'))
     parser.add_argument('--github-repository', default=os.environ.get('GITHUB_REPOSITORY'))
     parser.add_argument('--pr-number', default=os.environ.get('GITHUB_PR_NUMBER'))
+    parser.add_argument(
+        '--cache-file', default=os.environ.get('LABEL_CACHE_FILE'),
+        help='A JSON file in which to keep the labels last fetched, and their '
+             'ETags, so that checking an unchanged pull request again does not '
+             'count against the rate limit.'
+    )
+    parser.add_argument(
+        '--audit', nargs='+', metavar='REPOSITORY', default=[],
+        help='Instead of a single pull request, check every open pull request '
+             'in these repositories (e.g., uwit-iam/actions), and report on '
+             'each one as a line of JSON.'
+    )
+    parser.add_argument(
+        '--audit-org', metavar='ORG',
+        help='Like --audit, for every repository in the organization that '
+             'is not archived.'
+    )
+    parser.add_argument(
+        '--audit-report',
+        help='The file to write the audit report to; stdout by default.'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help='The number of repositories to audit at once.'
+    )
     return parser
 
 
@@ -27,18 +59,165 @@ def get_pr_number(github_ref: str) -> int:
         )
 
 
+def get_guidance(label_names: List[str]) -> List[str]:
+    return [
+        name.split(':')[-1] for name in label_names
+        if name.startswith('semver-guidance:')
+    ]
+
+
+def iter_pages(session: requests.Session, url: str) -> Iterator[List[Dict]]:
+    while url:
+        response = session.get(url, timeout=30)
+        response.raise_for_status()
+        yield response.json()
+        url = response.links.get('next', {}).get('url')
+
+
+def iter_org_repositories(session: requests.Session, org: str) -> Iterator[str]:
+    for page in iter_pages(session, f'{GITHUB_API_URL}/orgs/{org}/repos?per_page=100'):
+        for repo in page:
+            if not repo.get('archived'):
+                yield repo['full_name']
+
+
+def audit_repository(
+    session: requests.Session, repository: str, write: Callable[[Dict], None]
+) -> Tuple[int, int]:
+    """
+    Checks the guidance of every open pull request in the repository, and
+    writes a report on each as soon as its page of pull requests is listed
+    (the listing includes their labels).
+    :return: The number of pull requests checked, and how many were valid.
+    """
+    checked = valid = 0
+    url = f'{GITHUB_API_URL}/repos/{repository}/pulls?state=open&per_page=100'
+    for page in iter_pages(session, url):
+        for pull in page:
+            guidance = get_guidance([label['name'] for label in pull['labels']])
+            if len(guidance) > 1:
+                status = 'conflicting'
+            elif not guidance:
+                status = 'missing'
+            else:
+                status = 'valid'
+                valid += 1
+            checked += 1
+            write({
+                'repository': repository,
+                'pr-number': pull['number'],
+                'url': pull['html_url'],
+                'status': status,
+                'guidance': guidance,
+            })
+    return checked, valid
+
+
+def audit(
+    session: requests.Session, repositories: Iterable[str], workers: int, report: TextIO
+) -> bool:
+    """
+    Audits the repositories, `workers` at a time.
+    :return: True if every open pull request has valid guidance.
+    """
+    lock = threading.Lock()
+
+    def write(line: Dict):
+        with lock:
+            print(json.dumps(line), file=report, flush=True)
+
+    def audit_one(repository: str) -> Optional[Tuple[int, int]]:
+        try:
+            return audit_repository(session, repository, write)
+        except requests.RequestException as e:
+            write({'repository': repository, 'status': 'error', 'error': str(e)})
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(audit_one, repositories))
+    errors = results.count(None)
+    checked = sum(result[0] for result in results if result)
+    valid = sum(result[1] for result in results if result)
+    print(
+        f'Checked {checked} open pull requests in {len(results)} repositories; '
+        f'{checked - valid} without valid guidance; {errors} repositories could not be checked.',
+        file=sys.stderr,
+    )
+    return checked == valid and not errors
+
+
+def load_cache(cache_file: Optional[str]) -> Dict[str, Dict]:
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_cache(cache_file: Optional[str], cache: Dict[str, Dict]):
+    if cache_file:
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f)
+
+
+def get_label_names(
+    session: requests.Session, repository: str, pr_number: int, cache: Dict[str, Dict]
+) -> List[str]:
+    """
+    Lists the pull request's labels through the issue labels endpoint, which
+    takes one request (per 100 labels), instead of the three that it takes to
+    get the repository, then the pull request, then its labels.
+
+    Each page is requested with the ETag it had last time, if it is in the
+    cache; GitHub answers an unchanged page with a 304, which is free.
+    """
+    names = []
+    url = f'{GITHUB_API_URL}/repos/{repository}/issues/{pr_number}/labels?per_page=100'
+    while url:
+        cached = cache.get(url)
+        headers = {'If-None-Match': cached['etag']} if cached else {}
+        response = session.get(url, headers=headers, timeout=30)
+        if response.status_code == 304:
+            page = cached['labels']
+        else:
+            response.raise_for_status()
+            page = [label['name'] for label in response.json()]
+            if response.headers.get('ETag'):
+                cache[url] = {'etag': response.headers['ETag'], 'labels': page}
+        names.extend(page)
+        url = response.links.get('next', {}).get('url')
+    return names
+
+
 if __name__ == "__main__":
     args = get_parser().parse_args()
-    repo = Github(args.github_token).get_repo(args.github_repository)
+    if args.audit or args.audit_org:
+        session = make_session(args.github_token, pool_size=args.workers)
+        repositories = list(args.audit)
+        if args.audit_org:
+            repositories.extend(iter_org_repositories(session, args.audit_org))
+        if args.audit_report:
+            with open(args.audit_report, 'w') as report:
+                passed = audit(session, repositories, args.workers, report)
+        else:
+            passed = audit(session, repositories, args.workers, sys.stdout)
+        set_budget_output(session)
+        sys.exit(0 if passed else 1)
+
     if getattr(args, 'pr_number', None):
         pr_number = int(args.pr_number)
     else:
         pr_number = get_pr_number(args.github_ref)
 
-    guidance = [
-        label.name.split(':')[-1] for label in repo.get_pull(pr_number).labels
-        if label.name.startswith('semver-guidance:')
-    ]
+    session = make_session(args.github_token)
+    cache = load_cache(args.cache_file)
+    label_names = get_label_names(session, args.github_repository, pr_number, cache)
+    save_cache(args.cache_file, cache)
+    set_budget_output(session)
+
+    guidance = get_guidance(label_names)
     if len(guidance) > 1:
         raise ValueError('Too many guidance labels applied! '
                          'Please remove extraneous "semver-guidance" labels '
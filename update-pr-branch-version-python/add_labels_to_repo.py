@@ -1,17 +1,27 @@
-# pip install pygithub
-from github import (
-    Auth,
-    Github,
-    UnknownObjectException,
-)
+#!/usr/bin/env python
+"""
+Adds the semver-guidance labels to repositories, and updates the color and
+description of any that are out of date:
 
-# Personal access token suitable for updating repo labels
-GH_PAT = "ghp_"
-# repo to update
-GH_REPO = "UWIT-IAM/test-update-pr-branch-version-python"
+    ./add_labels_to_repo.py --github-token $TOKEN UWIT-IAM/repo-1 UWIT-IAM/repo-2
 
-# recreate existing labels? useful to synchronize description and/or color
-recreate = True
+The token must be allowed to update the repositories' labels (e.g., a
+personal access token). Each repository's labels are listed once, and only
+the labels that are missing or different are created or edited; repositories
+are updated concurrently.
+"""
+# pip install requests
+import os
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+
+import requests
+
+# A copy of require-semver-guidance-label/github_api.py
+from github_api import GITHUB_API_URL, make_session
 
 # These values taken from https://github.com/UWIT-IAM/identity-uw/labels
 REQUIRED_LABELS = [
@@ -23,28 +33,136 @@ REQUIRED_LABELS = [
 ]
 
 
-# Authenticate. You do not have to use a PAT
-# https://pygithub.readthedocs.io/en/stable/examples/Authentication.html
-auth = Auth.Token(GH_PAT)
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser('Add the semver-guidance labels to repositories.')
+    parser.add_argument('repositories', nargs='+', metavar='REPOSITORY',
+                        help='e.g., UWIT-IAM/test-update-pr-branch-version-python')
+    parser.add_argument('--github-token', default=os.environ.get('GITHUB_TOKEN'))
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help='The number of repositories to update at once.'
+    )
+    parser.add_argument(
+        '--create-only', action='store_true',
+        help="Only create missing labels; don't update the color or "
+             "description of existing ones."
+    )
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help="Print what would be changed, but don't change anything."
+    )
+    return parser
+
+
+class SyncResult(NamedTuple):
+    repository: str
+    created: List[str]
+    updated: List[str]
+    unchanged: List[str]
+    # The requests made, including listing the labels.
+    calls: int
+    error: Optional[str] = None
+
+    @property
+    def calls_saved(self) -> int:
+        """
+        Compared to looking up each label, and then creating or editing it,
+        after getting the repository.
+        """
+        return 1 + 2 * len(REQUIRED_LABELS) - self.calls
+
+
+def list_labels(session: requests.Session, repository: str) -> Tuple[Dict[str, Dict], int]:
+    """
+    :return: Every label in the repository, by lowercase name (label names
+        are case-insensitive), along with the number of requests made.
+    """
+    labels, calls = {}, 0
+    url = f'{GITHUB_API_URL}/repos/{repository}/labels?per_page=100'
+    while url:
+        response = session.get(url, timeout=30)
+        calls += 1
+        response.raise_for_status()
+        for label in response.json():
+            labels[label['name'].lower()] = label
+        url = response.links.get('next', {}).get('url')
+    return labels, calls
 
-# Create main Github object
-g = Github(auth=auth)
 
-repo = g.get_repo(GH_REPO)
-print(f"Updating semver-guidance labels on {repo.name}")
+def is_up_to_date(label: Dict, name: str, color: str, description: str) -> bool:
+    return (
+        label['name'] == name
+        and label['color'].lower() == color.lower()
+        and (label.get('description') or '') == description
+    )
 
-for name, color, desc in REQUIRED_LABELS:
+
+def sync_labels(
+    session: requests.Session, repository: str, create_only: bool = False,
+    dry_run: bool = False,
+) -> SyncResult:
+    calls = 0
+    created, updated, unchanged = [], [], []
     try:
-        label = repo.get_label(name=name)
-    except UnknownObjectException:  # 404, basically
-        defined = False
-    else:
-        defined = True
-
-    if not defined:
-        repo.create_label(name=name, color=color, description=desc)
-        print(f"Created label {name}")
-    elif recreate:
-        # NOTE: name required positional arg
-        label.edit(name=name, color=color, description=desc)
-        print(f"Updated label {name}")
+        existing, calls = list_labels(session, repository)
+        for name, color, description in REQUIRED_LABELS:
+            label = existing.get(name.lower())
+            if label and (create_only or is_up_to_date(label, name, color, description)):
+                unchanged.append(name)
+                continue
+            body = dict(color=color, description=description)
+            if label:
+                updated.append(name)
+                # The name is sent too, to fix its case if that is all that differs.
+                method = 'PATCH'
+                url = f"{GITHUB_API_URL}/repos/{repository}/labels/{quote(label['name'], safe='')}"
+                body['new_name'] = name
+            else:
+                created.append(name)
+                method = 'POST'
+                url = f'{GITHUB_API_URL}/repos/{repository}/labels'
+                body['name'] = name
+            if not dry_run:
+                calls += 1
+                session.request(method, url, json=body, timeout=30).raise_for_status()
+    except requests.RequestException as e:
+        return SyncResult(repository, created, updated, unchanged, calls, error=str(e))
+    return SyncResult(repository, created, updated, unchanged, calls)
+
+
+def main(args) -> int:
+    session = make_session(args.github_token, pool_size=args.workers)
+
+    def sync(repository: str) -> SyncResult:
+        return sync_labels(
+            session, repository, create_only=args.create_only, dry_run=args.dry_run
+        )
+
+    prefix = '[DRY RUN] ' if args.dry_run else ''
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(sync, args.repositories))
+    for result in results:
+        if result.error:
+            print(f'{result.repository}: FAILED: {result.error}', file=sys.stderr)
+            continue
+        print(
+            f'{prefix}{result.repository}: created {result.created or "none"}; '
+            f'updated {result.updated or "none"}; {len(result.unchanged)} unchanged'
+        )
+    calls = sum(result.calls for result in results)
+    saved = sum(result.calls_saved for result in results if not result.error)
+    print(
+        f'{prefix}Synchronized labels in {len(results)} repositories with '
+        f'{calls} requests ({saved} fewer than looking up each label).'
+    )
+    budget = session.get_budget()
+    print(
+        f"{budget['used']} requests counted against the rate limit "
+        f"({budget['remaining']} of {budget['limit']} left); rate limited "
+        f"{budget['rate-limited']} times, waited {budget['waited-seconds']}s."
+    )
+    return 1 if any(result.error for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_parser().parse_args()))
@@ -0,0 +1,186 @@
+"""
+A requests session for the GitHub REST API that keeps within the token's rate
+limit, shared by the python scripts in this repository. Each action that uses it
+(require-semver-guidance-label and update-pr-branch-version-python) has its own
+identical copy, so that either can be checked out or built on its own; change
+both together.
+
+Every response's X-RateLimit-* headers are recorded. Once fewer than
+`reserve` requests are left, requests are spaced out so that the rest of the
+budget lasts until it resets, instead of running into 403s; requests that
+hit the primary or a secondary rate limit anyway are retried after the wait
+that GitHub asks for.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+
+
+class RateLimitError(requests.HTTPError):
+    """
+    Raised when a request is still rate-limited after every retry, or would
+    have to wait longer than allowed.
+    """
+
+
+class GitHubSession(requests.Session):
+    def __init__(
+        self,
+        github_token: str,
+        reserve: int = 100,
+        max_retries: int = 5,
+        max_wait_seconds: float = 900,
+    ):
+        """
+        :param reserve: Requests are paced once fewer than this many are left.
+        :param max_retries: How many times to retry a rate-limited request.
+        :param max_wait_seconds: The longest to wait for a single request.
+        """
+        super().__init__()
+        self.headers.update({
+            'Accept': 'application/vnd.github+json',
+            'Authorization': f'Bearer {github_token}',
+        })
+        self.reserve = reserve
+        self.max_retries = max_retries
+        self.max_wait_seconds = max_wait_seconds
+        self._lock = threading.Lock()
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset_at: Optional[float] = None
+        self._next_request_at = 0.0
+        # Requests that counted against the rate limit (conditional requests
+        # answered with a 304 don't).
+        self.used = 0
+        self.rate_limited = 0
+        self.waited_seconds = 0.0
+
+    def _get_pacing_delay(self) -> float:
+        """
+        :return: How long to wait before the next request; requests from
+            every thread are given their own slots.
+        """
+        with self._lock:
+            if self.remaining is None or self.remaining >= self.reserve:
+                return 0
+            now = time.time()
+            until_reset = max(self.reset_at - now, 0)
+            if self.remaining <= 0:
+                return until_reset
+            slot = max(now, self._next_request_at)
+            self._next_request_at = slot + until_reset / self.remaining
+            return slot - now
+
+    def _record(self, response: requests.Response):
+        headers = response.headers
+        with self._lock:
+            if response.status_code != 304:
+                self.used += 1
+            if 'X-RateLimit-Remaining' in headers:
+                self.limit = int(headers['X-RateLimit-Limit'])
+                self.remaining = int(headers['X-RateLimit-Remaining'])
+                self.reset_at = float(headers['X-RateLimit-Reset'])
+
+    @staticmethod
+    def _get_retry_delay(response: requests.Response, attempt: int) -> Optional[float]:
+        """
+        :return: How long to wait before retrying, if the response was
+            rate-limited; otherwise None.
+        """
+        if response.status_code not in (403, 429):
+            return None
+        headers = response.headers
+        if 'Retry-After' in headers:
+            return float(headers['Retry-After'])
+        if headers.get('X-RateLimit-Remaining') == '0':
+            return max(float(headers['X-RateLimit-Reset']) - time.time(), 0) + 1
+        if response.status_code == 429 or 'rate limit' in response.text.lower():
+            # A secondary rate limit without a Retry-After; GitHub asks for
+            # at least a minute, and longer if it keeps happening.
+            return 60 * 2 ** attempt
+        return None
+
+    def _wait(self, seconds: float):
+        if seconds > self.max_wait_seconds:
+            raise RateLimitError(
+                f'Rate limited for {seconds:.0f}s, longer than {self.max_wait_seconds:.0f}s'
+            )
+        with self._lock:
+            self.waited_seconds += seconds
+        time.sleep(seconds)
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        for attempt in range(self.max_retries + 1):
+            delay = self._get_pacing_delay()
+            if delay:
+                self._wait(delay)
+            response = super().request(method, url, *args, **kwargs)
+            self._record(response)
+            delay = self._get_retry_delay(response, attempt)
+            if delay is None:
+                return response
+            with self._lock:
+                self.rate_limited += 1
+            if attempt == self.max_retries:
+                break
+            logging.warning(f'Rate limited by GitHub; retrying {method} {url} in {delay:.0f}s')
+            self._wait(delay)
+        raise RateLimitError(
+            f'Still rate limited after {self.max_retries} retries: {method} {url}',
+            response=response,
+        )
+
+    def get_budget(self) -> Dict:
+        """
+        :return: The rate limit budget used by this session, and what is left.
+        """
+        with self._lock:
+            return {
+                'used': self.used,
+                'remaining': self.remaining,
+                'limit': self.limit,
+                'rate-limited': self.rate_limited,
+                'waited-seconds': round(self.waited_seconds, 1),
+            }
+
+
+def make_session(github_token: str, pool_size: int = 10, **kwargs) -> GitHubSession:
+    """
+    :param kwargs: Passed to the GitHubSession.
+    """
+    session = GitHubSession(github_token, **kwargs)
+    # Retries transient server errors; rate limits are handled by the session.
+    retry = Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=None,
+    )
+    session.mount(
+        'https://', HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+    )
+    return session
+
+
+def set_budget_output(session: GitHubSession):
+    """
+    Reports the budget used as the `rate-limit-used` and `rate-limit-remaining`
+    outputs, when running as an action.
+    """
+    budget = session.get_budget()
+    print(f'GitHub rate limit budget: {budget}', file=sys.stderr)
+    output_file = os.environ.get('GITHUB_OUTPUT')
+    if output_file:
+        with open(output_file, 'a') as outf:
+            print(f"rate-limit-used={budget['used']}", file=outf)
+            remaining = budget['remaining']
+            print(f"rate-limit-remaining={'' if remaining is None else remaining}", file=outf)
@@ -0,0 +1,104 @@
+from typing import Dict, List
+
+import requests
+
+from add_labels_to_repo import REQUIRED_LABELS, sync_labels
+
+REPOSITORY = 'UWIT-IAM/test'
+
+
+class FakeResponse:
+    def __init__(self, data=None, status_code: int = 200, links: Dict = None):
+        self.data = data
+        self.status_code = status_code
+        self.links = links or {}
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} Error')
+
+
+class FakeSession:
+    """
+    Stands in for a requests session, serving the repository's labels a page at
+    a time, and recording every change that is asked for.
+    """
+
+    def __init__(
+        self, labels: List[Dict], page_size: int = 100, status_code: int = 200
+    ):
+        self.pages = [labels[i:i + page_size] for i in range(0, len(labels), page_size)]
+        self.status_code = status_code
+        self.changes = []
+
+    def get(self, url: str, timeout: float) -> FakeResponse:
+        page = int(url.rpartition('page=')[2]) if '&page=' in url else 0
+        links = {}
+        if page + 1 < len(self.pages):
+            links['next'] = {'url': f'{url.partition("&page=")[0]}&page={page + 1}'}
+        return FakeResponse(self.pages[page] if self.pages else [], links=links)
+
+    def request(
+        self, method: str, url: str, json: Dict, timeout: float
+    ) -> FakeResponse:
+        self.changes.append((method, url.rpartition('/labels')[2], json))
+        return FakeResponse(status_code=self.status_code)
+
+
+def label(name: str, color: str, description: str) -> Dict:
+    return {'name': name, 'color': color, 'description': description}
+
+
+UP_TO_DATE = [label(*required) for required in REQUIRED_LABELS]
+
+
+def test_up_to_date_labels_are_left_alone():
+    session = FakeSession(UP_TO_DATE)
+    result = sync_labels(session, REPOSITORY)
+    assert session.changes == []
+    assert result.unchanged == [name for name, _, _ in REQUIRED_LABELS]
+    assert result.calls == 1
+    assert result.calls_saved == 2 * len(REQUIRED_LABELS)
+
+
+def test_only_missing_and_different_labels_are_changed():
+    (major, color, description), (minor, minor_color, minor_description) = (
+        REQUIRED_LABELS[:2]
+    )
+    labels = [label(name, '000000', 'Other') for name in ('bug', 'docs')]
+    # Colors are compared case-insensitively, but names are fixed if their
+    # case differs.
+    labels.append(label(major.upper(), color.lower(), description))
+    labels.extend(UP_TO_DATE[2:])
+    session = FakeSession(labels, page_size=2)
+
+    result = sync_labels(session, REPOSITORY)
+    assert result.created == [minor]
+    assert result.updated == [major]
+    assert session.changes == [
+        ('PATCH', '/SEMVER-GUIDANCE%3AMAJOR',
+         {'color': color, 'description': description, 'new_name': major}),
+        ('POST', '',
+         {'color': minor_color, 'description': minor_description, 'name': minor}),
+    ]
+    # Three pages of labels, and two changes.
+    assert result.calls == 5
+
+
+def test_create_only_and_dry_run():
+    labels = [label(name, '000000', '') for name, _, _ in REQUIRED_LABELS[1:]]
+    session = FakeSession(labels)
+    result = sync_labels(session, REPOSITORY, create_only=True, dry_run=True)
+    assert result.created == [REQUIRED_LABELS[0][0]]
+    assert result.updated == []
+    assert session.changes == []
+
+
+def test_errors_are_reported_per_repository():
+    session = FakeSession([], status_code=403)
+    result = sync_labels(session, REPOSITORY)
+    assert result.error == '403 Error'
+    assert len(session.changes) == 1
@@ -0,0 +1,236 @@
+"""
+asyncio versions of the canvas clients, so that one process can work on many
+canvases at once, e.g.:
+
+    pool = AsyncClientPool()
+    await asyncio.gather(
+        *(pool.apply_operations(canvas_id, ops) for canvas_id, ops in work.items())
+    )
+
+Datastore and slack calls are made by the regular (blocking) clients on a thread
+pool, so that they keep their transactions, fencing, caching and rate limiting;
+waiting for a contended lock and renewing a lease are done on the event loop,
+so they never tie up a thread. As with the blocking clients, only new messages
+are posted while a lock is held, and the rest of each slack update is sent once
+it has been released.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from client import (
+    LOCK_HEARTBEAT_SECONDS,
+    ClientPool,
+    DatastoreClient,
+    TargetUpdate,
+    WorkflowCanvasClient,
+    iter_lock_backoff,
+)
+from models import Workflow
+
+if TYPE_CHECKING:
+    from operations import Operation
+
+
+async def run_in_executor(
+    executor: Optional[Executor], fn: Callable, *args, **kwargs
+) -> Any:
+    """
+    :param executor: None uses the event loop's default executor.
+    """
+    loop = asyncio.get_running_loop()
+    # Copies the caller's context, so that the call's timing spans are
+    # recorded to the caller's command.
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        executor, functools.partial(context.run, fn, *args, **kwargs)
+    )
+
+
+class AsyncDatastoreClient:
+    """
+    Like a DatastoreClient, each instance is meant to hold one lock at a time.
+    """
+
+    def __init__(
+        self, datastore_client: DatastoreClient, executor: Optional[Executor] = None
+    ):
+        self.datastore_client = datastore_client
+        self.executor = executor
+
+    async def _run(self, fn: Callable, *args, **kwargs) -> Any:
+        return await run_in_executor(self.executor, fn, *args, **kwargs)
+
+    async def acquire_lock(self, workflow_id: str):
+        started = time.monotonic()
+        backoff = iter_lock_backoff()
+        while not await self._run(self.datastore_client._attempt_lock, workflow_id):
+            await asyncio.sleep(next(backoff))
+        self.datastore_client.lock_wait_seconds += time.monotonic() - started
+
+    async def _renew_lease_until_cancelled(self, workflow_id: str):
+        from google.api_core.exceptions import Conflict
+
+        while True:
+            await asyncio.sleep(LOCK_HEARTBEAT_SECONDS)
+            try:
+                if not await self._run(self.datastore_client.renew_lease, workflow_id):
+                    return
+            except Conflict:
+                # Try again on the next beat; the lease has room for a miss.
+                logging.warning(f"Conflict renewing lease on {workflow_id}")
+
+    async def release_lock(self, workflow_id: str):
+        await self._run(self.datastore_client.release_lock, workflow_id)
+
+    @asynccontextmanager
+    async def lock_workflow(
+        self, workflow_id: str, save_on_exit: bool = False
+    ) -> AsyncIterator[Workflow]:
+        await self.acquire_lock(workflow_id)
+        heartbeat = asyncio.ensure_future(self._renew_lease_until_cancelled(workflow_id))
+        try:
+            workflow = await self._run(
+                self.datastore_client._get_locked_workflow, workflow_id
+            )
+            yield workflow
+            if save_on_exit:
+                await self.store_workflow(workflow)
+        finally:
+            heartbeat.cancel()
+            await self.release_lock(workflow_id)
+
+    async def materialize_events(
+        self, workflow_id: str, canvas_client: AsyncWorkflowCanvasClient
+    ) -> bool:
+        return await self._run(
+            self.datastore_client.materialize_events,
+            workflow_id,
+            canvas_client.canvas_client,
+        )
+
+    async def load_workflow(self, workflow_id: str) -> Workflow:
+        return await self._run(self.datastore_client.load_workflow, workflow_id)
+
+    async def store_workflow(self, workflow: Workflow) -> str:
+        return await self._run(self.datastore_client.store_workflow, workflow)
+
+    async def send_unlocked(
+        self,
+        canvas_client: AsyncWorkflowCanvasClient,
+        workflow: Workflow,
+        version: str,
+        updates: List[TargetUpdate],
+    ):
+        await self._run(
+            self.datastore_client._send_unlocked,
+            canvas_client.canvas_client,
+            workflow,
+            version,
+            updates,
+        )
+
+    async def delete_workflow(self, workflow_id: str):
+        await self._run(self.datastore_client.delete_workflow, workflow_id)
+
+    async def delete_lock(self, workflow_id: str):
+        await self._run(self.datastore_client.delete_lock, workflow_id)
+
+
+class AsyncWorkflowCanvasClient:
+    def __init__(
+        self, canvas_client: WorkflowCanvasClient, executor: Optional[Executor] = None
+    ):
+        self.canvas_client = canvas_client
+        self.executor = executor
+
+    async def _run(self, fn: Callable, *args, **kwargs) -> Any:
+        return await run_in_executor(self.executor, fn, *args, **kwargs)
+
+    async def create_workflow_canvas(self, workflow: Workflow):
+        await self._run(self.canvas_client.create_workflow_canvas, workflow)
+
+    async def update_workflow_canvas(self, workflow: Workflow, force: bool = False) -> bool:
+        updates = self.canvas_client.prepare_update(workflow, force=force)
+        if updates is None:
+            return False
+        return await self._run(self.canvas_client.send_update, workflow, updates)
+
+    async def post_and_store(
+        self, workflow: Workflow, datastore_client: AsyncDatastoreClient
+    ) -> Tuple[str, List[TargetUpdate]]:
+        """
+        Posts the canvas's new messages, whose ids are stored with the workflow,
+        then stores it; the caller must hold the workflow's lock.
+        :return: The version that was stored, and the rest of the update, for
+            `AsyncDatastoreClient.send_unlocked` once the lock has been released.
+        """
+        deferred = []
+        updates = self.canvas_client.prepare_update(workflow)
+        if updates:
+            posts, deferred = self.canvas_client.split_update(updates)
+            if posts:
+                await self._run(self.canvas_client.send_update, workflow, posts)
+        return await datastore_client.store_workflow(workflow), deferred
+
+
+class AsyncClientPool:
+    """
+    Hands out async clients that share one set of backend connections, workflow
+    cache and slack rate limits.
+    """
+
+    def __init__(
+        self,
+        client_pool: Optional[ClientPool] = None,
+        executor: Optional[Executor] = None,
+    ):
+        self.client_pool = client_pool or ClientPool()
+        self.executor = executor
+
+    def datastore_client(self) -> AsyncDatastoreClient:
+        return AsyncDatastoreClient(self.client_pool.datastore_client(), self.executor)
+
+    def canvas_client(self) -> AsyncWorkflowCanvasClient:
+        return AsyncWorkflowCanvasClient(self.client_pool.canvas_client(), self.executor)
+
+    async def apply_operations(
+        self, workflow_id: str, operations: List[Operation]
+    ) -> List[Dict[str, Any]]:
+        """
+        Applies operations to a canvas the same way the `batch` command does:
+        under a single lock, with a single slack update.
+        :return: The result of each operation.
+        """
+        datastore_client = self.datastore_client()
+        canvas_client = self.canvas_client()
+        async with datastore_client.lock_workflow(workflow_id) as workflow:
+            results = [
+                dict(command=operation.command, **operation.apply(workflow))
+                for operation in operations
+            ]
+            version, deferred = await canvas_client.post_and_store(
+                workflow, datastore_client
+            )
+        if deferred:
+            await datastore_client.send_unlocked(
+                canvas_client, workflow, version, deferred
+            )
+        await datastore_client.materialize_events(workflow_id, canvas_client)
+        return results
@@ -1,124 +1,1246 @@
 from __future__ import annotations
 
+import contextvars
+import hashlib
+import json
 import logging
 import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Dict
+from datetime import datetime, timedelta, timezone
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    MutableMapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 from uuid import uuid4
 
-from google.cloud import datastore
-from slack_sdk import WebClient
+import codec
+import operations
+import timing
+from models import ActionSettings, CanvasPage, CanvasTarget, Workflow
+from throttle import SlackRateLimiter, ThrottledSlackClient
 
-from models import ActionSettings, PostMessageInput, Workflow
+# google-cloud-datastore and slack_sdk are by far the slowest imports in the app,
+# so they are only imported once a command actually needs them.
+if TYPE_CHECKING:
+    from google.cloud import datastore
+    from slack_sdk import WebClient
+
+# Waiters back off exponentially, starting in the tens of milliseconds
+# so that an uncontended (or briefly contended) lock is picked up almost
+# immediately, and capping out so that long waits don't hammer Datastore.
+LOCK_BACKOFF_INITIAL_SECONDS = 0.025
+LOCK_BACKOFF_MAX_SECONDS = 2.0
+TRANSACTION_ATTEMPTS = 5
+# A lock is a lease: if its holder disappears (e.g., the job is cancelled and
+# never reaches its `finally`), waiters may take the lock over once the lease
+# expires. Holders renew the lease in the background while they work.
+LOCK_LEASE_SECONDS = 30
+LOCK_HEARTBEAT_SECONDS = LOCK_LEASE_SECONDS / 3
+# Datastore allows at most this many mutations in a single transaction.
+MAX_MUTATIONS_PER_TRANSACTION = 500
+# Applied events are deleted in the same transaction that stores the workflow,
+# so this leaves room in that transaction for steps.
+MAX_EVENTS_PER_STORE = 250
+# Slack updates are sent after the lock is released, so a newer version of the
+# canvas may reach slack first; this bounds how many times an update re-sends
+# the newest version instead (see `DatastoreClient._send_unlocked`).
+UNLOCKED_SEND_ROUNDS = 3
+
+
+T = TypeVar("T")
+
+
+def iter_lock_backoff() -> Iterator[float]:
+    """
+    :return: How long to wait before each successive attempt at a contended lock.
+    """
+    backoff = LOCK_BACKOFF_INITIAL_SECONDS
+    while True:
+        yield random.uniform(backoff / 2, backoff)
+        backoff = min(backoff * 2, LOCK_BACKOFF_MAX_SECONDS)
+
+
+_event_name_lock = threading.Lock()
+_last_event_time_ns = 0
+
+
+def new_event_name() -> str:
+    """
+    Event entities are named so that they sort in the order they were created:
+    by time (strictly increasing within this process), then randomly.
+    """
+    global _last_event_time_ns
+    with _event_name_lock:
+        _last_event_time_ns = max(time.time_ns(), _last_event_time_ns + 1)
+        return f"{_last_event_time_ns:020d}-{uuid4().hex[:8]}"
+
+
+class TargetUpdate(NamedTuple):
+    """
+    The pages of a canvas to send to one of its targets.
+    """
+
+    target: CanvasTarget
+    # page number (0 is the message itself) -> the payload to send it
+    payloads: Dict[int, Dict]
+    # Replies that are no longer needed. They have already been removed from the
+    # target, and are deleted once its pages have been sent.
+    deleted_pages: List[CanvasPage]
+
+
+def get_page(target: CanvasTarget, number: int) -> Union[CanvasTarget, CanvasPage]:
+    """
+    :return: The target itself for the first page, which is its message.
+    """
+    return target if number == 0 else target.pages[number - 1]
+
+
+def get_page_key(target: CanvasTarget, number: int) -> Tuple[str, str]:
+    """
+    :return: The (channel, message id) that a page was posted as.
+    """
+    return target.channel, get_page(target, number).message_id
+
+
+def get_page_hashes(workflow: Workflow) -> Dict[Tuple[str, str], Optional[str]]:
+    """
+    :return: The payload hash of every page that has been posted, by its
+        (channel, message id).
+    """
+    return {
+        (target.channel, page.message_id): page.payload_hash
+        for target in workflow.targets
+        for page in [target] + target.pages
+        if page.message_id
+    }
+
+
+def new_datastore_backend() -> datastore.Client:
+    from google.cloud import datastore
+
+    return datastore.Client(namespace="github-actions")
+
+
+def new_slack_backend() -> WebClient:
+    from slack_sdk import WebClient
+
+    settings = ActionSettings()
+    return WebClient(settings.slack_bot_token.get_secret_value())
+
+
+def new_entity(
+    key: datastore.Key, exclude_from_indexes: Tuple[str, ...] = ()
+) -> datastore.Entity:
+    from google.cloud import datastore
+
+    return datastore.Entity(key=key, exclude_from_indexes=exclude_from_indexes)
+
+
+class StaleLockError(RuntimeError):
+    """
+    Raised when a write is attempted with a fencing token that is no longer
+    current, i.e., our lease expired and another instance has since taken over
+    the lock.
+    """
+
+
+class LeaseHeartbeat(threading.Thread):
+    """
+    Periodically renews a held lock lease until stopped.
+    """
+
+    def __init__(self, datastore_client: DatastoreClient, workflow_id: str):
+        super().__init__(name=f"lease-heartbeat-{workflow_id}", daemon=True)
+        self.datastore_client = datastore_client
+        self.workflow_id = workflow_id
+        self._stopped = threading.Event()
+
+    def run(self):
+        from google.api_core.exceptions import Conflict
+
+        while not self._stopped.wait(LOCK_HEARTBEAT_SECONDS):
+            try:
+                if not self.datastore_client.renew_lease(self.workflow_id):
+                    return
+            except Conflict:
+                # Try again on the next beat; the lease has room for a miss.
+                logging.warning(f"Conflict renewing lease on {self.workflow_id}")
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
 
 
 class DatastoreClient:
-    def __init__(self):
-        self.client = datastore.Client(namespace="github-actions")
+    def __init__(
+        self,
+        client: Optional[datastore.Client] = None,
+        workflow_cache: Optional[MutableMapping[str, Tuple[str, Workflow]]] = None,
+    ):
+        self.client = client or new_datastore_backend()
         self.lock_id = str(uuid4())
         self.workflow_kind = "SlackWorkflowCanvas"
         self.lock_kind = "SlackWorkflowLock"
+        # Each step is stored as a child entity of its workflow, so that commands
+        # only write the steps they change, and no workflow can outgrow
+        # Datastore's entity size limit.
+        self.step_kind = "SlackWorkflowStep"
+        # In lock-free mode, commands append their operations as event entities
+        # under the workflow, instead of waiting for the lock; the events are
+        # applied by whoever next holds the lock.
+        self.event_kind = "SlackWorkflowEvent"
+        # workflow id -> the keys of the events applied to the workflow in hand,
+        # which are deleted when it is stored.
+        self._applied_events: Dict[str, List[datastore.Key]] = {}
+        # Total time spent waiting on contended locks, reported as an output.
+        self.lock_wait_seconds = 0.0
+        # The fencing token of the lock currently held by this instance, if any.
+        # Every acquisition increments the token stored on the lock entity, so
+        # a holder whose lease was taken over can be recognized by its token.
+        self.fencing_token: Optional[int] = None
+        self.lease_seconds = LOCK_LEASE_SECONDS
+        # Every store writes a new random version onto both the workflow entity and
+        # the lock entity. The version observed when acquiring a lock tells us
+        # whether a workflow we already have (keyed by id) is still current.
+        # The cache may be kept on disk (see workflow_cache.py), for the next
+        # command of the job.
+        self.workflow_cache = {} if workflow_cache is None else workflow_cache
+        self._locked_version: Optional[str] = None
 
     @contextmanager
-    def lock_workflow(self, workflow_id: str, save_on_exit: bool = False) -> Workflow:
-        lock_acquired = False
-        key = self.client.key(self.lock_kind, workflow_id)
-        lock_entity = None
-        while not lock_acquired:
-            lock_entity = self.client.get(key) or datastore.Entity(key=key)
+    def _transaction(self) -> datastore.Transaction:
+        """
+        Runs the body in a Datastore transaction that is committed on exit.
+        The transaction is managed explicitly (rather than with the client's own
+        context manager) so that it is never pushed onto the client's batch stack;
+        reads inside the body must pass `transaction=` themselves.
+        """
+        transaction = self.client.transaction()
+        transaction.begin()
+        try:
+            yield transaction
+        except Exception:
+            transaction.rollback()
+            raise
+        transaction.commit()
+
+    def _run_in_transaction(self, fn: Callable[[datastore.Transaction], T]) -> T:
+        """
+        Runs `fn` in a transaction, retrying if the transaction conflicts with
+        another (e.g., our own lease heartbeat).
+        """
+        from google.api_core.exceptions import Conflict
+
+        for attempt in range(TRANSACTION_ATTEMPTS):
+            try:
+                with self._transaction() as transaction:
+                    result = fn(transaction)
+                return result
+            except Conflict:
+                if attempt == TRANSACTION_ATTEMPTS - 1:
+                    raise
+                time.sleep(random.uniform(0, LOCK_BACKOFF_INITIAL_SECONDS))
+
+    @staticmethod
+    def _now() -> datetime:
+        return datetime.now(tz=timezone.utc)
+
+    def _get_lock_key(self, workflow_id: str) -> datastore.Key:
+        return self.client.key(self.lock_kind, workflow_id)
+
+    def _try_acquire_lock(self, key: datastore.Key) -> Optional[str]:
+        """
+        Atomically claims the lock entity if nobody else holds an unexpired lease
+        on it.
+        :return: None if the lock was acquired, otherwise the id of the holder.
+        """
+        with self._transaction() as transaction:
+            lock_entity = self.client.get(key, transaction=transaction)
+            lock_entity = lock_entity or new_entity(key)
             lock_id = lock_entity.get("lock_id")
+            now = self._now()
             if lock_id and lock_id != self.lock_id:
-                logging.warning(f"Entity {workflow_id} is locked by instance {lock_id}")
-                jitter = random.randrange(1000, 2000)
-                timeout = jitter / 1000.0
-                time.sleep(timeout)
-            else:
-                lock_entity["lock_id"] = self.lock_id
-                self.client.put(lock_entity)
-                lock_acquired = True
+                # Locks written before leases existed have no expiry; they
+                # are treated as expired so that they can never wedge a canvas.
+                expires_at = lock_entity.get("expires_at")
+                if expires_at and expires_at > now:
+                    return lock_id
+                logging.warning(
+                    f"Taking over expired lease on {key.name} from instance {lock_id}"
+                )
+            fencing_token = (lock_entity.get("fencing_token") or 0) + 1
+            lock_entity.update(
+                lock_id=self.lock_id,
+                expires_at=now + timedelta(seconds=self.lease_seconds),
+                fencing_token=fencing_token,
+            )
+            transaction.put(lock_entity)
+        self.fencing_token = fencing_token
+        self._locked_version = lock_entity.get("workflow_version")
+        return None
+
+    def _attempt_lock(self, workflow_id: str) -> bool:
+        """
+        :return: True if the lock was acquired.
+        """
+        from google.api_core.exceptions import Conflict
+
         try:
-            workflow = self.load_workflow(workflow_id)
+            lock_id = self._try_acquire_lock(self._get_lock_key(workflow_id))
+        except Conflict:
+            # Another runner committed a change to the lock entity
+            # between our read and our write.
+            lock_id = "(concurrent transaction)"
+        if lock_id:
+            logging.warning(f"Entity {workflow_id} is locked by instance {lock_id}")
+        return not lock_id
+
+    def acquire_lock(self, workflow_id: str):
+        started = time.monotonic()
+        backoff = iter_lock_backoff()
+        with timing.span("lock.acquire", workflow_id=workflow_id):
+            while not self._attempt_lock(workflow_id):
+                time.sleep(next(backoff))
+        self.lock_wait_seconds += time.monotonic() - started
+
+    def renew_lease(self, workflow_id: str) -> bool:
+        """
+        Extends the lease on a lock held by this instance.
+        :return: False if the lock is no longer ours to renew.
+        """
+        with self._transaction() as transaction:
+            lock_entity = self.client.get(
+                self._get_lock_key(workflow_id), transaction=transaction
+            )
+            if not self._holds_lock(lock_entity):
+                logging.error(
+                    f"Lost the lease on {workflow_id}; it was taken over by "
+                    f"instance {lock_entity and lock_entity.get('lock_id')}"
+                )
+                return False
+            lock_entity["expires_at"] = self._now() + timedelta(
+                seconds=self.lease_seconds
+            )
+            transaction.put(lock_entity)
+        return True
+
+    def _holds_lock(self, lock_entity: Optional[datastore.Entity]) -> bool:
+        return bool(
+            lock_entity
+            and self.fencing_token is not None
+            and lock_entity.get("fencing_token") == self.fencing_token
+        )
+
+    def _check_fencing_token(
+        self, workflow_id: str, transaction: datastore.Transaction
+    ) -> Optional[datastore.Entity]:
+        """
+        Rejects a write from an instance whose lease has been taken over. Writes
+        made without holding a lock (e.g., when creating a canvas) are not fenced.
+        :return: The lock entity, if there is one.
+        """
+        lock_entity = self.client.get(
+            self._get_lock_key(workflow_id), transaction=transaction
+        )
+        if self.fencing_token is not None and not self._holds_lock(lock_entity):
+            current_token = lock_entity and lock_entity.get("fencing_token")
+            raise StaleLockError(
+                f"Refusing to write {workflow_id} with stale fencing token "
+                f"{self.fencing_token} (current token: {current_token})"
+            )
+        return lock_entity
+
+    def release_lock(self, workflow_id: str):
+        key = self._get_lock_key(workflow_id)
+
+        def release(transaction: datastore.Transaction):
+            lock_entity = self.client.get(key, transaction=transaction)
+            # Never clear a lock that some other instance holds. The
+            # fencing token is kept so that it keeps increasing.
+            if self._holds_lock(lock_entity):
+                lock_entity.update(lock_id=None, expires_at=None)
+                transaction.put(lock_entity)
+
+        with timing.span("lock.release", workflow_id=workflow_id):
+            self._run_in_transaction(release)
+        self.fencing_token = None
+        self._locked_version = None
+
+    @contextmanager
+    def lock_workflow(self, workflow_id: str, save_on_exit: bool = False) -> Workflow:
+        self.acquire_lock(workflow_id)
+        with self._hold_lock(workflow_id, save_on_exit=save_on_exit) as workflow:
+            yield workflow
+
+    @contextmanager
+    def _hold_lock(
+        self, workflow_id: str, save_on_exit: bool, apply_events: bool = True
+    ) -> Workflow:
+        """
+        Keeps an acquired lock alive while the body works on the workflow, then
+        releases it.
+        """
+        heartbeat = LeaseHeartbeat(self, workflow_id)
+        heartbeat.start()
+        try:
+            workflow = self._get_locked_workflow(workflow_id, apply_events=apply_events)
             yield workflow
             if save_on_exit:
                 self.store_workflow(workflow)
         finally:
-            lock_entity["lock_id"] = None
-            self.client.put(lock_entity)
+            heartbeat.stop()
+            self.release_lock(workflow_id)
+
+    def _get_locked_workflow(
+        self, workflow_id: str, apply_events: bool = True
+    ) -> Workflow:
+        """
+        :return: The current workflow, with any pending events applied.
+        """
+        workflow = self._get_cached_workflow(workflow_id, self._locked_version)
+        if not workflow:
+            return self.load_workflow(
+                workflow_id,
+                apply_events=apply_events,
+                stored_version=self._locked_version,
+            )
+        if apply_events:
+            self._apply_events(workflow, self.get_pending_events(workflow_id))
+        return workflow
+
+    @contextmanager
+    def lock_and_update(
+        self, workflow_id: str, canvas_client: WorkflowCanvasClient
+    ) -> Iterator[Workflow]:
+        """
+        Locks the workflow for the body to change, then stores it and updates its
+        canvas. Only new messages, whose ids are stored with the workflow, are
+        posted while the lock is held; everything else is sent to slack once it
+        has been released, so that other jobs never wait on slack (or on its rate
+        limits) for the lock.
+        """
+        self.acquire_lock(workflow_id)
+        with self._update_locked(workflow_id, canvas_client) as workflow:
+            yield workflow
 
-    def load_workflow(self, workflow_id: str) -> Workflow:
+    @contextmanager
+    def _update_locked(
+        self, workflow_id: str, canvas_client: WorkflowCanvasClient
+    ) -> Iterator[Workflow]:
+        """
+        `lock_and_update`, for a lock that has already been acquired.
+        """
+        deferred = []
+        with self._hold_lock(workflow_id, save_on_exit=False) as workflow:
+            yield workflow
+            updates = canvas_client.prepare_update(workflow)
+            if updates:
+                posts, deferred = canvas_client.split_update(updates)
+                if posts:
+                    canvas_client.send_update(workflow, posts)
+            # The hashes of the pages still to be sent are stored as though they
+            # had been; any that aren't are cleared again by `_send_unlocked`.
+            version = self.store_workflow(workflow)
+        if deferred:
+            self._send_unlocked(canvas_client, workflow, version, deferred)
+
+    def _send_unlocked(
+        self,
+        canvas_client: WorkflowCanvasClient,
+        workflow: Workflow,
+        version: str,
+        updates: List[TargetUpdate],
+    ):
+        """
+        Sends the updates to a workflow that has been stored at `version`, after
+        its lock has been released. Meanwhile, other jobs may store newer versions
+        and send their own updates, so:
+            - a page that a newer version has changed is left to whoever stored
+              it, as they will send it too.
+            - a page that a newer version changed while this one was being sent
+              may have reached slack last, so is sent again from the newest
+              version.
+            - a page that isn't sent, or a reply that isn't deleted, is put back
+              as it was in the stored workflow (unless a newer version has
+              changed it anyway), so that the next update retries it.
+        """
+        workflow_id = workflow.workflow_id
+        unsent: Dict[Tuple[str, str], str] = {}
+        undeleted: Dict[Tuple[str, str], Tuple[int, List[CanvasPage]]] = {}
+        sent: Dict[Tuple[str, str], str] = {}
+        error = None
+        for attempt in range(UNLOCKED_SEND_ROUNDS + 1):
+            stored_version = self.get_stored_version(workflow_id)
+            if stored_version is None:
+                # The workflow was finalized, and its canvas with it.
+                return
+            if stored_version != version:
+                version = stored_version
+                latest = self.load_workflow(
+                    workflow_id, apply_events=False, stored_version=stored_version
+                )
+                latest_hashes = get_page_hashes(latest)
+                updates = [
+                    update._replace(
+                        payloads={
+                            number: payload
+                            for number, payload in update.payloads.items()
+                            if latest_hashes.get(get_page_key(update.target, number))
+                            == get_page(update.target, number).payload_hash
+                        }
+                    )
+                    for update in updates
+                ]
+                stale = {
+                    key
+                    for key, payload_hash in sent.items()
+                    if latest_hashes.get(key, payload_hash) != payload_hash
+                }
+                if stale:
+                    updates += canvas_client.prepare_resend(latest, stale)
+            updates = [
+                update for update in updates if update.payloads or update.deleted_pages
+            ]
+            if not updates or attempt == UNLOCKED_SEND_ROUNDS:
+                break
+
+            hashes = [
+                {
+                    number: get_page(update.target, number).payload_hash
+                    for number in update.payloads
+                }
+                for update in updates
+            ]
+            num_pages = [len(update.target.pages) for update in updates]
+            try:
+                canvas_client.send_update(workflow, updates)
+            except Exception as e:
+                error = e
+            sent = {}
+            for update, update_hashes, update_num_pages in zip(
+                updates, hashes, num_pages
+            ):
+                target = update.target
+                for number, payload_hash in update_hashes.items():
+                    key = get_page_key(target, number)
+                    if get_page(target, number).payload_hash:
+                        sent[key] = payload_hash
+                    else:
+                        unsent[key] = payload_hash
+                if len(target.pages) > update_num_pages:
+                    undeleted[(target.channel, target.message_id)] = (
+                        update_num_pages,
+                        target.pages[update_num_pages:],
+                    )
+            updates = []
+
+        if unsent or undeleted:
+            self._restore_unsent(workflow_id, unsent, undeleted)
+        if error:
+            raise error
+
+    def _restore_unsent(
+        self,
+        workflow_id: str,
+        unsent: Dict[Tuple[str, str], str],
+        undeleted: Dict[Tuple[str, str], Tuple[int, List[CanvasPage]]],
+    ):
+        """
+        Clears the stored hashes of pages that weren't sent (by their (channel,
+        message id)), and puts back replies that weren't deleted (by the (channel,
+        message id) of their target, along with how many replies it was left
+        with), unless the workflow has changed them since.
+        """
+
+        def restore(workflow: Workflow) -> bool:
+            restored = False
+            for target in workflow.targets:
+                for page in [target] + target.pages:
+                    payload_hash = unsent.get((target.channel, page.message_id))
+                    if payload_hash and page.payload_hash == payload_hash:
+                        page.payload_hash = None
+                        restored = True
+                num_pages, pages = undeleted.get(
+                    (target.channel, target.message_id), (None, [])
+                )
+                if pages and len(target.pages) == num_pages:
+                    target.pages.extend(pages)
+                    restored = True
+            return restored
+
+        # Usually a newer version has changed these pages already, so there is
+        # nothing to restore, and no need for the lock.
+        stored_version = self.get_stored_version(workflow_id)
+        if stored_version is None or not restore(
+            self.load_workflow(
+                workflow_id, apply_events=False, stored_version=stored_version
+            )
+        ):
+            return
+        self.acquire_lock(workflow_id)
+        # Pending events are left for the next update, which sends them to slack.
+        with self._hold_lock(
+            workflow_id, save_on_exit=True, apply_events=False
+        ) as workflow:
+            restore(workflow)
+
+    def _get_cached_workflow(
+        self, workflow_id: str, version: Optional[str]
+    ) -> Optional[Workflow]:
+        cached_version, workflow = self.workflow_cache.get(workflow_id, (None, None))
+        if version and cached_version == version:
+            logging.debug(f"Using cached workflow {workflow_id} @ {version}")
+            return codec.copy_workflow(workflow)
+        return None
+
+    def _cache_workflow(self, version: Optional[str], workflow: Workflow):
+        if version:
+            self.workflow_cache[workflow.workflow_id] = (
+                version,
+                codec.copy_workflow(workflow),
+            )
+
+    def get_stored_version(self, workflow_id: str) -> Optional[str]:
+        """
+        :return: The version of the workflow as last stored, according to its
+            lock entity (which is much smaller than the workflow and its steps).
+        """
+        with timing.span("datastore.version", workflow_id=workflow_id):
+            lock_entity = self.client.get(self._get_lock_key(workflow_id))
+        return (lock_entity or {}).get("workflow_version")
+
+    def load_workflow(
+        self,
+        workflow_id: str,
+        apply_events: bool = True,
+        stored_version: Optional[str] = None,
+    ) -> Workflow:
+        """
+        :param apply_events: False to load the workflow as it was stored, without
+            any pending events.
+        :param stored_version: The version from the workflow's lock entity, if the
+            caller already has it, to save looking it up again.
+        """
+        if workflow_id in self.workflow_cache:
+            version = stored_version or self.get_stored_version(workflow_id)
+            workflow = self._get_cached_workflow(workflow_id, version)
+            if workflow and not apply_events:
+                return workflow
+            if workflow:
+                events = self.get_pending_events(workflow_id)
+                # Unless the lock is held, another instance may have stored the
+                # workflow (deleting the events it applied) since the version was
+                # read, in which case it is loaded afresh below.
+                if (
+                    self.fencing_token is not None
+                    or self.get_stored_version(workflow_id) == version
+                ):
+                    self._apply_events(workflow, events)
+                    return workflow
         key = self.get_workflow_key(workflow_id)
-        entity = self.client.get(key)
-        return Workflow.parse_obj(entity)
+        # An ancestor query is strongly consistent, and fetches the workflow along
+        # with all of its steps in a single round trip.
+        entity, step_entities, events = None, {}, []
+        with timing.span("datastore.load", workflow_id=workflow_id):
+            for result in self.client.query(ancestor=key).fetch():
+                if result.key == key:
+                    entity = result
+                elif result.key.kind == self.step_kind:
+                    step_entities[result.key.name] = result
+                elif result.key.kind == self.event_kind:
+                    events.append(result)
+        if entity is None:
+            raise ValueError(f"No workflow canvas named {workflow_id}")
+
+        data = dict(entity)
+        is_legacy = "step_keys" not in data
+        with timing.span("workflow.parse", workflow_id=workflow_id):
+            if is_legacy or "targets" not in data:
+                # Stored in an older format, which the models' validators convert.
+                if not is_legacy:
+                    data["steps"] = [step_entities[n] for n in data.pop("step_keys")]
+                workflow = Workflow.parse_obj(data)
+            else:
+                workflow = codec.load_workflow(
+                    data, [step_entities[name] for name in data["step_keys"]]
+                )
+        # Workflows written before steps were stored separately are never
+        # cached, so that the next store writes every step.
+        if not is_legacy:
+            self._cache_workflow(entity.get("version"), workflow)
+        if apply_events:
+            self._apply_events(workflow, events)
+        return workflow
+
+    def get_event_key(self, workflow_id: str, name: str) -> datastore.Key:
+        return self.client.key(self.workflow_kind, workflow_id, self.event_kind, name)
+
+    def append_events(self, workflow_id: str, events: List[operations.Operation]):
+        """
+        Records operations to be applied to the workflow by whoever next holds its
+        lock. This never waits for, or conflicts with, any other instance.
+        """
+        entities = []
+        for operation in events:
+            entity = new_entity(
+                self.get_event_key(workflow_id, new_event_name()),
+                exclude_from_indexes=("operation",),
+            )
+            entity["operation"] = operation.json(by_alias=True, exclude_none=True)
+            entities.append(entity)
+        with timing.span("events.append", workflow_id=workflow_id):
+            self.client.put_multi(entities)
+
+    def get_pending_events(
+        self, workflow_id: str, limit: Optional[int] = None, keys_only: bool = False
+    ) -> List[datastore.Entity]:
+        query = self.client.query(
+            kind=self.event_kind, ancestor=self.get_workflow_key(workflow_id)
+        )
+        if keys_only:
+            query.keys_only()
+        return list(query.fetch(limit=limit))
+
+    def _apply_events(self, workflow: Workflow, events: List[datastore.Entity]):
+        events = sorted(events, key=lambda e: e.key.name)[:MAX_EVENTS_PER_STORE]
+        if not events:
+            return
+        with timing.span("events.apply", workflow_id=workflow.workflow_id):
+            for event in events:
+                try:
+                    operation = operations.parse_operation(json.loads(event["operation"]))
+                    operation.apply(workflow)
+                except (ValueError, IndexError) as e:
+                    # Nobody is waiting on the result of an event, so one that
+                    # can't be applied is dropped, rather than wedging the canvas.
+                    logging.warning(
+                        f"Dropping event {event.key.name} on {workflow.workflow_id}: {e}"
+                    )
+        self._applied_events[workflow.workflow_id] = [event.key for event in events]
+
+    def materialize_events(
+        self, workflow_id: str, canvas_client: WorkflowCanvasClient
+    ) -> bool:
+        """
+        Applies any pending events to the workflow, stores it and updates its
+        canvas (as `lock_and_update` does), unless another instance holds the lock.
+        Every lock holder calls this after releasing the lock, so any event
+        appended before a failed attempt here is applied by that holder.
+        :return: False if the events were left to another instance.
+        """
+        while self.get_pending_events(workflow_id, limit=1, keys_only=True):
+            if not self._attempt_lock(workflow_id):
+                return False
+            with self._update_locked(workflow_id, canvas_client):
+                pass
+        return True
 
     def get_workflow_key(self, workflow_id) -> datastore.Key:
         return self.client.key(self.workflow_kind, workflow_id)
 
-    def store_workflow(self, workflow: Workflow):
-        data = workflow.canvas_payload
-        key = self.get_workflow_key(workflow.workflow_id)
-        entity = datastore.Entity(key=key)
+    def get_step_key(self, workflow_id: str, key_name: str) -> datastore.Key:
+        return self.client.key(self.workflow_kind, workflow_id, self.step_kind, key_name)
+
+    @staticmethod
+    def get_step_key_names(workflow: Workflow) -> List[str]:
+        """
+        Step entities are named for their step ids; should the same id be used
+        more than once, the repeats are numbered (`build`, `build#1`, ...).
+        """
+        names, counts = [], {}
+        for step in workflow.steps:
+            count = counts.get(step.step_id, 0)
+            counts[step.step_id] = count + 1
+            names.append(f"{step.step_id}#{count}" if count else step.step_id)
+        return names
+
+    def _get_stored_step_keys(
+        self, workflow_id: str, transaction: datastore.Transaction
+    ) -> List[str]:
+        stored = self.client.get(
+            self.get_workflow_key(workflow_id), transaction=transaction
+        )
+        return list((stored or {}).get("step_keys") or [])
+
+    def _put_steps(self, workflow_id: str, step_entities: List[datastore.Entity]):
+        """
+        Writes step entities ahead of the workflow entity that lists them, in as
+        many transactions as it takes. Until the workflow entity is stored, the
+        steps that it lists may no longer match it, so each transaction also
+        clears the version on the lock entity: no cached workflow is trusted,
+        and the next store writes every step, should this one not finish.
+        """
+        lock_key = self._get_lock_key(workflow_id)
+
+        def put(transaction: datastore.Transaction, chunk: List[datastore.Entity]):
+            lock_entity = self._check_fencing_token(workflow_id, transaction)
+            lock_entity = lock_entity or new_entity(lock_key)
+            lock_entity["workflow_version"] = None
+            transaction.put(lock_entity)
+            for step_entity in chunk:
+                transaction.put(step_entity)
+
+        # One mutation in each transaction is the lock entity.
+        chunk_size = MAX_MUTATIONS_PER_TRANSACTION - 1
+        for start in range(0, len(step_entities), chunk_size):
+            chunk = step_entities[start : start + chunk_size]
+            self._run_in_transaction(lambda transaction: put(transaction, chunk))
+
+    def _delete_keys(self, workflow_id: str, keys: List[datastore.Key]):
+        """
+        Deletes entities that the workflow entity no longer lists (or that belong
+        to a workflow that has been deleted), in as many transactions as it takes.
+        """
+
+        def delete(transaction: datastore.Transaction, chunk: List[datastore.Key]):
+            self._check_fencing_token(workflow_id, transaction)
+            for key in chunk:
+                transaction.delete(key)
+
+        for start in range(0, len(keys), MAX_MUTATIONS_PER_TRANSACTION):
+            chunk = keys[start : start + MAX_MUTATIONS_PER_TRANSACTION]
+            self._run_in_transaction(lambda transaction: delete(transaction, chunk))
+
+    def store_workflow(self, workflow: Workflow) -> str:
+        """
+        :return: The version of the workflow that is stored.
+        """
+        workflow_id = workflow.workflow_id
+        with timing.span("workflow.serialize", workflow_id=workflow_id):
+            data = codec.dump_workflow(workflow)
+        step_payloads = dict(zip(self.get_step_key_names(workflow), data.pop("steps")))
+        version = uuid4().hex
+        entity = new_entity(
+            self.get_workflow_key(workflow_id), exclude_from_indexes=("step_keys",)
+        )
         entity.update(**data)
-        self.client.put(entity)
+        entity["step_keys"] = list(step_payloads)
+        entity["version"] = version
+        cached_version, cached_workflow = self.workflow_cache.get(
+            workflow_id, (None, None)
+        )
+        applied_events = self._applied_events.pop(workflow_id, [])
+        if (
+            not applied_events
+            and self.fencing_token is not None
+            and cached_version == self._locked_version
+            and cached_version is not None
+            and codec.dump_workflow(cached_workflow)
+            == dict(data, steps=list(step_payloads.values()))
+        ):
+            # Nothing changed since the workflow was stored at the version that
+            # the lock holder (us) found, so there is nothing to write.
+            logging.debug(f"Workflow {workflow_id} is unchanged @ {cached_version}")
+            return cached_version
+
+        lock_key = self._get_lock_key(workflow_id)
+
+        def put_workflow(
+            transaction: datastore.Transaction, lock_entity: datastore.Entity
+        ):
+            for event_key in applied_events:
+                transaction.delete(event_key)
+            lock_entity["workflow_version"] = version
+            transaction.put(lock_entity)
+            transaction.put(entity)
+
+        def store(
+            transaction: datastore.Transaction,
+        ) -> Optional[Tuple[List[datastore.Entity], List[datastore.Key]]]:
+            """
+            Writes the workflow, along with its changed steps, if that can be done
+            in a single transaction.
+            :return: Otherwise, the step entities to put, and the keys of the
+                steps to delete, having written nothing.
+            """
+            lock_entity = self._check_fencing_token(workflow_id, transaction)
+            lock_entity = lock_entity or new_entity(lock_key)
+            if cached_version and lock_entity.get("workflow_version") == cached_version:
+                # The cached workflow is what is stored, so only the steps that
+                # differ from it need to be written.
+                stored_steps = dict(
+                    zip(
+                        self.get_step_key_names(cached_workflow),
+                        (codec.dump_step(step) for step in cached_workflow.steps),
+                    )
+                )
+            else:
+                stored_steps = dict.fromkeys(
+                    self._get_stored_step_keys(workflow_id, transaction)
+                )
+
+            step_entities = []
+            for name, payload in step_payloads.items():
+                if stored_steps.get(name) != payload:
+                    step_entity = new_entity(
+                        self.get_step_key(workflow_id, name),
+                        exclude_from_indexes=("description",),
+                    )
+                    step_entity.update(**payload)
+                    step_entities.append(step_entity)
+            removed_keys = [
+                self.get_step_key(workflow_id, name)
+                for name in stored_steps.keys() - step_payloads.keys()
+            ]
+            # The workflow entity and the lock entity are written too.
+            mutations = len(step_entities) + len(removed_keys) + len(applied_events) + 2
+            if mutations > MAX_MUTATIONS_PER_TRANSACTION:
+                return step_entities, removed_keys
+
+            for step_entity in step_entities:
+                transaction.put(step_entity)
+            for key in removed_keys:
+                transaction.delete(key)
+            put_workflow(transaction, lock_entity)
+            return None
+
+        def store_after_steps(transaction: datastore.Transaction):
+            lock_entity = self._check_fencing_token(workflow_id, transaction)
+            put_workflow(transaction, lock_entity or new_entity(lock_key))
+
+        with timing.span("datastore.store", workflow_id=workflow_id):
+            unwritten = self._run_in_transaction(store)
+            if unwritten:
+                # Too much to write at once. The steps that the workflow entity
+                # lists are the ones that are part of it, so new and changed steps
+                # are written before it, and removed steps are deleted after it.
+                step_entities, removed_keys = unwritten
+                # The version that was locked is cleared by `_put_steps`.
+                self._locked_version = None
+                self._put_steps(workflow_id, step_entities)
+                self._run_in_transaction(store_after_steps)
+                self._delete_keys(workflow_id, removed_keys)
+        if self.fencing_token is not None:
+            self._locked_version = version
+        # Cached as it was written, rather than as the workflow is now: a slack
+        # update sent after the lock is released (see `_send_unlocked`) may clear
+        # its page hashes, which are not stored.
+        self.workflow_cache[workflow_id] = (
+            version,
+            codec.load_workflow(data, list(step_payloads.values())),
+        )
+        return version
 
     def delete_workflow(self, workflow_id):
-        self.client.delete(self.get_workflow_key(workflow_id))
+        event_keys = [
+            event.key for event in self.get_pending_events(workflow_id, keys_only=True)
+        ]
+
+        def delete(transaction: datastore.Transaction) -> List[datastore.Key]:
+            """
+            Deletes the workflow entity, along with as many of its events and
+            steps as fit in the transaction.
+            :return: The keys of the events and steps left to delete.
+            """
+            self._check_fencing_token(workflow_id, transaction)
+            keys = event_keys + [
+                self.get_step_key(workflow_id, name)
+                for name in self._get_stored_step_keys(workflow_id, transaction)
+            ]
+            transaction.delete(self.get_workflow_key(workflow_id))
+            for key in keys[: MAX_MUTATIONS_PER_TRANSACTION - 1]:
+                transaction.delete(key)
+            return keys[MAX_MUTATIONS_PER_TRANSACTION - 1 :]
+
+        with timing.span("datastore.delete", workflow_id=workflow_id):
+            self._delete_keys(workflow_id, self._run_in_transaction(delete))
+        self.workflow_cache.pop(workflow_id, None)
 
     def delete_lock(self, workflow_id):
-        self.client.delete(self.client.key(self.lock_kind, workflow_id))
+        self.client.delete(self._get_lock_key(workflow_id))
 
 
 class WorkflowCanvasClient:
-    def __init__(self):
-        self._settings = ActionSettings()
-        self._slack_client = WebClient(
-            self._settings.slack_bot_token.get_secret_value()
-        )
-        self._input_template = PostMessageInput.construct(
-            channel_name="#tom-integration-sandbox",
+    def __init__(
+        self,
+        slack_client: Optional[WebClient] = None,
+        rate_limiter: Optional[SlackRateLimiter] = None,
+    ):
+        # Slack's rate limits are handled for us; the WebClient is created
+        # on first use, so that commands that only render the canvas
+        # (e.g., get-canvas-json) never load slack_sdk.
+        self.slack_client = ThrottledSlackClient(
+            (lambda: slack_client) if slack_client else new_slack_backend,
+            rate_limiter=rate_limiter,
         )
-
-    @property
-    def slack_client(self) -> WebClient:
-        return self._slack_client
+        # Counts of canvas updates sent to slack, vs. skipped because
+        # nothing visible had changed.
+        self.updates_sent = 0
+        self.updates_skipped = 0
 
     def create_workflow_canvas(self, workflow: Workflow):
+        if not workflow.targets:
+            raise ValueError(f"Canvas {workflow.workflow_id} has no channel to post to.")
         workflow.artifacts.append("INCOMPLETE")
-        post_message_input = self._input_template.copy(
-            update=dict(
-                text=workflow.description,
-                blocks=[
-                    b.dict(by_alias=True, exclude_none=True)
-                    for b in workflow.get_message_blocks()
-                ],
-            )
-        )
-        message_input = post_message_input.dict(by_alias=True, exclude_none=True)
-        message_input["channel"] = workflow.channel
-        response = self.slack_client.chat_postMessage(**message_input)
-        message_id = response.data["message"]["ts"]
-        channel_id = response.data["channel"]
-        workflow.message_id = message_id
-        workflow.channel_id = channel_id
-
-    def get_slack_payload(self, workflow: Workflow) -> Dict:
-        update_message_input = self._input_template.copy(
-            update=dict(
-                text=workflow.description,
-                ts=workflow.message_id,
-                channel_id=workflow.channel_id,
-                blocks=[
-                    b.dict(by_alias=True, exclude_none=True)
-                    for b in workflow.get_message_blocks()
-                ],
-            )
-        )
-        update_message_input = update_message_input.dict(
-            by_alias=True, exclude_none=True
+        self.update_workflow_canvas(workflow, force=True)
+
+    def get_slack_payload(
+        self, workflow: Workflow, target: Optional[CanvasTarget] = None
+    ) -> Dict:
+        """
+        :param target: The message to address the payload to; defaults to the
+            workflow's first target.
+        """
+        target = target or (workflow.targets[0] if workflow.targets else CanvasTarget())
+        update_message_input = {
+            "text": workflow.description,
+            "ts": target.message_id,
+            "blocks": workflow.get_message_block_dicts(),
+            "channel": target.channel,
+        }
+        return {k: v for k, v in update_message_input.items() if v is not None}
+
+    @staticmethod
+    def get_payload_hash(payload: Dict) -> str:
+        return hashlib.sha256(
+            json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def update_workflow_canvas(self, workflow: Workflow, force: bool = False) -> bool:
+        """
+        Sends each page of the rendered canvas to each of the workflow's targets,
+        unless it is identical to the last payload that was sent there (as
+        recorded by the page's `payload_hash`). Callers should store the
+        workflow afterwards to persist the new hashes.
+        :return: True if every page that needed it was sent.
+        """
+        updates = self.prepare_update(workflow, force=force)
+        if updates is None:
+            return False
+        return self.send_update(workflow, updates)
+
+    def prepare_update(
+        self, workflow: Workflow, force: bool = False
+    ) -> Optional[List[TargetUpdate]]:
+        """
+        Renders the canvas (once, no matter how many targets it has), records
+        the hash of each page on each target that it will be sent to, and removes
+        the replies that are no longer needed from each target.
+        :return: What to send to each target, or None if it would not change
+            anything.
+        """
+        with timing.span("canvas.render", workflow_id=workflow.workflow_id):
+            pages = []
+            for blocks in workflow.get_page_block_dicts():
+                payload = {"text": workflow.description, "blocks": blocks}
+                payload = {k: v for k, v in payload.items() if v is not None}
+                pages.append((payload, self.get_payload_hash(payload)))
+        updates = []
+        for target in workflow.targets:
+            while len(target.pages) < len(pages) - 1:
+                target.pages.append(CanvasPage())
+            payloads = {}
+            for number, (payload, payload_hash) in enumerate(pages):
+                page = get_page(target, number)
+                if page.payload_hash != payload_hash or force:
+                    page.payload_hash = payload_hash
+                    # Every target shares the same rendered blocks.
+                    payloads[number] = payload
+            deleted_pages = target.pages[len(pages) - 1 :]
+            del target.pages[len(pages) - 1 :]
+            if payloads or deleted_pages:
+                updates.append(TargetUpdate(target, payloads, deleted_pages))
+        if not updates:
+            logging.info(f"Canvas {workflow.workflow_id} is unchanged; not updating.")
+            self.updates_skipped += 1
+            return None
+        return updates
+
+    @staticmethod
+    def split_update(
+        updates: List[TargetUpdate],
+    ) -> Tuple[List[TargetUpdate], List[TargetUpdate]]:
+        """
+        :return: The new messages to post, whose ids have to be stored with the
+            workflow, and the rest of the updates: to messages that already exist,
+            and deletes.
+        """
+        posts, rest = [], []
+        for update in updates:
+            new_payloads, payloads = {}, {}
+            for number, payload in update.payloads.items():
+                if get_page(update.target, number).message_id:
+                    payloads[number] = payload
+                else:
+                    new_payloads[number] = payload
+            if new_payloads:
+                posts.append(TargetUpdate(update.target, new_payloads, []))
+            if payloads or update.deleted_pages:
+                rest.append(TargetUpdate(update.target, payloads, update.deleted_pages))
+        return posts, rest
+
+    def prepare_resend(
+        self, workflow: Workflow, messages: Set[Tuple[str, str]]
+    ) -> List[TargetUpdate]:
+        """
+        :param messages: The (channel, message id) of each page to send again.
+        :return: What to send to each target, to update those pages to the
+            workflow as it is, whatever hashes are recorded for them.
+        """
+        updates = []
+        for update in self.prepare_update(workflow, force=True) or []:
+            payloads = {
+                number: payload
+                for number, payload in update.payloads.items()
+                if get_page_key(update.target, number) in messages
+            }
+            if payloads:
+                updates.append(TargetUpdate(update.target, payloads, []))
+        return updates
+
+    def send_update(self, workflow: Workflow, updates: List[TargetUpdate]) -> bool:
+        """
+        Sends the updates from `prepare_update`, to all of their targets at once.
+        A page that isn't sent has its `payload_hash` cleared, so that the next
+        update re-sends it no matter what; a failure on one target is logged, and
+        doesn't stop the others. Only if nothing at all could be sent is the
+        (first) error raised.
+        :return: True if every page was sent.
+        """
+        if len(updates) == 1:
+            results = [self._send_to_target(workflow, updates[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(updates)) as executor:
+                futures = [
+                    # Each call gets its own copy of the context, so that its
+                    # timing spans are recorded to this command.
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        self._send_to_target,
+                        workflow,
+                        update,
+                    )
+                    for update in updates
+                ]
+            results = [future.result() for future in futures]
+
+        errors = []
+        for update, (sent, skipped, error) in zip(updates, results):
+            self.updates_sent += sent
+            # Updates dropped because a newer update to the same message was
+            # sent instead.
+            self.updates_skipped += skipped
+            if error:
+                logging.error(
+                    f"Failed to update canvas {workflow.workflow_id} in "
+                    f"{update.target.channel}: {error}"
+                )
+                errors.append(error)
+        if errors and not any(sent for sent, _, _ in results):
+            raise errors[0]
+        return not errors and not any(skipped for _, skipped, _ in results)
+
+    def _send_to_target(
+        self, workflow: Workflow, update: TargetUpdate
+    ) -> Tuple[int, int, Optional[Exception]]:
+        """
+        Sends the pages to the target in order (so that the message exists before
+        any reply to it), then deletes any replies that are no longer needed;
+        those that aren't deleted are put back on the target.
+        :return: The number of pages sent, the number dropped in favour of a newer
+            update, and the error that stopped the rest, if any.
+        """
+        target = update.target
+        sent = skipped = 0
+        pending = sorted(update.payloads)
+        deleted_pages = list(update.deleted_pages)
+        try:
+            while pending:
+                number = pending[0]
+                if self._send_page(workflow, target, number, update.payloads[number]):
+                    sent += 1
+                else:
+                    skipped += 1
+                    get_page(target, number).payload_hash = None
+                pending.pop(0)
+            while deleted_pages:
+                self._delete_page(workflow, target, deleted_pages[0])
+                deleted_pages.pop(0)
+        except Exception as e:
+            for number in pending:
+                get_page(target, number).payload_hash = None
+            # So that the next update deletes them.
+            target.pages.extend(deleted_pages)
+            return sent, skipped, e
+        return sent, skipped, None
+
+    def _send_page(
+        self, workflow: Workflow, target: CanvasTarget, number: int, payload: Dict
+    ) -> bool:
+        """
+        Posts a page to the target's channel (the first page as a new message, the
+        rest as replies to it), or updates the message it was posted as.
+        :return: False if the update was dropped in favour of a newer one.
+        """
+        page = get_page(target, number)
+        payload = dict(payload, channel=target.channel)
+        span_attributes = dict(
+            workflow_id=workflow.workflow_id, channel=target.channel, page=number
         )
-        update_message_input["channel"] = workflow.channel
-        return update_message_input
+        if page.message_id:
+            with timing.span("slack.update", **span_attributes):
+                response = self.slack_client.chat_update(ts=page.message_id, **payload)
+            return response is not None
+        if number:
+            payload["thread_ts"] = target.message_id
+        with timing.span("slack.post", **span_attributes):
+            response = self.slack_client.chat_postMessage(**payload)
+        page.message_id = response.data["message"]["ts"]
+        if not number:
+            target.channel_id = response.data["channel"]
+        return True
+
+    def _delete_page(self, workflow: Workflow, target: CanvasTarget, page: CanvasPage):
+        from slack_sdk.errors import SlackApiError
+
+        if not page.message_id:
+            return
+        with timing.span(
+            "slack.delete", workflow_id=workflow.workflow_id, channel=target.channel
+        ):
+            try:
+                self.slack_client.chat_delete(channel=target.channel, ts=page.message_id)
+            except SlackApiError as e:
+                if e.response.get("error") != "message_not_found":
+                    raise
+
 
-    def update_workflow_canvas(self, workflow: Workflow):
-        update_message_input = self.get_slack_payload(workflow)
-        self.slack_client.chat_update(**update_message_input)
+class ClientPool:
+    """
+    Backend connections, and the workflows they have cached, that can be shared by
+    many commands in one long-running process (e.g., the sidecar). Each command
+    still gets its own DatastoreClient, so that lock ids and outputs stay
+    per-command.
+    """
+
+    def __init__(
+        self,
+        datastore_client: Optional[datastore.Client] = None,
+        slack_client: Optional[WebClient] = None,
+    ):
+        self.datastore = datastore_client or new_datastore_backend()
+        self.slack = slack_client or new_slack_backend()
+        self.slack_rate_limiter = SlackRateLimiter()
+        self.workflow_cache: MutableMapping[str, Tuple[str, Workflow]] = {}
+
+    def datastore_client(self) -> DatastoreClient:
+        return DatastoreClient(client=self.datastore, workflow_cache=self.workflow_cache)
+
+    def canvas_client(self) -> WorkflowCanvasClient:
+        return WorkflowCanvasClient(
+            slack_client=self.slack, rate_limiter=self.slack_rate_limiter
+        )
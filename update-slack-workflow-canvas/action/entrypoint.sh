@@ -22,6 +22,7 @@ ACTION_STEP_STATUS="${ACTION_STEP_STATUS}"
 ACTION_STEP_ID="${ACTION_STEP_ID}"
 ACTION_CANVAS="${ACTION_CANVAS}"
 ACTION_JSON="${ACTION_JSON}"
+ACTION_LOCK_FREE="${ACTION_LOCK_FREE}"
 
 CMD="python /action/run.py $ACTION_COMMAND"
 
@@ -30,7 +31,27 @@ set -e
 function add-arg-if-exists() {
   if [[ -n "$2" ]]
   then
-    ACTION_ARGS+=" --$1 '$(get_value_from_arg $2)' "
+    ACTION_ARGS+=" --$1 '$(get_value_from_arg "$2")' "
+  fi
+}
+
+function add-file-arg-if-exists() {
+  # Writes the value ($2) to a file, and supplies that file's path
+  # as the argument ($1), so that the value is passed through as it
+  # is, without being subject to quoting (e.g., JSON lines, which
+  # can include newlines and single quotes).
+  if [[ -n "$2" ]]
+  then
+    value_file="$(mktemp)"
+    get_value_from_arg "$2" > "$value_file"
+    ACTION_ARGS+=" --$1 '$value_file' "
+  fi
+}
+
+function add-flag-if-true() {
+  if [[ "$(get_value_from_arg "$2")" == "true" ]]
+  then
+    ACTION_ARGS+=" --$1 "
   fi
 }
 
@@ -84,7 +105,7 @@ case "$ACTION_COMMAND" in
   create-canvas)
     add-arg-if-exists canvas-id "${ACTION_CANVAS}"
     add-arg-if-exists description "${ACTION_DESCRIPTION}"
-    add-arg-if-exists channel "${ACTION_CHANNEL}"
+    add-multi-arg-if-exists channel "${ACTION_CHANNEL}"
     add-arg-if-exists json "${ACTION_JSON}"
     ;;
   create-step)
@@ -93,21 +114,25 @@ case "$ACTION_COMMAND" in
     add-arg-if-exists step-id "${ACTION_STEP_ID}"
     add-arg-if-exists canvas-id "${ACTION_CANVAS}"
     add-arg-if-exists description "${ACTION_DESCRIPTION}"
+    add-flag-if-true lock-free "${ACTION_LOCK_FREE}"
     ;;
   remove-step)
     add-arg-if-exists canvas-id "${ACTION_CANVAS}"
     add-multi-arg-if-exists step-id "${ACTION_STEP_ID}"
     add-multi-arg-if-exists step-status "${ACTION_STEP_STATUS}"
+    add-flag-if-true lock-free "${ACTION_LOCK_FREE}"
     ;;
   update-workflow)
     add-arg-if-exists workflow-status "${ACTION_WF_STATUS}"
     add-multi-arg-if-exists step-status "${ACTION_STEP_STATUS}"
     add-multi-arg-if-exists step-id "${ACTION_STEP_ID}"
     add-arg-if-exists canvas-id "${ACTION_CANVAS}"
+    add-flag-if-true lock-free "${ACTION_LOCK_FREE}"
     ;;
   add-artifact)
     add-arg-if-exists canvas-id "${ACTION_CANVAS}"
     add-arg-if-exists description "${ACTION_DESCRIPTION}"
+    add-flag-if-true lock-free "${ACTION_LOCK_FREE}"
     ;;
   finalize-workflow)
     add-arg-if-exists canvas-id "${ACTION_CANVAS}"
@@ -116,6 +141,11 @@ case "$ACTION_COMMAND" in
   get-canvas-json)
     add-arg-if-exists canvas-id "${ACTION_CANVAS}"
     ;;
+  batch)
+    add-arg-if-exists canvas-id "${ACTION_CANVAS}"
+    add-file-arg-if-exists file "${ACTION_JSON}"
+    add-flag-if-true lock-free "${ACTION_LOCK_FREE}"
+    ;;
 esac
 
 echo "$CMD $ACTION_ARGS"
@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+from enum import Enum
+from typing import Dict, List, Type, Union
+
+
+class ImprovedEnum(Enum):
+    @classmethod
+    def from_value(cls, val: Union[str, ImprovedEnum]) -> ImprovedEnum:
+        if isinstance(val, str):
+            try:
+                return cls(val)
+            except ValueError:
+                return cls.members_by_value()[val]
+        return val
+
+    @classmethod
+    def members_by_value(cls) -> Dict[str, str]:
+        return {member.value: name for name, member in cls.__members__.items()}
+
+    @classmethod
+    def values(cls: Type[ImprovedEnum]) -> List[str]:
+        return [m.value for m in cls.__members__.values()]
+
+
+class WorkflowStepStatus(ImprovedEnum):
+    not_started = "not started"
+    in_progress = "in progress"
+    skipped = "skipped"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+class WorkflowStatus(ImprovedEnum):
+    initializing = "initializing"
+    in_progress = "in progress"
+    succeeded = "succeeded"
+    failed = "failed"
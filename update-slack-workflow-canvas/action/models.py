@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import logging
 from datetime import datetime
-from enum import Enum
-from typing import Dict, List, Optional, Type, Union
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Union
 from uuid import uuid4
 
 from pydantic import (
@@ -10,30 +11,16 @@ from pydantic import (
     BaseSettings,
     Extra,
     Field,
+    PrivateAttr,
     SecretStr,
     root_validator,
     validator,
 )
 from pytz import timezone
 
-
-class ImprovedEnum(Enum):
-    @classmethod
-    def from_value(cls, val: Union[str, ImprovedEnum]) -> ImprovedEnum:
-        if isinstance(val, str):
-            try:
-                return cls(val)
-            except ValueError:
-                return cls.members_by_value()[val]
-        return val
-
-    @classmethod
-    def members_by_value(cls) -> Dict[str, str]:
-        return {member.value: name for name, member in cls.__members__.items()}
-
-    @classmethod
-    def values(cls: Type[ImprovedEnum]) -> List[str]:
-        return [m.value for m in cls.__members__.values()]
+# The enums live in their own module so that the CLI can use them without
+# importing pydantic; they are re-exported here for convenience.
+from enums import ImprovedEnum, WorkflowStatus, WorkflowStepStatus  # noqa: F401
 
 
 def to_mixed_case(string: str):
@@ -53,21 +40,6 @@ class ActionBaseModel(BaseModel):
         use_enum_values = True
 
 
-class WorkflowStepStatus(ImprovedEnum):
-    not_started = "not started"
-    in_progress = "in progress"
-    skipped = "skipped"
-    succeeded = "succeeded"
-    failed = "failed"
-
-
-class WorkflowStatus(ImprovedEnum):
-    initializing = "initializing"
-    in_progress = "in progress"
-    succeeded = "succeeded"
-    failed = "failed"
-
-
 STEP_STATUS_ICONS = {
     WorkflowStepStatus.succeeded: ":white_check_mark:",
     WorkflowStepStatus.failed: ":octagonal_sign:",
@@ -115,6 +87,13 @@ class WorkflowStep(ActionBaseModel):
             )
         ]
 
+    def get_message_block_dicts(self) -> List[Dict[str, Any]]:
+        """
+        The same blocks as `get_message_blocks`, rendered directly to (cached)
+        dicts; see `render_step_block`.
+        """
+        return [render_step_block(self.description, self.status_str)]
+
     @property
     def canvas_payload(self):
         result = self.dict()
@@ -180,6 +159,54 @@ class SectionBlock(Block):
     fields: List[Block] = []
 
 
+# Rendering a workflow through the pydantic block models above, then calling
+# `.dict()` on all of them, costs more than the slack API call itself once a
+# workflow has hundreds of steps. These functions render the same blocks straight
+# to dicts, and cache them, so that only steps that have changed since the last
+# render are rendered again. The dicts they return are shared, and must never be
+# modified.
+
+DIVIDER_BLOCK = {"type": SlackBlockType.divider.value}
+
+
+@lru_cache(maxsize=4096)
+def render_step_block(description: str, status: str) -> Dict[str, Any]:
+    icon = STEP_STATUS_ICONS.get(WorkflowStepStatus(status))
+    return {
+        "type": SlackBlockType.section.value,
+        "fields": [
+            {"type": SlackBlockType.mrkdwn.value, "text": description},
+            {"type": SlackBlockType.mrkdwn.value, "text": f"{icon} {status.title()}"},
+        ],
+    }
+
+
+@lru_cache(maxsize=256)
+def render_artifact_block(artifact: str) -> Dict[str, Any]:
+    return {
+        "type": SlackBlockType.context.value,
+        "elements": [{"type": SlackBlockType.mrkdwn.value, "text": artifact}],
+    }
+
+
+def render_note_block(text: str) -> Dict[str, Any]:
+    return {
+        "type": SlackBlockType.context.value,
+        "elements": [{"type": SlackBlockType.text.value, "text": text}],
+    }
+
+
+def render_header_block(description: Optional[str], status: str) -> Dict[str, Any]:
+    icon = WORKFLOW_STATUS_ICONS.get(WorkflowStatus(status))
+    return {
+        "type": SlackBlockType.header.value,
+        "text": {
+            "type": SlackBlockType.text.value,
+            "text": f"{icon} [{status.title()}] {description}",
+        },
+    }
+
+
 class PostMessageInput(APIModel):
     timestamp: str = Field(
         default_factory=lambda: datetime.now(tz=timezone("US/Pacific")).isoformat(),
@@ -197,15 +224,64 @@ class ActionSettings(BaseSettings):
     context_storage: str = Field("/tmp/action_context", env="CONTEXT_STORAGE_PATH")
 
 
+class UnknownStepError(ValueError):
+    pass
+
+
 class CreateMessageInput(ActionBaseModel):
     workflow_description: Optional[str]
 
 
+# Slack allows at most 50 blocks per message. The first page (the message itself)
+# also has a header, a note that the steps continue in the thread, up to 9
+# artifacts and a divider; every other page (a reply in the message's thread)
+# has a note saying which steps it holds.
+MAX_MESSAGE_BLOCKS = 50
+FIRST_PAGE_STEPS = MAX_MESSAGE_BLOCKS - 12
+PAGE_STEPS = MAX_MESSAGE_BLOCKS - 2
+
+
+class CanvasPage(ActionBaseModel):
+    """
+    A reply in the thread of a target's message, showing steps that don't fit in
+    the message itself.
+    """
+
+    message_id: Optional[str]
+    payload_hash: Optional[str]  # Hash of the last payload sent to this reply
+
+
+class CanvasTarget(ActionBaseModel):
+    """
+    One slack message that shows the canvas.
+    """
+
+    channel_name: Optional[str] = Field(None, alias="channel")
+    channel_id: Optional[str]  # Set once the message has been posted
+    message_id: Optional[str]  # Used to update the message
+    payload_hash: Optional[str]  # Hash of the last payload sent to this message
+    # The second page onwards; see `Workflow.get_page_block_dicts`.
+    pages: List[CanvasPage] = []
+
+    @property
+    def channel(self) -> str:
+        return self.channel_id or self.channel_name
+
+
+# The fields that held the one channel a workflow used to have; see
+# `Workflow.migrate_channel_to_targets`.
+_LEGACY_TARGET_FIELDS = {
+    "channel_name": ("channel_name", "channelName", "channel", "channels"),
+    "channel_id": ("channel_id", "channelId"),
+    "message_id": ("message_id", "messageId"),
+    "payload_hash": ("payload_hash", "payloadHash"),
+}
+
+
 class Workflow(ActionBaseModel):
     workflow_id: str = Field(default_factory=lambda: str(uuid4()))
-    message_id: Optional[str]  # Used to update the workflow canvas
-    channel_id: Optional[str]  # Used to update the workflow canvas
-    channel_name: Optional[str] = Field(None, alias="channel")
+    # The messages to keep up to date with the canvas, one per channel.
+    targets: List[CanvasTarget] = []
     execution_href: Optional[str]  # Link to actions run
     description: Optional[str]  # e.g., "Prod release workflow"
     event_name: Optional[str]  # e.g., 'push', 'pull_request'
@@ -214,6 +290,10 @@ class Workflow(ActionBaseModel):
     steps: List[WorkflowStep] = []
     artifacts: List[str] = []
 
+    # step_id -> position in `steps`, and the length of `steps` when it was built.
+    _step_index: Optional[Dict[str, int]] = PrivateAttr(None)
+    _step_index_size: int = PrivateAttr(0)
+
     @root_validator(pre=True)
     def allow_canvas_id(cls, vals: Dict) -> Dict:
         """
@@ -229,9 +309,30 @@ class Workflow(ActionBaseModel):
             vals["workflowId"] = canvas_id
         return vals
 
-    @property  # TODO Why are there two fields for channel?!
-    def channel(self) -> str:
-        return self.channel_id or self.channel_name
+    @root_validator(pre=True)
+    def migrate_channel_to_targets(cls, vals: Dict) -> Dict:
+        """
+        Workflows used to have a single channel, stored in the fields that are now
+        part of each target; those are converted to a target. A `channel` (or
+        `channels`) input may also list many channels, to create one target each.
+        """
+        vals = dict(vals)
+        legacy = {}
+        for field_name, keys in _LEGACY_TARGET_FIELDS.items():
+            for key in keys:
+                if vals.get(key) is not None:
+                    legacy[field_name] = vals[key]
+                vals.pop(key, None)
+        if vals.get("targets") or not legacy:
+            return vals
+        channels = legacy.pop("channel_name", None)
+        if not isinstance(channels, (list, tuple)):
+            channels = [channels]
+        vals["targets"] = [
+            dict(legacy, channel_name=channel) if i == 0 else {"channel_name": channel}
+            for i, channel in enumerate(channels)
+        ]
+        return vals
 
     @property
     def status_enum(self) -> WorkflowStatus:
@@ -275,6 +376,89 @@ class Workflow(ActionBaseModel):
         )
         return _dict
 
+    def _get_step_index(self) -> Dict[str, int]:
+        """
+        The index is kept up to date by the step methods below; if `steps` is
+        modified some other way, it is rebuilt the next time it's needed.
+        """
+        if self._step_index is None or self._step_index_size != len(self.steps):
+            index = {}
+            for position, step in enumerate(self.steps):
+                index.setdefault(step.step_id, position)
+            self._step_index = index
+            self._step_index_size = len(self.steps)
+        return self._step_index
+
+    def find_step(self, step_id: str) -> Optional[int]:
+        """
+        :return: The position of the (first) step with the given id, or None.
+        """
+        position = self._get_step_index().get(step_id)
+        if position is None or self.steps[position].step_id != step_id:
+            self._step_index = None
+            position = self._get_step_index().get(step_id)
+        return position
+
+    def get_step(self, step_id: str) -> WorkflowStep:
+        position = self.find_step(step_id)
+        if position is None:
+            raise UnknownStepError(f"No step named {step_id}")
+        return self.steps[position]
+
+    def add_step(self, step: WorkflowStep):
+        index = self._get_step_index()
+        self.steps.append(step)
+        index.setdefault(step.step_id, len(self.steps) - 1)
+        self._step_index_size = len(self.steps)
+
+    def update_step_statuses(
+        self, step_statuses: Dict[str, Union[str, WorkflowStepStatus]]
+    ):
+        """
+        Sets the status of each given step id. If any of the ids are unknown, no
+        steps are updated.
+        """
+        positions = {step_id: self.find_step(step_id) for step_id in step_statuses}
+        unknown = [step_id for step_id, pos in positions.items() if pos is None]
+        if unknown:
+            raise UnknownStepError(f"No step(s) named: {', '.join(unknown)}")
+        for step_id, status in step_statuses.items():
+            self.steps[positions[step_id]].status = WorkflowStepStatus(status).value
+
+    def remove_steps(
+        self,
+        step_ids: Iterable[str],
+        status_filter: Optional[Iterable[Union[str, WorkflowStepStatus]]] = None,
+    ) -> List[str]:
+        """
+        Removes the selected steps in a single pass.
+        :param step_ids: The ids to remove, or ["*"] to select all steps.
+        :param status_filter: If provided, only selected steps having one of these
+            statuses are removed.
+        :return: The ids of the steps that were removed.
+        """
+        selected = set(step_ids)
+        remove_all = "*" in selected
+        statuses = {WorkflowStepStatus(s).value for s in status_filter or []}
+        kept, removed = [], []
+        for step in self.steps:
+            if (remove_all or step.step_id in selected) and (
+                not statuses or step.status_str in statuses
+            ):
+                removed.append(step.step_id)
+            else:
+                kept.append(step)
+        logging.debug(f"Removing steps {removed} (status filter: {statuses})")
+
+        if not remove_all:
+            unknown = selected.difference(step.step_id for step in self.steps)
+            if unknown:
+                logging.warning(f"No step(s) named: {', '.join(sorted(unknown))}")
+
+        self.steps = kept
+        self._step_index = None
+        return removed
+
     def get_message_blocks(self) -> List[Block]:
         blocks = [self.header_block]
 
@@ -287,6 +471,43 @@ class Workflow(ActionBaseModel):
 
         return blocks
 
+    def get_message_block_dicts(self) -> List[Dict[str, Any]]:
+        """
+        Renders the same blocks as `get_message_blocks`, as plain dicts that are
+        ready to send to slack.
+        """
+        blocks = [render_header_block(self.description, self.status_str)]
+        for step in self.steps:
+            blocks.extend(step.get_message_block_dicts())
+        blocks.extend(render_artifact_block(artifact) for artifact in self.artifacts)
+        blocks.append(DIVIDER_BLOCK)
+        return blocks
+
+    def get_page_block_dicts(self) -> List[List[Dict[str, Any]]]:
+        """
+        Splits the blocks from `get_message_block_dicts` into pages that each fit
+        in a slack message. The first page is the message itself, and holds the
+        first steps; the rest of the steps go in replies in its thread, so that
+        adding a step only ever changes the last page.
+        """
+        first_steps = self.steps[:FIRST_PAGE_STEPS]
+        first_page = [render_header_block(self.description, self.status_str)]
+        for step in first_steps:
+            first_page.extend(step.get_message_block_dicts())
+        if len(self.steps) > FIRST_PAGE_STEPS:
+            first_page.append(render_note_block("Continued in the thread"))
+        first_page.extend(render_artifact_block(artifact) for artifact in self.artifacts)
+        first_page.append(DIVIDER_BLOCK)
+
+        pages = [first_page]
+        for start in range(FIRST_PAGE_STEPS, len(self.steps), PAGE_STEPS):
+            page_steps = self.steps[start : start + PAGE_STEPS]
+            page = [render_note_block(f"Steps {start + 1}-{start + len(page_steps)}")]
+            for step in page_steps:
+                page.extend(step.get_message_block_dicts())
+            pages.append(page)
+        return pages
+
 
 class WorkflowJSONInput(Workflow):
     """
@@ -295,4 +516,4 @@ class WorkflowJSONInput(Workflow):
     """
 
     description: str
-    channel_name: str
+    targets: List[CanvasTarget] = Field(..., min_items=1)
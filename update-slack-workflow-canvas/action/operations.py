@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List, Optional, Type, Union
+from uuid import uuid4
+
+from pydantic import Field, validator
+
+from models import (
+    ActionBaseModel,
+    Workflow,
+    WorkflowStatus,
+    WorkflowStep,
+    WorkflowStepStatus,
+)
+
+MAX_CONTEXT_ELEMENTS = 9
+
+
+def sanitize_text(text: Optional[str]) -> Optional[str]:
+    """
+    Makes sure we don't have wacky whitespace in our output, depending on how
+    the text is set.
+    :param text: The text to sanitize.
+    :return: The sanitized text.
+
+    Example:
+        # shell
+        DESCRIPTION="
+        blahblah
+        foobar
+            baz
+                    bop
+        "
+        # When the description is read in, it will become:
+        "blahblah foobar baz bop"
+    """
+    if not text:
+        return text
+    text = text.replace("\n", " ")
+    return text.strip()
+
+
+# The functions below mutate a workflow that has already been loaded (and
+# locked); the caller is responsible for updating slack and storing the result.
+
+
+def create_step(
+    workflow: Workflow,
+    description: str,
+    step_status: Union[str, WorkflowStepStatus] = WorkflowStepStatus.not_started,
+    workflow_status: Optional[Union[str, WorkflowStatus]] = None,
+    step_id: Optional[str] = None,
+) -> WorkflowStep:
+    step = WorkflowStep(
+        description=sanitize_text(description),
+        status=step_status,
+    )
+    if step_id:
+        step.step_id = step_id
+
+    if workflow_status:
+        workflow.status = WorkflowStatus.from_value(workflow_status)
+    workflow.add_step(step)
+    return step
+
+
+def remove_steps(
+    workflow: Workflow, step_ids: List[str], status_filter: List[str]
+) -> List[str]:
+    """
+    :return: The ids of the steps that were removed.
+    """
+    return workflow.remove_steps(step_ids, status_filter)
+
+
+def update_workflow(
+    workflow: Workflow,
+    step_statuses: Dict[str, Union[str, WorkflowStepStatus]],
+    workflow_status: Optional[Union[str, WorkflowStatus]] = None,
+):
+    """
+    :param step_statuses: The new status for each step id to update.
+    :raises UnknownStepError: If any of the step ids don't exist; in that case
+        the workflow is not modified.
+    """
+    workflow.update_step_statuses(step_statuses)
+    if workflow_status:
+        workflow.status = WorkflowStatus.from_value(workflow_status)
+
+
+def add_artifact(workflow: Workflow, description: str):
+    if len(workflow.artifacts) >= MAX_CONTEXT_ELEMENTS:
+        raise IndexError(
+            f"A maximum of {MAX_CONTEXT_ELEMENTS} artifacts per canvas can be attached."
+        )
+    workflow.artifacts.append(f"> {sanitize_text(description)}")
+
+
+class Operation(ActionBaseModel):
+    """
+    A single canvas operation, as read from one line of `batch` input; the
+    `command` field selects the operation, and uses the same names as the CLI.
+    """
+
+    command: str
+
+    def apply(self, workflow: Workflow) -> Dict[str, Any]:
+        """
+        Applies this operation to the workflow.
+        :return: Any values this operation would normally output.
+        """
+        raise NotImplementedError
+
+    def prepare_event(self) -> Dict[str, Any]:
+        """
+        Called before the operation is recorded as an event, to be applied
+        later (in lock-free mode).
+        :return: Any of the operation's outputs that are already known.
+        """
+        return {}
+
+
+class CreateStepOperation(Operation):
+    command: str = Field("create-step", const=True)
+    description: str
+    step_status: WorkflowStepStatus = WorkflowStepStatus.not_started
+    workflow_status: Optional[WorkflowStatus]
+    step_id: Optional[str]
+
+    def apply(self, workflow: Workflow) -> Dict[str, Any]:
+        step = create_step(
+            workflow,
+            description=self.description,
+            step_status=self.step_status,
+            workflow_status=self.workflow_status,
+            step_id=self.step_id,
+        )
+        return {"stepId": step.step_id}
+
+    def prepare_event(self) -> Dict[str, Any]:
+        # The step id is an output, so it can't wait to be generated.
+        self.step_id = self.step_id or str(uuid4())
+        return {"stepId": self.step_id}
+
+
+class RemoveStepOperation(Operation):
+    command: str = Field("remove-step", const=True)
+    step_ids: List[str]
+    status_filter: List[WorkflowStepStatus] = []
+
+    @validator("step_ids", pre=True)
+    def allow_single_step_id(cls, val: Union[str, List[str]]) -> List[str]:
+        if isinstance(val, str):
+            return [val]
+        return val
+
+    def apply(self, workflow: Workflow) -> Dict[str, Any]:
+        return {
+            "removedStepIds": remove_steps(
+                workflow, self.step_ids, self.status_filter
+            )
+        }
+
+
+class UpdateWorkflowOperation(Operation):
+    command: str = Field("update-workflow", const=True)
+    workflow_status: Optional[WorkflowStatus]
+    # step id -> new status
+    steps: Dict[str, WorkflowStepStatus] = {}
+
+    def apply(self, workflow: Workflow) -> Dict[str, Any]:
+        update_workflow(
+            workflow,
+            step_statuses=self.steps,
+            workflow_status=self.workflow_status,
+        )
+        return {}
+
+
+class AddArtifactOperation(Operation):
+    command: str = Field("add-artifact", const=True)
+    description: str
+
+    def apply(self, workflow: Workflow) -> Dict[str, Any]:
+        add_artifact(workflow, self.description)
+        return {}
+
+
+BATCH_OPERATIONS: Dict[str, Type[Operation]] = {
+    op.__fields__["command"].default: op
+    for op in (
+        CreateStepOperation,
+        RemoveStepOperation,
+        UpdateWorkflowOperation,
+        AddArtifactOperation,
+    )
+}
+
+
+def parse_operation(data: Dict[str, Any]) -> Operation:
+    command = data.get("command")
+    if command not in BATCH_OPERATIONS:
+        raise ValueError(
+            f"Unsupported batch command {command!r}; "
+            f"must be one of: {', '.join(BATCH_OPERATIONS)}"
+        )
+    return BATCH_OPERATIONS[command].parse_obj(data)
@@ -1,43 +1,120 @@
+from __future__ import annotations
+
 import json
 import logging
 import os
-from typing import List, Optional
+import sys
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 from uuid import uuid4
 
 import click
 
-from client import DatastoreClient, WorkflowCanvasClient
-from models import Workflow, WorkflowStatus, WorkflowStep, WorkflowStepStatus
+import sidecar
+import timing
+from enums import WorkflowStatus, WorkflowStepStatus
+
+# The client (google-cloud-datastore, slack_sdk) and the pydantic models are
+# slow to import, so each command imports only what it uses when it runs; this
+# keeps `--help` and forwarding to the sidecar fast.
+if TYPE_CHECKING:
+    from client import ClientPool, DatastoreClient, WorkflowCanvasClient
+    from operations import Operation
+
+# Set when running as a sidecar, so that commands share backend connections.
+client_pool: Optional[ClientPool] = None
+
+
+def new_datastore_client() -> DatastoreClient:
+    from client import DatastoreClient
+    from models import ActionSettings
+    from workflow_cache import DiskWorkflowCache
 
-MAX_CONTEXT_ELEMENTS = 9
+    if client_pool:
+        return client_pool.datastore_client()
+    # Each command runs in a new process, so the workflows it has seen are
+    # kept on the runner's disk for the job's next command.
+    return DatastoreClient(
+        workflow_cache=DiskWorkflowCache(ActionSettings().context_storage)
+    )
+
+
+def new_canvas_client() -> WorkflowCanvasClient:
+    from client import WorkflowCanvasClient
+
+    if client_pool:
+        return client_pool.canvas_client()
+    return WorkflowCanvasClient()
 
 
 def print_action_output(output_name: str, output_value: str):
     print(f"::set-output name={output_name}::{output_value}")
 
 
-def sanitize_text(text: Optional[str]) -> Optional[str]:
+def print_lock_outputs(datastore_client: DatastoreClient):
+    print_action_output("lock-id", datastore_client.lock_id)
+    print_action_output(
+        "lock-wait-ms", round(datastore_client.lock_wait_seconds * 1000)
+    )
+
+
+def print_timing_outputs():
+    timings = timing.current()
+    if timings:
+        print_action_output("timings", json.dumps(timings.summary()))
+
+
+def print_canvas_outputs(canvas_client: WorkflowCanvasClient):
+    print_action_output("slack-updates-sent", canvas_client.updates_sent)
+    print_action_output("slack-updates-skipped", canvas_client.updates_skipped)
+    print_action_output(
+        "slack-calls-throttled", canvas_client.slack_client.calls_throttled
+    )
+    print_action_output("slack-calls-retried", canvas_client.slack_client.calls_retried)
+
+
+lock_free_option = click.option(
+    "--lock-free",
+    is_flag=True,
+    default=False,
+    help="Record the change as an event, instead of waiting for the canvas lock; "
+    "it is applied by whichever command next holds the lock. The change is "
+    "checked against the canvas as it is now (e.g., for an unknown step id); if "
+    "it only fails once the event is applied, it is logged and dropped.",
+)
+
+
+def append_operations(
+    canvas_id: str, batch_operations: List[Operation]
+) -> List[Dict[str, Any]]:
     """
-    Makes sure we don't have wacky whitespace in our output, depending on how
-    the text is set.
-    :param text: The text to sanitize.
-    :return: The sanitized text.
-
-    Example:
-        # shell
-        DESCRIPTION="
-        blahblah
-        foobar
-            baz
-                    bop
-        "
-        # When the description is read in, it will become:
-        "blahblah foobar baz bop"
+    Applies operations in lock-free mode: they are recorded as events, which are
+    applied now if no other command holds the lock, or else by the command that
+    does.
+    :return: The outputs of each operation that are already known.
     """
-    if not text:
-        return text
-    text = text.replace("\n", " ")
-    return text.strip()
+    datastore_client = new_datastore_client()
+    canvas_client = new_canvas_client()
+    results = [
+        dict(command=operation.command, **operation.prepare_event())
+        for operation in batch_operations
+    ]
+    # Whoever applies the events drops any that fail, so the operations are
+    # tried out first on the canvas as it is now (with any events that are still
+    # pending), so that mistakes like an unknown step id fail this command.
+    workflow = datastore_client.load_workflow(canvas_id)
+    for number, operation in enumerate(batch_operations, start=1):
+        try:
+            operation.apply(workflow)
+        except (ValueError, IndexError) as e:
+            raise click.ClickException(
+                f"Operation {number} ({operation.command}) failed: {e}"
+            )
+    datastore_client.append_events(canvas_id, batch_operations)
+    datastore_client.materialize_events(canvas_id, canvas_client)
+    print_lock_outputs(datastore_client)
+    print_canvas_outputs(canvas_client)
+    print_timing_outputs()
+    return results
 
 
 @click.command(help="Creates a new workflow canvas")
@@ -55,28 +132,40 @@ def sanitize_text(text: Optional[str]) -> Optional[str]:
     help="A JSON object containing (at least) the description field, "
     "but that may include also the workflowId, steps, and status fields.",
 )
-@click.option("--channel", required=False, default=None, help="The channel to send messages to.")
+@click.option(
+    "--channel",
+    "channels",
+    required=False,
+    multiple=True,
+    help="The channel to send messages to. You may supply this multiple times to "
+    "show the same canvas in many channels.",
+)
 def create_canvas(
-    description: str, channel: str, canvas_id: str, workflow_json: Optional[str]
+    description: str, channels: List[str], canvas_id: str, workflow_json: Optional[str]
 ):
+    from models import Workflow
+    from operations import sanitize_text
+
     if workflow_json:
         workflow = Workflow.parse_raw(workflow_json)
         logging.info(workflow.dict())
     else:
         args = {
             'description': sanitize_text(description),
-            'channel_name': channel,
+            'channels': list(channels),
         }
         # canvas_id has a default generator, so should only
         # be included if it is not blank.
         if canvas_id:
             args['workflow_id'] = 'canvas_id'
         workflow = Workflow(**args)
-    canvas_client = WorkflowCanvasClient()
-    datastore_client = DatastoreClient()
+    canvas_client = new_canvas_client()
+    datastore_client = new_datastore_client()
     canvas_client.create_workflow_canvas(workflow)
     datastore_client.store_workflow(workflow)
     print_action_output("canvas-id", workflow.workflow_id)
+    print_canvas_outputs(canvas_client)
+    print_timing_outputs()
 
 
 @click.command(help="Adds a step to an existing workflow.")
@@ -100,30 +189,49 @@ def create_canvas(
     "--step-id",
     help="An optional identifier for the step, otherwise this will be autogenerated.",
 )
+@lock_free_option
 def create_step(
     description: str,
     step_status: WorkflowStepStatus,
     canvas_id: str,
     workflow_status: Optional[WorkflowStatus] = None,
     step_id: Optional[str] = None,
+    lock_free: bool = False,
 ):
-    datastore_client = DatastoreClient()
-
-    with datastore_client.lock_workflow(canvas_id, save_on_exit=True) as workflow:
-        step = WorkflowStep(
-            description=sanitize_text(description),
-            status=step_status,
+    import operations
+
+    if lock_free:
+        [result] = append_operations(
+            canvas_id,
+            [
+                operations.CreateStepOperation(
+                    description=description,
+                    step_status=step_status,
+                    workflow_status=workflow_status,
+                    step_id=step_id,
+                )
+            ],
         )
-        if step_id:
-            step.step_id = step_id
-
-        if workflow_status:
-            workflow.status = WorkflowStatus.from_value(workflow_status)
-        workflow.steps.append(step)
+        print_action_output("step-id", result["stepId"])
+        return
+
+    datastore_client = new_datastore_client()
+    canvas_client = new_canvas_client()
+
+    with datastore_client.lock_and_update(canvas_id, canvas_client) as workflow:
+        step = operations.create_step(
+            workflow,
+            description=description,
+            step_status=step_status,
+            workflow_status=workflow_status,
+            step_id=step_id,
+        )
+    datastore_client.materialize_events(canvas_id, canvas_client)
 
-    WorkflowCanvasClient().update_workflow_canvas(workflow)
     print_action_output("step-id", step.step_id)
-    print_action_output("lock-id", datastore_client.lock_id)
+    print_lock_outputs(datastore_client)
+    print_canvas_outputs(canvas_client)
+    print_timing_outputs()
 
 
 @click.command(
@@ -150,33 +258,36 @@ def create_step(
     help="Optional, can be supplied multiple times. "
     "Only removes a step if it matches the status provided.",
 )
-def remove_step(canvas_id: str, step_ids: str, status_filter: List[WorkflowStepStatus]):
-    datastore_client = DatastoreClient()
-
-    with datastore_client.lock_workflow(canvas_id, save_on_exit=True) as workflow:
-        if step_ids[0] == "*":
-            logging.debug(f"Removing all steps matching filter: {status_filter}")
-            step_ids = [step.step_id for step in workflow.steps]
-
-        num_removed = 0
-        for index, step in enumerate(list(workflow.steps)):
-            if step.step_id not in step_ids:
-                logging.debug(f"Step {step.step_id} not selected; not removing.")
-                continue
-
-            if status_filter and step.status_str not in status_filter:
-                logging.debug(
-                    f"Step {step.step_id} has status {step.status} "
-                    f"which does not match filter: {status_filter}; "
-                    "not removing."
+@lock_free_option
+def remove_step(
+    canvas_id: str,
+    step_ids: str,
+    status_filter: List[WorkflowStepStatus],
+    lock_free: bool = False,
+):
+    import operations
+
+    if lock_free:
+        append_operations(
+            canvas_id,
+            [
+                operations.RemoveStepOperation(
+                    step_ids=list(step_ids), status_filter=list(status_filter)
                 )
-                continue
-            logging.debug(f"Removing step {step.step_id} from canvas")
-            workflow.steps.pop(index - num_removed)
-            num_removed += 1
+            ],
+        )
+        return
 
-    WorkflowCanvasClient().update_workflow_canvas(workflow)
-    print_action_output("lock-id", datastore_client.lock_id)
+    datastore_client = new_datastore_client()
+    canvas_client = new_canvas_client()
+
+    with datastore_client.lock_and_update(canvas_id, canvas_client) as workflow:
+        operations.remove_steps(workflow, step_ids, status_filter)
+    datastore_client.materialize_events(canvas_id, canvas_client)
+
+    print_lock_outputs(datastore_client)
+    print_canvas_outputs(canvas_client)
+    print_timing_outputs()
 
 
 @click.command(
@@ -205,50 +316,74 @@ def remove_step(canvas_id: str, step_ids: str, status_filter: List[WorkflowStepS
     multiple=True,
     help="Required for each step-status is provided. " "The id of the step to update. ",
 )
+@lock_free_option
 def update_workflow(
     statuses: List[WorkflowStepStatus],
     workflow_status: Optional[WorkflowStatus],
     canvas_id: str,
     step_ids: List[str],
+    lock_free: bool = False,
 ):
-    datastore_client = DatastoreClient()
+    import operations
+    from models import UnknownStepError
+
     if len(step_ids) != len(statuses):
         raise ValueError(
             f"Mismatch in number of steps "
             f"({len(step_ids)}) and statuses ({len(statuses)})."
         )
+    if lock_free:
+        append_operations(
+            canvas_id,
+            [
+                operations.UpdateWorkflowOperation(
+                    workflow_status=workflow_status,
+                    steps=dict(zip(step_ids, statuses)),
+                )
+            ],
+        )
+        return
 
-    with datastore_client.lock_workflow(canvas_id, save_on_exit=True) as workflow:
-        if workflow_status:
-            workflow.status = workflow_status
+    datastore_client = new_datastore_client()
+    canvas_client = new_canvas_client()
 
-        wf_step_ids = [s.step_id for s in workflow.steps]
-        for step_id_index, step_id in enumerate(step_ids):
-            try:
-                step_index = wf_step_ids.index(step_id)
-            except IndexError:
-                raise ValueError(f"No step named {step_id}")
+    with datastore_client.lock_and_update(canvas_id, canvas_client) as workflow:
+        try:
+            operations.update_workflow(
+                workflow,
+                step_statuses=dict(zip(step_ids, statuses)),
+                workflow_status=workflow_status,
+            )
+        except UnknownStepError as e:
+            raise click.BadParameter(str(e), param_hint="--step-id")
+    datastore_client.materialize_events(canvas_id, canvas_client)
 
-            step_status = statuses[step_id_index]
-            workflow.steps[step_index].status = step_status
-
-    WorkflowCanvasClient().update_workflow_canvas(workflow)
-    print_action_output("lock-id", datastore_client.lock_id)
+    print_lock_outputs(datastore_client)
+    print_canvas_outputs(canvas_client)
+    print_timing_outputs()
 
 
 @click.command(help="Add a context artifact to the workflow canvas")
 @click.option("--description", help="The mrkdwn for your context artifact.")
 @click.option("--canvas-id", help="Your b64-encoded canvas.")
-def add_artifact(description: str, canvas_id: str):
-    datastore_client = DatastoreClient()
-    with datastore_client.lock_workflow(canvas_id, save_on_exit=True) as workflow:
-        if len(workflow.artifacts) >= MAX_CONTEXT_ELEMENTS:
-            raise IndexError(
-                f"A maximum of {MAX_CONTEXT_ELEMENTS} artifacts per canvas can be attached."
-            )
-        workflow.artifacts.append(f"> {sanitize_text(description)}")
-    WorkflowCanvasClient().update_workflow_canvas(workflow)
-    print_action_output("lock-id", datastore_client.lock_id)
+@lock_free_option
+def add_artifact(description: str, canvas_id: str, lock_free: bool = False):
+    import operations
+
+    if lock_free:
+        append_operations(
+            canvas_id, [operations.AddArtifactOperation(description=description)]
+        )
+        return
+
+    datastore_client = new_datastore_client()
+    canvas_client = new_canvas_client()
+    with datastore_client.lock_and_update(canvas_id, canvas_client) as workflow:
+        operations.add_artifact(workflow, description)
+    datastore_client.materialize_events(canvas_id, canvas_client)
+    print_lock_outputs(datastore_client)
+    print_canvas_outputs(canvas_client)
+    print_timing_outputs()
 
 
 @click.command(
@@ -262,7 +397,8 @@ def add_artifact(description: str, canvas_id: str):
 def finalize_workflow(canvas_id: str, workflow_status: str):
     if workflow_status:
         workflow_status = WorkflowStatus.from_value(workflow_status)
-    datastore_client = DatastoreClient()
+    datastore_client = new_datastore_client()
+    canvas_client = new_canvas_client()
     try:
         with datastore_client.lock_workflow(canvas_id) as workflow:
             workflow = datastore_client.load_workflow(canvas_id)
@@ -270,24 +406,135 @@ def finalize_workflow(canvas_id: str, workflow_status: str):
             if workflow_status:
                 workflow.status = workflow_status
             datastore_client.delete_workflow(workflow.workflow_id)
-        WorkflowCanvasClient().update_workflow_canvas(workflow)
+        canvas_client.update_workflow_canvas(workflow)
     finally:
-        datastore_client.delete_lock(workflow.workflow_id)
+        datastore_client.delete_lock(canvas_id)
+    print_lock_outputs(datastore_client)
+    print_canvas_outputs(canvas_client)
+    print_timing_outputs()
 
 
 @click.command(help="Simply dump workflow json and exit.")
 @click.option("--canvas-id", help="Required.", required=True)
 def get_canvas_json(canvas_id: str):
-    datastore_client = DatastoreClient()
+    datastore_client = new_datastore_client()
     workflow = datastore_client.load_workflow(canvas_id)
-    payload = json.dumps(WorkflowCanvasClient().get_slack_payload(workflow), indent=4)
+    payload = json.dumps(new_canvas_client().get_slack_payload(workflow), indent=4)
     print(payload)
     print_action_output("canvas-json", payload)
+    print_timing_outputs()
+
+
+def print_batch_results(results: List[Dict[str, Any]]):
+    for result in results:
+        print(json.dumps(result))
+    print_action_output("batch-results", json.dumps(results))
+
+
+@click.command(
+    help="Apply many operations to a canvas under a single lock, with a single "
+    "slack update. Operations are read as JSON lines, one per line, e.g.: "
+    '{"command": "create-step", "stepId": "build", "description": "Build"}. '
+    "Supported commands are: create-step, remove-step, update-workflow, "
+    "add-artifact."
+)
+@click.option("--canvas-id", required=True, help="Required.")
+@click.option(
+    "--json",
+    "operations_json",
+    default=None,
+    required=False,
+    help="The JSON-lines operations to apply. If not provided, operations are "
+    "read from --file instead.",
+)
+@click.option(
+    "--file",
+    "operations_file",
+    type=click.File("r"),
+    default="-",
+    help="A file containing JSON-lines operations to apply; defaults to stdin.",
+)
+@lock_free_option
+def batch(
+    canvas_id: str,
+    operations_json: Optional[str],
+    operations_file,
+    lock_free: bool = False,
+):
+    import operations
+
+    lines = operations_json.splitlines() if operations_json else operations_file
+    batch_operations = []
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            raise click.BadParameter(f"Line {line_number}: {e}")
+        if not isinstance(data, dict):
+            raise click.BadParameter(
+                f"Line {line_number}: expected a JSON object, not {line.strip()}"
+            )
+        try:
+            batch_operations.append(operations.parse_operation(data))
+        except ValueError as e:
+            raise click.BadParameter(f"Line {line_number}: {e}")
+    if not batch_operations:
+        raise click.UsageError("No operations were given, in --json or --file.")
+
+    if lock_free:
+        print_batch_results(append_operations(canvas_id, batch_operations))
+        return
+
+    datastore_client = new_datastore_client()
+    canvas_client = new_canvas_client()
+    # If any operation fails, none of them are stored.
+    with datastore_client.lock_and_update(canvas_id, canvas_client) as workflow:
+        results = []
+        for number, operation in enumerate(batch_operations, start=1):
+            try:
+                results.append(
+                    dict(command=operation.command, **operation.apply(workflow))
+                )
+            except (ValueError, IndexError) as e:
+                raise click.ClickException(
+                    f"Operation {number} ({operation.command}) failed: {e}"
+                )
+    datastore_client.materialize_events(canvas_id, canvas_client)
+
+    print_batch_results(results)
+    print_lock_outputs(datastore_client)
+    print_canvas_outputs(canvas_client)
+    print_timing_outputs()
+
+
+@click.command(
+    "sidecar",
+    help="Run a long-lived process that serves the other commands over a "
+    "local unix socket, re-using its connections and cached workflows for "
+    "every command. While it is running, invoking run.py with the same "
+    "socket path forwards commands to it.",
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    default=sidecar.get_socket_path,
+    show_default="CANVAS_SIDECAR_SOCKET, or " + sidecar.DEFAULT_SOCKET_PATH,
+    help="The path of the unix socket to listen on.",
+)
+def serve_sidecar(socket_path: str):
+    from client import ClientPool
+
+    global client_pool
+    client_pool = ClientPool()
+    sidecar.serve(socket_path, cli.main)
 
 
 @click.group(help="Creates and maintains a slack workflow canvas.")
-def cli():
-    pass
+@click.pass_context
+def cli(ctx: click.Context):
+    timing.start(ctx.invoked_subcommand)
 
 
 cli.add_command(create_canvas)
@@ -297,10 +544,19 @@ cli.add_command(update_workflow)
 cli.add_command(add_artifact)
 cli.add_command(finalize_workflow)
 cli.add_command(get_canvas_json)
+cli.add_command(batch)
+cli.add_command(serve_sidecar)
 
 
 if __name__ == "__main__":
     logging.basicConfig()
     logging.getLogger(__name__).setLevel(logging.DEBUG)
-    cli()
-    print_action_output("fingerprint", os.environ.get("FINGERPRINT"))
+    socket_path = sidecar.get_socket_path()
+    try:
+        if sys.argv[1:2] != ["sidecar"] and sidecar.is_running(socket_path):
+            sys.exit(sidecar.forward(socket_path, sys.argv[1:]))
+        cli()
+    finally:
+        # Both paths exit (click's standalone mode always does), so this is
+        # output on the way out, whether the command ran here or in the sidecar.
+        print_action_output("fingerprint", os.environ.get("FINGERPRINT"))
@@ -0,0 +1,201 @@
+"""
+A long-running "sidecar" process that serves run.py commands over a local unix
+socket, so that a job pays for imports, authentication and connection setup
+once, instead of once per step.
+
+The protocol is one JSON object per line, in each direction:
+    request:  {"args": ["create-step", "--canvas-id", "...", ...],
+               "stdin": "", "env": {"CANVAS_TIMING_LOG": "0"}, "cwd": "/..."}
+    response: {"exitCode": 0, "stdout": "...", "stderr": "...", "error": null}
+
+A command runs in the sidecar with the client's working directory (if the
+sidecar can see it), the client's CANVAS_* environment variables, and the
+client's stdin, for commands that read it; everything it prints or logs is
+relayed back to the client.
+"""
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from typing import Callable, Dict, List, Optional
+
+DEFAULT_SOCKET_PATH = "/tmp/update-slack-workflow-canvas.sock"
+# The environment variables that are read by each command, rather than once by
+# the sidecar (e.g., the slack token), and so are forwarded with the command.
+FORWARDED_ENV_PREFIX = "CANVAS_"
+
+
+def get_socket_path() -> str:
+    return os.environ.get("CANVAS_SIDECAR_SOCKET", DEFAULT_SOCKET_PATH)
+
+
+def reads_stdin(args: List[str]) -> bool:
+    """
+    :return: Whether the command reads stdin: `batch` does, unless it is given
+        --json, or a --file other than `-`.
+    """
+    if args[:1] != ["batch"]:
+        return False
+    operations_file = "-"
+    for i, arg in enumerate(args):
+        if arg in ("--json", "--file") and i + 1 < len(args):
+            value = args[i + 1]
+        elif arg.startswith(("--json=", "--file=")):
+            arg, _, value = arg.partition("=")
+        else:
+            continue
+        if arg == "--json" and value:
+            return False
+        if arg == "--file":
+            operations_file = value
+    return operations_file == "-"
+
+
+def run_command(
+    cli_main: Callable,
+    args: List[str],
+    stdin: str = "",
+    env: Optional[Dict[str, str]] = None,
+    cwd: Optional[str] = None,
+) -> dict:
+    """
+    Runs a single CLI invocation in this process, capturing what it prints and
+    logs.
+    :param env: The client's CANVAS_* environment variables, which replace the
+        sidecar's own for the duration of the command.
+    """
+    import click  # Deferred so that the thin client never imports click.
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    log_handler = logging.StreamHandler(stderr)
+    log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    saved_env = {
+        name: value
+        for name, value in os.environ.items()
+        if name.startswith(FORWARDED_ENV_PREFIX)
+    }
+    saved_cwd, saved_stdin = os.getcwd(), sys.stdin
+    exit_code, error = 0, None
+    logging.getLogger().addHandler(log_handler)
+    try:
+        if env is not None:
+            for name in saved_env:
+                del os.environ[name]
+            os.environ.update(env)
+        if cwd and os.path.isdir(cwd):
+            os.chdir(cwd)
+        sys.stdin = io.StringIO(stdin)
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                exit_code = (
+                    cli_main(args, prog_name="run.py", standalone_mode=False) or 0
+                )
+            except click.ClickException as e:
+                exit_code, error = e.exit_code, e.format_message()
+            except click.Abort:
+                exit_code, error = 1, "Aborted!"
+            except Exception:
+                exit_code, error = 1, traceback.format_exc()
+    finally:
+        logging.getLogger().removeHandler(log_handler)
+        sys.stdin = saved_stdin
+        os.chdir(saved_cwd)
+        if env is not None:
+            for name in env:
+                os.environ.pop(name, None)
+            os.environ.update(saved_env)
+    return {
+        "exitCode": exit_code,
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue(),
+        "error": error,
+    }
+
+
+class SidecarServer(socketserver.UnixStreamServer):
+    """
+    Handles one command at a time, in the order they are received, so that
+    commands never race each other within the sidecar itself.
+    """
+
+    def __init__(self, socket_path: str, cli_main: Callable):
+        self.cli_main = cli_main
+        super().__init__(socket_path, SidecarRequestHandler)
+
+
+class SidecarRequestHandler(socketserver.StreamRequestHandler):
+    server: SidecarServer
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:  # Someone checking whether we are running
+            return
+        request = json.loads(line)
+        logging.info(f"Sidecar running: {request['args']}")
+        response = run_command(
+            self.server.cli_main,
+            request["args"],
+            stdin=request.get("stdin", ""),
+            env=request.get("env"),
+            cwd=request.get("cwd"),
+        )
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def serve(socket_path: str, cli_main: Callable):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # Make sure the socket is cleaned up when the job stops the sidecar.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with SidecarServer(socket_path, cli_main) as server:
+        logging.warning(f"Serving canvas commands on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+
+def is_running(socket_path: str) -> bool:
+    if not os.path.exists(socket_path):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:  # A socket left behind by a sidecar that has exited
+            return False
+    return True
+
+
+def forward(socket_path: str, args: List[str]) -> int:
+    """
+    Sends a command to a running sidecar, along with its stdin (if it reads
+    it), environment and working directory, and relays its output.
+    :return: The exit code of the command.
+    """
+    request = {
+        "args": args,
+        "stdin": sys.stdin.read() if reads_stdin(args) else "",
+        "env": {
+            name: value
+            for name, value in os.environ.items()
+            if name.startswith(FORWARDED_ENV_PREFIX)
+        },
+        "cwd": os.getcwd(),
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as stream:
+            stream.write(json.dumps(request).encode("utf-8") + b"\n")
+            stream.flush()
+            response = json.loads(stream.readline())
+    print(response["stdout"], end="")
+    print(response.get("stderr", ""), end="", file=sys.stderr)
+    if response["error"]:
+        print(response["error"], file=sys.stderr)
+    return response["exitCode"]
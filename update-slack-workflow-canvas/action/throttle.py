@@ -0,0 +1,252 @@
+"""
+Keeps canvas updates inside slack's rate limits.
+
+Slack limits each API method across the workspace (its "tier"), and limits how
+quickly messages can be posted to any one channel; going over either gets an
+HTTP 429 with a `Retry-After` header. The ThrottledSlackClient paces calls
+with a token bucket per method and per (method, channel), waits out any
+`Retry-After` (with jitter, so that many jobs don't all retry at once), and
+drops queued updates to a message that have been superseded by a newer update
+to the same message.
+"""
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, Optional, Tuple
+
+if TYPE_CHECKING:
+    from slack_sdk import WebClient
+    from slack_sdk.web import SlackResponse
+
+# (requests per second, burst size) for each method across the workspace,
+# per https://api.slack.com/docs/rate-limits; chat.update is a "Tier 3" method.
+METHOD_RATE_LIMITS: Dict[str, Tuple[float, int]] = {
+    "chat.postMessage": (5.0, 10),
+    "chat.update": (50 / 60, 5),
+    "chat.delete": (50 / 60, 5),
+}
+# (requests per second, burst size) for each method within a single channel.
+CHANNEL_RATE_LIMIT: Tuple[float, int] = (1.0, 3)
+MAX_RETRIES = 5
+# A rate-limited call waits for Retry-After, plus up to this fraction again.
+RETRY_JITTER = 0.5
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket. Callers reserve a token and then wait for however
+    long the reservation says, so that concurrent callers queue in order.
+    """
+
+    def __init__(
+        self, rate: float, capacity: int, clock: Callable[[], float] = time.monotonic
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """
+        Takes a token.
+        :return: How many seconds the caller must wait before using it.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate, self.paused_until - self.updated)
+
+    def refund(self):
+        """
+        Gives back a token that was reserved, but not used.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, seconds: float):
+        """
+        Makes sure that no token can be used for at least `seconds`.
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+
+class SlackRateLimiter:
+    """
+    Rate limit state that is shared by every ThrottledSlackClient using the same
+    slack token (e.g., by every command run by the sidecar).
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+        # (channel, ts) -> the sequence number of the newest update queued for it
+        self._latest_updates: Dict[Tuple[str, str], int] = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def get_buckets(self, method: str, channel: Optional[str]) -> Tuple[TokenBucket, ...]:
+        keys = [(method, None), (method, channel)] if channel else [(method, None)]
+        with self._lock:
+            for key in keys:
+                if key not in self._buckets:
+                    if key[1] is None:
+                        rate, capacity = METHOD_RATE_LIMITS.get(method, (1.0, 1))
+                    else:
+                        rate, capacity = CHANNEL_RATE_LIMIT
+                    self._buckets[key] = TokenBucket(rate, capacity, self.clock)
+            return tuple(self._buckets[key] for key in keys)
+
+    def queue_update(self, message: Tuple[str, str]) -> int:
+        """
+        Records that an update to the message is waiting to be sent.
+        :return: The update's sequence number.
+        """
+        with self._lock:
+            self._sequence += 1
+            self._latest_updates[message] = self._sequence
+            return self._sequence
+
+    def is_superseded(self, message: Tuple[str, str], sequence: int) -> bool:
+        with self._lock:
+            return self._latest_updates.get(message) != sequence
+
+    def finish_update(self, message: Tuple[str, str], sequence: int):
+        with self._lock:
+            if self._latest_updates.get(message) == sequence:
+                del self._latest_updates[message]
+
+
+class ThrottledSlackClient:
+    """
+    Wraps the slack WebClient methods that the canvas uses. Counts, for outputs:
+        calls_throttled: calls that had to wait for a rate limit, either ours
+            or slack's.
+        calls_retried: calls that were retried after slack rate-limited them.
+        calls_coalesced: updates that were dropped because a newer update to the
+            same message was queued behind them.
+    """
+
+    def __init__(
+        self,
+        new_client: Callable[[], WebClient],
+        rate_limiter: Optional[SlackRateLimiter] = None,
+        sleep: Callable[[float], Any] = time.sleep,
+    ):
+        self._new_client = new_client
+        self._client: Optional[WebClient] = None
+        self.rate_limiter = rate_limiter or SlackRateLimiter()
+        self.sleep = sleep
+        self.calls_throttled = 0
+        self.calls_retried = 0
+        self.calls_coalesced = 0
+
+    @property
+    def client(self) -> WebClient:
+        # Created on first use, so that commands that only render the canvas
+        # (e.g., get-canvas-json) never load slack_sdk.
+        if not self._client:
+            self._client = self._new_client()
+        return self._client
+
+    def chat_postMessage(self, **kwargs) -> SlackResponse:
+        return self._call("chat.postMessage", kwargs)
+
+    def chat_update(self, **kwargs) -> Optional[SlackResponse]:
+        """
+        :return: None if the update was not sent, because a newer update to the
+            same message was queued while this one was waiting.
+        """
+        message = (kwargs.get("channel"), kwargs.get("ts"))
+        sequence = self.rate_limiter.queue_update(message)
+        try:
+            return self._call(
+                "chat.update",
+                kwargs,
+                is_superseded=lambda: self.rate_limiter.is_superseded(message, sequence),
+            )
+        finally:
+            self.rate_limiter.finish_update(message, sequence)
+
+    def chat_delete(self, **kwargs) -> SlackResponse:
+        return self._call("chat.delete", kwargs)
+
+    def _wait_for_buckets(
+        self, method: str, channel: Optional[str], buckets: Tuple[TokenBucket, ...]
+    ) -> bool:
+        """
+        :return: True if the call had to wait.
+        """
+        wait_seconds = max(bucket.reserve() for bucket in buckets)
+        if wait_seconds:
+            logging.info(f"Waiting {wait_seconds:.2f}s to call {method} on {channel}")
+            self.sleep(wait_seconds)
+        return wait_seconds > 0
+
+    @staticmethod
+    def get_retry_after(response: SlackResponse) -> float:
+        headers = {k.lower(): v for k, v in (response.headers or {}).items()}
+        retry_after = headers.get("retry-after", 1)
+        if isinstance(retry_after, list):
+            retry_after = retry_after[0]
+        return float(retry_after)
+
+    def _coalesce(self, method: str, channel: Optional[str]) -> None:
+        logging.info(f"Skipping {method} on {channel}; a newer update is queued.")
+        self.calls_coalesced += 1
+
+    def _call(
+        self,
+        method: str,
+        kwargs: Dict[str, Any],
+        is_superseded: Callable[[], bool] = lambda: False,
+    ) -> Optional[SlackResponse]:
+        from slack_sdk.errors import SlackApiError
+
+        channel = kwargs.get("channel")
+        attempt = 0
+        throttled = False
+        try:
+            while True:
+                # Checked before taking a token, as well as after waiting for it,
+                # so that a dropped update doesn't use up the budget.
+                if is_superseded():
+                    return self._coalesce(method, channel)
+                buckets = self.rate_limiter.get_buckets(method, channel)
+                throttled = self._wait_for_buckets(method, channel, buckets) or throttled
+                if is_superseded():
+                    for bucket in buckets:
+                        bucket.refund()
+                    return self._coalesce(method, channel)
+                try:
+                    return getattr(self.client, method.replace(".", "_"))(**kwargs)
+                except SlackApiError as e:
+                    if e.response.status_code != 429 or attempt >= MAX_RETRIES:
+                        raise
+                    retry_after = self.get_retry_after(e.response)
+                    attempt += 1
+                    # Hold back everyone else calling this method on this channel.
+                    for bucket in self.rate_limiter.get_buckets(method, channel):
+                        bucket.pause(retry_after)
+                    wait_seconds = retry_after * (1 + random.uniform(0, RETRY_JITTER))
+                    logging.warning(
+                        f"Slack rate-limited {method} on {channel}; retrying in "
+                        f"{wait_seconds:.2f}s (attempt {attempt} of {MAX_RETRIES})"
+                    )
+                    throttled = True
+                    self.sleep(wait_seconds)
+        finally:
+            self.calls_throttled += throttled
+            self.calls_retried += attempt > 0
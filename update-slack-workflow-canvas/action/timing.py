@@ -0,0 +1,148 @@
+"""
+Timing spans around each phase of a command (waiting for the lock, loading,
+parsing, rendering, talking to slack, ...), so that a slow step can be
+diagnosed from its logs.
+
+Every span is written to stderr as a JSON line, e.g.:
+    {"span": "slack.update", "ms": 182.4, "command": "create-step", "workflow_id": "..."}
+unless CANVAS_TIMING_LOG=0. The spans of the current command are also totalled
+by name, for the `timings` output.
+
+If OTEL_TRACES_EXPORTER or OTEL_EXPORTER_OTLP_ENDPOINT is set, spans are also
+exported with opentelemetry: to the tracer provider that has already been set up
+(e.g., by `opentelemetry-instrument`), or else to one that is set up here, with
+the exporter named by OTEL_TRACES_EXPORTER ("otlp", the default, or "console").
+This needs the opentelemetry-sdk package, and for "otlp", the
+opentelemetry-exporter-otlp package; the exporter reads the rest of its
+configuration (endpoint, headers, protocol, ...) from the standard OTEL_*
+variables.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+
+_current_timings: ContextVar[Optional["Timings"]] = ContextVar(
+    "canvas_timings", default=None
+)
+_otel_tracer = None
+
+
+class Timings:
+    """
+    The spans recorded while running one command.
+    """
+
+    def __init__(self, command: Optional[str] = None):
+        self.command = command
+        self.started = time.perf_counter()
+        self.totals: Dict[str, float] = defaultdict(float)
+
+    def record(self, name: str, elapsed_ms: float):
+        self.totals[name] += elapsed_ms
+
+    def summary(self) -> Dict[str, float]:
+        """
+        :return: The total milliseconds spent in each span, and in the whole
+            command so far.
+        """
+        summary = {name: round(ms, 1) for name, ms in self.totals.items()}
+        summary["total"] = round((time.perf_counter() - self.started) * 1000, 1)
+        return summary
+
+
+def start(command: Optional[str] = None) -> Timings:
+    """
+    Starts recording spans for a new command, in the current thread or task.
+    """
+    timings = Timings(command)
+    _current_timings.set(timings)
+    return timings
+
+
+def current() -> Optional[Timings]:
+    return _current_timings.get()
+
+
+def _set_up_otel_provider(trace):
+    """
+    Sets up the SDK's tracer provider with the exporter that the environment
+    names, unless a provider has already been set up.
+    """
+    if not isinstance(trace.get_tracer_provider(), trace.ProxyTracerProvider):
+        return
+    from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    exporter_name = os.environ.get("OTEL_TRACES_EXPORTER", "otlp").split(",")[0]
+    if exporter_name == "console":
+        exporter = ConsoleSpanExporter()
+    elif exporter_name == "otlp":
+        if os.environ.get("OTEL_EXPORTER_OTLP_PROTOCOL") == "grpc":
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
+                OTLPSpanExporter,
+            )
+        else:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+        exporter = OTLPSpanExporter()
+    else:
+        raise ValueError(f"Unsupported OTEL_TRACES_EXPORTER: {exporter_name}")
+    service_name = os.environ.get("OTEL_SERVICE_NAME", "update-slack-workflow-canvas")
+    provider = TracerProvider(resource=Resource.create({SERVICE_NAME: service_name}))
+    # Spans are exported in the background, and flushed when the process exits.
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
+
+def get_otel_tracer():
+    global _otel_tracer
+    if _otel_tracer is None:
+        _otel_tracer = False
+        exporter_name = os.environ.get("OTEL_TRACES_EXPORTER")
+        if exporter_name != "none" and (
+            exporter_name or os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+        ):
+            try:
+                from opentelemetry import trace
+
+                _set_up_otel_provider(trace)
+                _otel_tracer = trace.get_tracer("update-slack-workflow-canvas")
+            except (ImportError, ValueError) as e:
+                # Timing is never worth failing a command over.
+                logging.warning(f"Not exporting timing spans with opentelemetry: {e}")
+    return _otel_tracer or None
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[None]:
+    tracer = get_otel_tracer()
+    started = time.perf_counter()
+    try:
+        if tracer:
+            with tracer.start_as_current_span(
+                name, attributes={k: str(v) for k, v in attributes.items()}
+            ):
+                yield
+        else:
+            yield
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        timings = current()
+        if timings:
+            timings.record(name, elapsed_ms)
+        if os.environ.get("CANVAS_TIMING_LOG", "1") != "0":
+            line = {"span": name, "ms": round(elapsed_ms, 1)}
+            if timings and timings.command:
+                line["command"] = timings.command
+            line.update(attributes)
+            print(json.dumps(line, default=str), file=sys.stderr)
@@ -0,0 +1,115 @@
+"""
+Keeps the last workflow that each canvas was stored or loaded as on the runner's
+disk, under `ActionSettings.context_storage`, so that the commands of a job
+(each of which is a new process) start out with the workflow in hand.
+
+An entry is only ever used along with the version it was stored at; the
+DatastoreClient checks that version against the one on the workflow's lock
+entity (a single small lookup, or none when it has just acquired the lock)
+before trusting it, the same way as its in-memory cache.
+
+Entries are written with the cache's format, which changes whenever the
+models' fields do, so that a runner never reads back entries written by a
+different version of the app.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from collections.abc import MutableMapping
+from typing import Iterator, Tuple
+from urllib.parse import quote, unquote
+from uuid import uuid4
+
+import codec
+from models import CanvasPage, CanvasTarget, Workflow, WorkflowStep
+
+CACHE_VERSION = 1
+
+
+def _get_cache_format() -> str:
+    fields = [
+        f"{model.__name__}.{name}"
+        for model in (Workflow, WorkflowStep, CanvasTarget, CanvasPage)
+        for name in model.__fields__
+    ]
+    return f"{CACHE_VERSION}:{hashlib.sha1(','.join(fields).encode()).hexdigest()}"
+
+
+CACHE_FORMAT = _get_cache_format()
+
+
+class DiskWorkflowCache(MutableMapping):
+    """
+    (version, workflow) by workflow id, like the DatastoreClient's in-memory
+    cache, backed by a JSON file per workflow. Entries that can't be read
+    (e.g., written in another format) are treated as missing, and failures to
+    write them are logged and ignored; the cache is only ever an optimization.
+    """
+
+    def __init__(self, context_storage: str):
+        self.directory = os.path.join(context_storage, "workflows")
+        self._entries = {}
+
+    def _get_path(self, workflow_id: str) -> str:
+        return os.path.join(self.directory, f"{quote(workflow_id, safe='')}.json")
+
+    def __getitem__(self, workflow_id: str) -> Tuple[str, Workflow]:
+        if workflow_id not in self._entries:
+            try:
+                with open(self._get_path(workflow_id)) as f:
+                    data = json.load(f)
+                if data["format"] != CACHE_FORMAT:
+                    raise KeyError(workflow_id)
+                workflow = data["workflow"]
+                self._entries[workflow_id] = (
+                    data["version"],
+                    codec.load_workflow(workflow, workflow["steps"]),
+                )
+            except (OSError, ValueError, KeyError, TypeError):
+                raise KeyError(workflow_id)
+        return self._entries[workflow_id]
+
+    def __setitem__(self, workflow_id: str, entry: Tuple[str, Workflow]):
+        self._entries[workflow_id] = entry
+        version, workflow = entry
+        path = self._get_path(workflow_id)
+        temp_path = f"{path}.{uuid4().hex}"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, "w") as f:
+                json.dump(
+                    dict(
+                        format=CACHE_FORMAT,
+                        version=version,
+                        workflow=codec.dump_workflow(workflow),
+                    ),
+                    f,
+                )
+            # Readers only ever see a whole entry.
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not cache workflow {workflow_id}: {e}")
+
+    def __delitem__(self, workflow_id: str):
+        found = self._entries.pop(workflow_id, None) is not None
+        try:
+            os.remove(self._get_path(workflow_id))
+        except FileNotFoundError:
+            if not found:
+                raise KeyError(workflow_id)
+
+    def __iter__(self) -> Iterator[str]:
+        try:
+            filenames = os.listdir(self.directory)
+        except FileNotFoundError:
+            return iter(self._entries)
+        return iter(
+            set(self._entries)
+            | {unquote(name[: -len(".json")]) for name in filenames if name.endswith(".json")}
+        )
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
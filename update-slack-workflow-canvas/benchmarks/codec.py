@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Compares the cost of a workflow's round trip to and from the dicts stored in
+Datastore through pydantic (`canvas_payload`, then `Workflow.parse_obj`; the way
+the app used to), against codec.py, at 10, 100 and 1000 steps. Also times the
+deep copy made whenever a workflow is cached, or read from the cache.
+
+Usage:
+    python benchmarks/codec.py [--steps 10 100 1000] [--repeat 20]
+"""
+import os
+import sys
+import timeit
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "action"))
+
+import codec  # noqa: E402
+from models import (  # noqa: E402
+    CanvasPage,
+    CanvasTarget,
+    Workflow,
+    WorkflowStatus,
+    WorkflowStep,
+    WorkflowStepStatus,
+)
+
+STATUSES = WorkflowStepStatus.values()
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser("Benchmark storing and loading workflows.")
+    parser.add_argument("--steps", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    return parser
+
+
+def make_workflow(num_steps: int) -> Workflow:
+    return Workflow(
+        description="Codec benchmark",
+        targets=[
+            CanvasTarget(
+                channel="#benchmark",
+                channel_id="C1234",
+                message_id="1234.5678",
+                payload_hash="abc",
+                pages=[CanvasPage(message_id="1234.5679", payload_hash="def")],
+            ),
+            CanvasTarget(channel="#benchmark-ops"),
+        ],
+        status=WorkflowStatus.in_progress,
+        steps=[
+            WorkflowStep(
+                step_id=f"step-{i}",
+                description=f"Step number {i} of <https://example.com/{i} | the build>",
+                status=STATUSES[i % len(STATUSES)],
+            )
+            for i in range(num_steps)
+        ],
+        artifacts=[f"> Artifact {i}" for i in range(5)],
+    )
+
+
+def round_trip_with_models(workflow: Workflow) -> Workflow:
+    return Workflow.parse_obj(workflow.canvas_payload)
+
+
+def round_trip_with_codec(workflow: Workflow) -> Workflow:
+    data = codec.dump_workflow(workflow)
+    return codec.load_workflow(data, data.pop("steps"))
+
+
+def time_ms(fn, repeat: int) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000
+
+
+def main():
+    args = get_parser().parse_args()
+    print(
+        f"{'steps':>6} {'models ms':>10} {'codec ms':>10} {'speedup':>8} "
+        f"{'copy ms':>10} {'codec copy ms':>14}"
+    )
+    for num_steps in args.steps:
+        workflow = make_workflow(num_steps)
+        assert codec.dump_workflow(workflow) == workflow.canvas_payload, "Dumps differ!"
+        for round_trip in (round_trip_with_models, round_trip_with_codec):
+            assert (
+                round_trip(workflow).canvas_payload == workflow.canvas_payload
+            ), f"{round_trip.__name__} changed the workflow!"
+
+        models_ms = time_ms(lambda: round_trip_with_models(workflow), args.repeat)
+        codec_ms = time_ms(lambda: round_trip_with_codec(workflow), args.repeat)
+        copy_ms = time_ms(lambda: workflow.copy(deep=True), args.repeat)
+        codec_copy_ms = time_ms(lambda: codec.copy_workflow(workflow), args.repeat)
+        print(
+            f"{num_steps:>6} {models_ms:>10.3f} {codec_ms:>10.3f} "
+            f"{models_ms / codec_ms:>7.1f}x {copy_ms:>10.3f} {codec_copy_ms:>14.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
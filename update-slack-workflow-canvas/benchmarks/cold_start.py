@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Measures the cold-start latency of the canvas app: how long a fresh interpreter
+takes to start and import what each entry point needs. Import times come from
+`python -X importtime`, so the slowest imports can be called out by name.
+
+Each command only imports the backends it uses when it runs, so the targets
+below cover the CLI itself (`--help`, and forwarding to a sidecar), and the
+sets of modules that commands load on top of it.
+
+Usage:
+    python benchmarks/cold_start.py [--runs 5] [--top 10] [--max-cli-ms 250]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from typing import Dict, List, Tuple
+
+ACTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "action")
+
+TARGETS: Dict[str, List[str]] = {
+    "cli --help": ["run.py", "--help"],
+    "cli create-step --help": ["run.py", "create-step", "--help"],
+    "models": ["-c", "import models"],
+    "operations": ["-c", "import operations"],
+    "get-canvas-json (datastore)": [
+        "-c",
+        "import run, client; from google.cloud import datastore",
+    ],
+    "mutating commands (datastore + slack)": [
+        "-c",
+        "import run, client, operations, slack_sdk; from google.cloud import datastore",
+    ],
+}
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser("Benchmark the cold-start latency of the canvas app.")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per target.")
+    parser.add_argument(
+        "--top", type=int, default=5, help="How many of the slowest imports to list."
+    )
+    parser.add_argument(
+        "--max-cli-ms",
+        type=float,
+        default=None,
+        help="Exit non-zero if the median import time of `cli --help` exceeds this.",
+    )
+    return parser
+
+
+def parse_import_times(stderr: str) -> Dict[str, int]:
+    """
+    :return: The cumulative import time, in microseconds, of each top-level import.
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented beneath the import that caused them.
+        if not name[1:].startswith(" "):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def run_target(args: List[str]) -> Tuple[float, Dict[str, int]]:
+    env = dict(os.environ, SLACK_BOT_TOKEN="benchmark")
+    # Make sure the CLI never forwards to a running sidecar.
+    env["CANVAS_SIDECAR_SOCKET"] = os.devnull + ".no-sidecar"
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=ACTION_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    return wall_ms, parse_import_times(result.stderr)
+
+
+def main():
+    args = get_parser().parse_args()
+    cli_import_ms = None
+    print(f"{'target':<40} {'wall ms':>10} {'import ms':>10}")
+    for name, target_args in TARGETS.items():
+        wall_times, import_times, slowest = [], [], {}
+        for _ in range(args.runs):
+            wall_ms, times = run_target(target_args)
+            wall_times.append(wall_ms)
+            import_times.append(sum(times.values()) / 1000)
+            slowest = times
+        import_ms = statistics.median(import_times)
+        print(f"{name:<40} {statistics.median(wall_times):>10.1f} {import_ms:>10.1f}")
+        for module, us in sorted(slowest.items(), key=lambda i: -i[1])[: args.top]:
+            print(f"    {module:<36} {us / 1000:>21.1f}")
+        if name == "cli --help":
+            cli_import_ms = import_ms
+
+    if args.max_cli_ms is not None and cli_import_ms > args.max_cli_ms:
+        print(
+            f"cli --help imports took {cli_import_ms:.1f}ms; "
+            f"the maximum is {args.max_cli_ms}ms.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
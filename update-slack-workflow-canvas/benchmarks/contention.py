@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+A load test of many runners working on one canvas at the same time, using the
+in-process fakes in fakes.py in place of Datastore and Slack.
+
+Each runner runs the real `run.py` commands: `create-step` to add its own step,
+then `update-workflow` to mark it succeeded. Every runner gets its own clients,
+the way separate jobs would (or, with --shared-pool, shares them the way commands
+in the sidecar do), and with --lock-free, both commands append events instead of
+waiting for the lock. Afterwards, the stored canvas and the last message sent to
+slack are checked for lost updates.
+
+Usage:
+    python benchmarks/contention.py [--runners 50] [--datastore-latency-ms 20]
+        [--slack-latency-ms 50] [--rate-limit-probability 0.05] [--lock-free]
+"""
+import json
+import math
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "action"))
+os.environ.setdefault("SLACK_BOT_TOKEN", "benchmark")
+os.environ.setdefault("CANVAS_TIMING_LOG", "0")
+
+import client  # noqa: E402
+import run  # noqa: E402
+from fakes import FakeDatastore, FakeSlack  # noqa: E402
+
+CANVAS_ID = "contention-test"
+
+outputs = threading.local()
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser("Load test many runners contending for one canvas.")
+    parser.add_argument("--runners", type=int, default=50)
+    parser.add_argument("--datastore-latency-ms", type=float, default=20)
+    parser.add_argument("--slack-latency-ms", type=float, default=50)
+    parser.add_argument(
+        "--rate-limit-probability",
+        type=float,
+        default=0.0,
+        help="The fraction of slack calls to reject with a 429.",
+    )
+    parser.add_argument("--retry-after-seconds", type=float, default=1.0)
+    parser.add_argument(
+        "--shared-pool",
+        action="store_true",
+        help="Share clients and cached workflows between runners, like the sidecar.",
+    )
+    parser.add_argument(
+        "--lock-free",
+        action="store_true",
+        help="Append the runners' changes as events, instead of locking the canvas.",
+    )
+    return parser
+
+
+def record_output(output_name: str, output_value):
+    outputs.values[output_name] = output_value
+
+
+def invoke(*args: str) -> Dict:
+    """
+    Runs a command, returning its outputs and how long it took.
+    """
+    outputs.values = {}
+    started = time.perf_counter()
+    try:
+        run.cli.main(list(args), prog_name="run.py", standalone_mode=False)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return dict(
+        outputs.values,
+        command=args[0],
+        error=error,
+        elapsed_ms=(time.perf_counter() - started) * 1000,
+    )
+
+
+def run_runner(runner: int, start: threading.Barrier, lock_free: bool) -> List[Dict]:
+    step_id = f"runner-{runner}"
+    extra_args = ["--lock-free"] if lock_free else []
+    start.wait()
+    return [
+        invoke(
+            "create-step",
+            "--canvas-id", CANVAS_ID,
+            "--step-id", step_id,
+            "--description", f"Runner {runner}",
+            "--step-status", "in progress",
+            *extra_args,
+        ),
+        invoke(
+            "update-workflow",
+            "--canvas-id", CANVAS_ID,
+            "--step-id", step_id,
+            "--step-status", "succeeded",
+            *extra_args,
+        ),
+    ]
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)] if values else 0.0
+
+
+def main():
+    args = get_parser().parse_args()
+    fake_datastore = FakeDatastore(latency_seconds=args.datastore_latency_ms / 1000)
+    fake_slack = FakeSlack(
+        latency_seconds=args.slack_latency_ms / 1000,
+        rate_limit_probability=args.rate_limit_probability,
+        retry_after_seconds=args.retry_after_seconds,
+    )
+    client.new_datastore_backend = lambda: fake_datastore
+    client.new_slack_backend = lambda: fake_slack
+    if args.shared_pool:
+        run.client_pool = client.ClientPool()
+    run.print_action_output = record_output
+
+    created = invoke(
+        "create-canvas",
+        "--json",
+        json.dumps({"canvasId": CANVAS_ID, "description": "Contention", "channel": "#test"}),
+    )
+    assert not created["error"], created["error"]
+
+    start = threading.Barrier(args.runners)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.runners) as executor:
+        results = [
+            result
+            for runner_results in executor.map(
+                lambda i: run_runner(i, start, args.lock_free), range(args.runners)
+            )
+            for result in runner_results
+        ]
+    total_seconds = time.perf_counter() - started
+
+    by_command = defaultdict(list)
+    for result in results:
+        by_command[result["command"]].append(result)
+    print(f"{args.runners} runners finished in {total_seconds:.2f}s\n")
+    print(f"{'command':<18} {'':<14} {'p50':>9} {'p95':>9} {'p99':>9} {'errors':>7}")
+    for command, command_results in by_command.items():
+        for label, field in (("lock wait ms", "lock-wait-ms"), ("end-to-end ms", "elapsed_ms")):
+            values = [float(r[field]) for r in command_results if r.get(field) is not None]
+            errors = sum(1 for r in command_results if r["error"])
+            print(
+                f"{command:<18} {label:<14} "
+                + " ".join(f"{percentile(values, p):>9.1f}" for p in (50, 95, 99))
+                + f" {errors:>7}"
+            )
+
+    # Every runner's step should be there, and succeeded, both in Datastore and
+    # in what slack was last sent.
+    workflow = client.DatastoreClient().load_workflow(CANVAS_ID)
+    statuses = {step.step_id: step.status_str for step in workflow.steps}
+    lost = [
+        f"runner-{i}"
+        for i in range(args.runners)
+        if statuses.get(f"runner-{i}") != "succeeded"
+    ]
+    target = workflow.targets[0]
+    message_ids = [target.message_id] + [page.message_id for page in target.pages]
+    pages = workflow.get_page_block_dicts()
+    stale_slack = len(message_ids) != len(pages) or any(
+        fake_slack.messages[message_id]["blocks"] != blocks
+        for message_id, blocks in zip(message_ids, pages)
+    )
+
+    print()
+    print(f"{'lost updates:':<24}{len(lost)} {lost[:5] if lost else ''}")
+    print(f"{'slack out of date:':<24}{stale_slack}")
+    print(f"{'slack calls:':<24}{dict(fake_slack.calls)}")
+    for name in ("slack-updates-skipped", "slack-calls-throttled", "slack-calls-retried"):
+        total = sum(int(r.get(name) or 0) for r in results)
+        print(f"{name + ':':<24}{total}")
+    print(f"{'datastore calls:':<24}{dict(fake_datastore.calls)}")
+    for error in sorted({r["error"] for r in results if r["error"]})[:5]:
+        print(f"error: {error}", file=sys.stderr)
+    if lost or stale_slack:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
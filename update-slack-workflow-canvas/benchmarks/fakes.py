@@ -0,0 +1,236 @@
+"""
+In-process stand-ins for the Datastore client and the slack WebClient, so that the
+app can be exercised (and timed) without GCP or Slack.
+
+Both add a configurable latency to every call. The Datastore fake commits
+transactions optimistically, the way Datastore does: a commit fails with
+`Aborted` if anything the transaction read or wrote was changed by another
+commit in the meantime. The slack fake can be told to rate-limit a fraction of
+calls with a 429 and a `Retry-After` header.
+"""
+import copy
+import random
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import Aborted
+from google.cloud import datastore
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web import SlackResponse
+
+KeyPath = Tuple
+
+
+class FakeTransaction:
+    def __init__(self, client: "FakeDatastore"):
+        self.client = client
+        # key path -> the version of the entity when this transaction first saw it
+        self.observed: Dict[KeyPath, int] = {}
+        self.puts: List[datastore.Entity] = []
+        self.deletes: List[datastore.Key] = []
+
+    def observe(self, key: datastore.Key):
+        path = key.flat_path
+        if path not in self.observed:
+            self.observed[path] = self.client.versions.get(path, 0)
+
+    def begin(self):
+        self.client.simulate_rpc("begin_transaction")
+
+    def put(self, entity: datastore.Entity):
+        self.observe(entity.key)
+        self.puts.append(entity)
+
+    def delete(self, key: datastore.Key):
+        self.observe(key)
+        self.deletes.append(key)
+
+    def rollback(self):
+        self.client.simulate_rpc("rollback")
+
+    def commit(self):
+        self.client.simulate_rpc("commit")
+        with self.client.lock:
+            for path, version in self.observed.items():
+                if self.client.versions.get(path, 0) != version:
+                    self.client.calls["aborted"] += 1
+                    raise Aborted(f"Transaction conflict on {path}")
+            for entity in self.puts:
+                self.client.write(entity.key, copy.deepcopy(entity))
+            for key in self.deletes:
+                self.client.write(key, None)
+
+
+class FakeQuery:
+    """
+    Supports only ancestor queries, optionally of one kind; results are in key
+    order, as they are from Datastore.
+    """
+
+    def __init__(
+        self, client: "FakeDatastore", kind: Optional[str], ancestor: datastore.Key
+    ):
+        self.client = client
+        self.kind = kind
+        self.ancestor = ancestor
+        self.projection = []
+
+    def keys_only(self):
+        self.projection = ["__key__"]
+
+    def fetch(self, limit: Optional[int] = None) -> List[datastore.Entity]:
+        self.client.simulate_rpc("run_query")
+        prefix = self.ancestor.flat_path
+        with self.client.lock:
+            results = [
+                copy.deepcopy(entity)
+                for path, entity in sorted(self.client.entities.items())
+                if path[: len(prefix)] == prefix
+                and (self.kind is None or entity.key.kind == self.kind)
+            ]
+        if self.projection:
+            results = [datastore.Entity(key=entity.key) for entity in results]
+        return results[:limit]
+
+
+class FakeDatastore:
+    """
+    Stands in for `google.cloud.datastore.Client`, implementing only what the app
+    uses.
+    """
+
+    def __init__(self, latency_seconds: float = 0.0, namespace: str = "github-actions"):
+        self.latency_seconds = latency_seconds
+        self.namespace = namespace
+        self.entities: Dict[KeyPath, datastore.Entity] = {}
+        self.versions: Dict[KeyPath, int] = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def simulate_rpc(self, name: str):
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def write(self, key: datastore.Key, entity: Optional[datastore.Entity]):
+        # Callers must hold the lock.
+        path = key.flat_path
+        if entity is None:
+            self.entities.pop(path, None)
+        else:
+            self.entities[path] = entity
+        self.versions[path] = self.versions.get(path, 0) + 1
+
+    def key(self, *path_args) -> datastore.Key:
+        return datastore.Key(*path_args, project="fake", namespace=self.namespace)
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def get(
+        self, key: datastore.Key, transaction: Optional[FakeTransaction] = None
+    ) -> Optional[datastore.Entity]:
+        self.simulate_rpc("lookup")
+        with self.lock:
+            if transaction is not None:
+                transaction.observe(key)
+            return copy.deepcopy(self.entities.get(key.flat_path))
+
+    def put(self, entity: datastore.Entity):
+        self.simulate_rpc("commit")
+        with self.lock:
+            self.write(entity.key, copy.deepcopy(entity))
+
+    def put_multi(self, entities: List[datastore.Entity]):
+        self.simulate_rpc("commit")
+        with self.lock:
+            for entity in entities:
+                self.write(entity.key, copy.deepcopy(entity))
+
+    def delete(self, key: datastore.Key):
+        self.simulate_rpc("commit")
+        with self.lock:
+            self.write(key, None)
+
+    def query(self, kind: Optional[str] = None, ancestor: datastore.Key = None) -> FakeQuery:
+        return FakeQuery(self, kind, ancestor)
+
+
+class FakeSlack:
+    """
+    Stands in for `slack_sdk.WebClient`, remembering the last payload sent for
+    each message.
+    """
+
+    def __init__(
+        self,
+        latency_seconds: float = 0.0,
+        rate_limit_probability: float = 0.0,
+        retry_after_seconds: float = 1.0,
+    ):
+        self.latency_seconds = latency_seconds
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after_seconds = retry_after_seconds
+        self.calls = Counter()
+        # ts -> the last payload posted or updated
+        self.messages: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self._next_ts = 0
+
+    def _response(self, method: str, data: dict, status_code: int = 200, headers=None):
+        return SlackResponse(
+            client=self,
+            http_verb="POST",
+            api_url=f"https://slack.com/api/{method}",
+            req_args={},
+            data=data,
+            headers=headers or {},
+            status_code=status_code,
+        )
+
+    def _call(self, method: str):
+        with self.lock:
+            self.calls[method] += 1
+            rate_limited = random.random() < self.rate_limit_probability
+            if rate_limited:
+                self.calls["rate_limited"] += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        if rate_limited:
+            response = self._response(
+                method,
+                {"ok": False, "error": "ratelimited"},
+                status_code=429,
+                headers={"Retry-After": str(self.retry_after_seconds)},
+            )
+            raise SlackApiError("ratelimited", response)
+
+    def chat_postMessage(self, **kwargs) -> SlackResponse:
+        self._call("chat.postMessage")
+        with self.lock:
+            self._next_ts += 1
+            ts = f"{self._next_ts}.000000"
+            self.messages[ts] = kwargs
+        return self._response(
+            "chat.postMessage",
+            {"ok": True, "channel": "CFAKE", "ts": ts, "message": {"ts": ts}},
+        )
+
+    def chat_update(self, **kwargs) -> SlackResponse:
+        self._call("chat.update")
+        with self.lock:
+            self.messages[kwargs["ts"]] = kwargs
+        return self._response(
+            "chat.update", {"ok": True, "channel": kwargs["channel"], "ts": kwargs["ts"]}
+        )
+
+    def chat_delete(self, **kwargs) -> SlackResponse:
+        self._call("chat.delete")
+        with self.lock:
+            self.messages.pop(kwargs["ts"], None)
+        return self._response(
+            "chat.delete", {"ok": True, "channel": kwargs["channel"], "ts": kwargs["ts"]}
+        )
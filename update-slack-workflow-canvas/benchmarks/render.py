@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Compares the cost of rendering a workflow canvas to a slack payload through the
+pydantic block models (the way the app used to), against the cached dict
+renderer, at 10, 100 and 1000 steps.
+
+"cold" renders with empty caches; "update" re-renders after changing a single
+step's status, which is what almost every command does.
+
+Usage:
+    python benchmarks/render.py [--steps 10 100 1000] [--repeat 20]
+"""
+import os
+import sys
+import timeit
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "action"))
+
+import models  # noqa: E402
+from models import (  # noqa: E402
+    CanvasTarget,
+    PostMessageInput,
+    Workflow,
+    WorkflowStatus,
+    WorkflowStep,
+    WorkflowStepStatus,
+)
+
+STATUSES = WorkflowStepStatus.values()
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser("Benchmark rendering workflow canvases.")
+    parser.add_argument("--steps", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    return parser
+
+
+def make_workflow(num_steps: int) -> Workflow:
+    return Workflow(
+        description="Render benchmark",
+        targets=[CanvasTarget(channel="#benchmark", message_id="1234.5678")],
+        status=WorkflowStatus.in_progress,
+        steps=[
+            WorkflowStep(
+                step_id=f"step-{i}",
+                description=f"Step number {i} of <https://example.com/{i} | the build>",
+                status=STATUSES[i % len(STATUSES)],
+            )
+            for i in range(num_steps)
+        ],
+        artifacts=[f"> Artifact {i}" for i in range(5)],
+    )
+
+
+def render_with_models(workflow: Workflow) -> dict:
+    """The rendering path used before blocks were rendered directly to dicts."""
+    [target] = workflow.targets
+    template = PostMessageInput.construct(channel_name="#benchmark")
+    payload = template.copy(
+        update=dict(
+            text=workflow.description,
+            ts=target.message_id,
+            channel_id=target.channel_id,
+            blocks=[
+                b.dict(by_alias=True, exclude_none=True)
+                for b in workflow.get_message_blocks()
+            ],
+        )
+    ).dict(by_alias=True, exclude_none=True)
+    payload["channel"] = target.channel
+    return payload
+
+
+def clear_caches():
+    models.render_step_block.cache_clear()
+    models.render_artifact_block.cache_clear()
+
+
+def change_one_step(workflow: Workflow, counter=[0]):
+    counter[0] += 1
+    step = workflow.steps[counter[0] % len(workflow.steps)]
+    step.status = STATUSES[(STATUSES.index(step.status_str) + 1) % len(STATUSES)]
+
+
+def time_ms(fn, repeat: int) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000
+
+
+def main():
+    args = get_parser().parse_args()
+    print(f"{'steps':>6} {'models ms':>10} {'cold ms':>10} {'update ms':>10} {'speedup':>8}")
+    for num_steps in args.steps:
+        workflow = make_workflow(num_steps)
+        assert (
+            render_with_models(workflow)["blocks"]
+            == workflow.get_message_block_dicts()
+        ), "Renderers disagree!"
+
+        models_ms = time_ms(lambda: render_with_models(workflow), args.repeat)
+        cold_ms = time_ms(
+            lambda: (clear_caches(), workflow.get_message_block_dicts()), args.repeat
+        )
+        update_ms = time_ms(
+            lambda: (change_one_step(workflow), workflow.get_message_block_dicts()),
+            args.repeat,
+        )
+        print(
+            f"{num_steps:>6} {models_ms:>10.3f} {cold_ms:>10.3f} {update_ms:>10.3f} "
+            f"{models_ms / update_ms:>7.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -32,6 +32,7 @@ docker run \
   -e ACTION_STEP_STATUS \
   -e ACTION_CANVAS \
   -e ACTION_JSON \
+  -e ACTION_LOCK_FREE \
   -e CI \
   -e GOOGLE_APPLICATION_CREDENTIALS="/secrets/$CREDENTIALS_FILE" \
   action .
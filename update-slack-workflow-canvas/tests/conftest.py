@@ -0,0 +1,98 @@
+"""
+Runs the real `run.py` commands against the in-process fakes in
+benchmarks/fakes.py, in place of Datastore and Slack.
+"""
+import os
+import sys
+from typing import Dict
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# benchmarks/codec.py shares its name with action/codec.py, so the action's
+# modules must come first.
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, os.path.join(ROOT, "action"))
+os.environ.setdefault("SLACK_BOT_TOKEN", "test")
+os.environ.setdefault("CANVAS_TIMING_LOG", "0")
+
+import client  # noqa: E402
+import run  # noqa: E402
+from fakes import FakeDatastore, FakeSlack  # noqa: E402
+
+CANVAS_ID = "test-canvas"
+
+
+@pytest.fixture
+def fake_datastore(monkeypatch) -> FakeDatastore:
+    fake = FakeDatastore()
+    monkeypatch.setattr(client, "new_datastore_backend", lambda: fake)
+    return fake
+
+
+@pytest.fixture
+def fake_slack(monkeypatch) -> FakeSlack:
+    fake = FakeSlack()
+    monkeypatch.setattr(client, "new_slack_backend", lambda: fake)
+    return fake
+
+
+@pytest.fixture
+def invoke(monkeypatch, tmp_path, fake_datastore, fake_slack):
+    """
+    Runs a command as a job would, each in a "new process" that shares only the
+    workflow cache on the runner's disk.
+    :return: A function that runs a command and returns its outputs.
+    """
+    monkeypatch.setenv("CONTEXT_STORAGE_PATH", str(tmp_path))
+    monkeypatch.setattr(run, "client_pool", None)
+
+    def invoke_command(*args: str) -> Dict[str, str]:
+        outputs = {}
+        monkeypatch.setattr(
+            run,
+            "print_action_output",
+            lambda name, value: outputs.update({name: value}),
+        )
+        run.cli.main(list(args), prog_name="run.py", standalone_mode=False)
+        return outputs
+
+    return invoke_command
+
+
+@pytest.fixture
+def canvas(invoke) -> str:
+    """
+    :return: The id of a new canvas, posted to one channel.
+    """
+    outputs = invoke(
+        "create-canvas",
+        "--json",
+        f'{{"canvasId": "{CANVAS_ID}", "description": "Tests", "channel": "#test"}}',
+    )
+    return outputs["canvas-id"]
+
+
+@pytest.fixture
+def load_stored(fake_datastore):
+    """
+    :return: A function that loads a workflow as it is stored, with no cache.
+    """
+    return lambda workflow_id: client.DatastoreClient(workflow_cache={}).load_workflow(
+        workflow_id, apply_events=False
+    )
+
+
+@pytest.fixture
+def sent_pages(fake_slack):
+    """
+    :return: A function that returns the blocks that slack was last sent for each
+        of a workflow's pages, in order.
+    """
+
+    def get_sent_pages(workflow):
+        target = workflow.targets[0]
+        message_ids = [target.message_id] + [page.message_id for page in target.pages]
+        return [fake_slack.messages[message_id]["blocks"] for message_id in message_ids]
+
+    return get_sent_pages
@@ -0,0 +1,71 @@
+from google.cloud import datastore
+
+import codec
+from models import CanvasPage, CanvasTarget, Workflow, WorkflowStep
+
+
+def new_workflow() -> Workflow:
+    return Workflow(
+        workflow_id="codec",
+        description="Codec",
+        status="in progress",
+        targets=[
+            CanvasTarget(
+                channel="#test",
+                channel_id="CTEST",
+                message_id="1.0",
+                payload_hash="abc",
+                pages=[CanvasPage(message_id="2.0")],
+            )
+        ],
+        steps=[
+            WorkflowStep(step_id="build", description="Build", status="succeeded"),
+            WorkflowStep(step_id="test", description="*Test*"),
+        ],
+        artifacts=["> Logs"],
+    )
+
+
+def test_round_trip_matches_pydantic():
+    workflow = new_workflow()
+    data = codec.dump_workflow(workflow)
+    loaded = codec.load_workflow(data, data["steps"])
+    assert loaded.dict() == workflow.dict()
+    assert loaded.dict() == Workflow.parse_obj(workflow.dict()).dict()
+    assert loaded.get_page_block_dicts() == workflow.get_page_block_dicts()
+
+
+def test_copy_is_independent():
+    workflow = new_workflow()
+    copy = codec.copy_workflow(workflow)
+    copy.steps[0].status = "failed"
+    copy.targets[0].pages[0].payload_hash = "def"
+    copy.artifacts.append("> More")
+    assert workflow.dict() == new_workflow().dict()
+
+
+def test_legacy_workflow_is_converted_when_stored(
+    invoke, fake_datastore, load_stored, sent_pages
+):
+    # Stored with its steps inline, and a single channel, before either was split
+    # out.
+    entity = datastore.Entity(key=fake_datastore.key("SlackWorkflowCanvas", "legacy"))
+    entity.update(
+        workflow_id="legacy",
+        description="Legacy",
+        status="in progress",
+        channel_name="#test",
+        steps=[{"step_id": "build", "description": "Build", "status": "succeeded"}],
+        artifacts=[],
+    )
+    fake_datastore.put(entity)
+
+    invoke("add-artifact", "--canvas-id", "legacy", "--description", "Logs")
+    stored = dict(fake_datastore.entities[("SlackWorkflowCanvas", "legacy")])
+    assert stored["step_keys"] == ["build"]
+    assert "steps" not in stored
+    workflow = load_stored("legacy")
+    assert [step.status_str for step in workflow.steps] == ["succeeded"]
+    assert workflow.targets[0].channel_name == "#test"
+    assert sent_pages(workflow) == workflow.get_page_block_dicts()
+
@@ -0,0 +1,111 @@
+import click
+import pytest
+
+import client
+import operations
+
+
+def get_event_count(fake_datastore) -> int:
+    return sum(
+        1 for entity in fake_datastore.entities.values()
+        if entity.key.kind == "SlackWorkflowEvent"
+    )
+
+
+def test_expired_lease_is_taken_over_and_fenced(canvas, invoke, load_stored):
+    stale = client.DatastoreClient()
+    stale.lease_seconds = -1
+    stale.acquire_lock(canvas)
+    workflow = stale._get_locked_workflow(canvas)
+
+    # The lease has expired, so this doesn't wait for it.
+    invoke(
+        "create-step", "--canvas-id", canvas, "--step-id", "build",
+        "--description", "Build",
+    )
+    operations.create_step(workflow, description="Stale", step_id="stale")
+    with pytest.raises(client.StaleLockError):
+        stale.store_workflow(workflow)
+    assert [step.step_id for step in load_stored(canvas).steps] == ["build"]
+
+
+def test_stale_holder_never_releases_the_new_holders_lock(canvas, fake_datastore):
+    stale = client.DatastoreClient()
+    stale.lease_seconds = -1
+    stale.acquire_lock(canvas)
+    holder = client.DatastoreClient()
+    holder.acquire_lock(canvas)
+    assert holder.fencing_token == stale.fencing_token + 1
+
+    stale.release_lock(canvas)
+    lock_entity = fake_datastore.entities[("SlackWorkflowLock", canvas)]
+    assert lock_entity["lock_id"] == holder.lock_id
+    assert not stale._attempt_lock(canvas)
+
+
+def test_lock_free_changes_wait_for_the_lock_holder(
+    canvas, invoke, fake_datastore, load_stored, sent_pages
+):
+    holder = client.DatastoreClient()
+    holder.acquire_lock(canvas)
+    outputs = invoke(
+        "create-step", "--canvas-id", canvas, "--step-id", "build",
+        "--description", "Build", "--lock-free",
+    )
+    assert outputs["step-id"] == "build"
+    assert get_event_count(fake_datastore) == 1
+    assert load_stored(canvas).steps == []
+    holder.release_lock(canvas)
+
+    # The pending step is known to the next lock-free change, which, with the lock
+    # free, applies both.
+    invoke(
+        "update-workflow", "--canvas-id", canvas, "--step-id", "build",
+        "--step-status", "succeeded", "--lock-free",
+    )
+    assert get_event_count(fake_datastore) == 0
+    workflow = load_stored(canvas)
+    assert [(step.step_id, step.status_str) for step in workflow.steps] == [
+        ("build", "succeeded")
+    ]
+    assert sent_pages(workflow) == workflow.get_page_block_dicts()
+
+
+def test_locked_command_applies_pending_events(
+    canvas, invoke, fake_datastore, load_stored
+):
+    holder = client.DatastoreClient()
+    holder.acquire_lock(canvas)
+    invoke(
+        "add-artifact", "--canvas-id", canvas, "--description", "Logs", "--lock-free"
+    )
+    holder.release_lock(canvas)
+
+    invoke(
+        "create-step", "--canvas-id", canvas, "--step-id", "build",
+        "--description", "Build",
+    )
+    assert get_event_count(fake_datastore) == 0
+    workflow = load_stored(canvas)
+    assert workflow.artifacts[-1] == "> Logs"
+    assert [step.step_id for step in workflow.steps] == ["build"]
+
+
+def test_lock_free_change_to_an_unknown_step_fails(canvas, invoke, fake_datastore):
+    with pytest.raises(click.ClickException, match="nope"):
+        invoke(
+            "update-workflow", "--canvas-id", canvas, "--step-id", "nope",
+            "--step-status", "succeeded", "--lock-free",
+        )
+    assert get_event_count(fake_datastore) == 0
+
+
+def test_event_that_fails_when_applied_is_dropped(
+    canvas, invoke, fake_datastore, load_stored
+):
+    client.DatastoreClient().append_events(
+        canvas, [operations.UpdateWorkflowOperation(steps={"nope": "succeeded"})]
+    )
+    invoke("add-artifact", "--canvas-id", canvas, "--description", "Logs")
+    assert get_event_count(fake_datastore) == 0
+    assert load_stored(canvas).artifacts[-1] == "> Logs"
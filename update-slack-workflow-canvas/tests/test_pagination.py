@@ -0,0 +1,60 @@
+import json
+
+from models import FIRST_PAGE_STEPS, PAGE_STEPS
+
+
+def create_steps(invoke, canvas: str, count: int):
+    invoke(
+        "batch",
+        "--canvas-id",
+        canvas,
+        "--json",
+        "\n".join(
+            json.dumps(
+                {
+                    "command": "create-step",
+                    "stepId": f"step-{i}",
+                    "description": f"Step {i}",
+                }
+            )
+            for i in range(count)
+        ),
+    )
+
+
+def test_steps_that_do_not_fit_are_replies_in_the_thread(
+    canvas, invoke, fake_slack, load_stored, sent_pages
+):
+    create_steps(invoke, canvas, FIRST_PAGE_STEPS + PAGE_STEPS + 1)
+    workflow = load_stored(canvas)
+    target = workflow.targets[0]
+    assert len(target.pages) == 2
+    assert sent_pages(workflow) == workflow.get_page_block_dicts()
+    for page in target.pages:
+        assert fake_slack.messages[page.message_id]["thread_ts"] == target.message_id
+
+
+def test_only_the_changed_page_is_sent(
+    canvas, invoke, fake_slack, load_stored, sent_pages
+):
+    create_steps(invoke, canvas, FIRST_PAGE_STEPS + 1)
+    calls = fake_slack.calls.copy()
+    invoke(
+        "update-workflow", "--canvas-id", canvas,
+        "--step-id", f"step-{FIRST_PAGE_STEPS}", "--step-status", "succeeded",
+    )
+    assert fake_slack.calls - calls == {"chat.update": 1}
+    workflow = load_stored(canvas)
+    assert sent_pages(workflow) == workflow.get_page_block_dicts()
+
+
+def test_replies_no_longer_needed_are_deleted(
+    canvas, invoke, fake_slack, load_stored, sent_pages
+):
+    create_steps(invoke, canvas, FIRST_PAGE_STEPS + PAGE_STEPS + 1)
+    invoke("remove-step", "--canvas-id", canvas, "--step-id", "*")
+    assert fake_slack.calls["chat.delete"] == 2
+    workflow = load_stored(canvas)
+    assert workflow.targets[0].pages == []
+    assert list(fake_slack.messages) == [workflow.targets[0].message_id]
+    assert sent_pages(workflow) == workflow.get_page_block_dicts()
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+import client
+import throttle
+
+STEP_COUNT = client.MAX_MUTATIONS_PER_TRANSACTION + 100
+
+
+@pytest.fixture(autouse=True)
+def unthrottled(monkeypatch):
+    # So many steps take a dozen pages, which slack's rate limits would pace
+    # out over many seconds.
+    unlimited = (1000.0, 1000)
+    monkeypatch.setattr(throttle, "CHANNEL_RATE_LIMIT", unlimited)
+    monkeypatch.setattr(
+        throttle,
+        "METHOD_RATE_LIMITS",
+        dict.fromkeys(throttle.METHOD_RATE_LIMITS, unlimited),
+    )
+
+
+def get_step_paths(fake_datastore):
+    return [
+        path for path, entity in fake_datastore.entities.items()
+        if entity.key.kind == "SlackWorkflowStep"
+    ]
+
+
+def create_steps(invoke, canvas: str, count: int):
+    invoke(
+        "batch",
+        "--canvas-id",
+        canvas,
+        "--json",
+        "\n".join(
+            json.dumps(
+                {"command": "create-step", "stepId": f"step-{i}", "description": "A"}
+            )
+            for i in range(count)
+        ),
+    )
+
+
+def test_too_many_steps_for_one_transaction_are_stored(
+    canvas, invoke, fake_datastore, load_stored
+):
+    commits = fake_datastore.calls["commit"]
+    create_steps(invoke, canvas, STEP_COUNT)
+    # At least the steps, and then the workflow, in separate transactions.
+    assert fake_datastore.calls["commit"] - commits > 2
+    assert len(get_step_paths(fake_datastore)) == STEP_COUNT
+    workflow = load_stored(canvas)
+    assert [step.step_id for step in workflow.steps] == [
+        f"step-{i}" for i in range(STEP_COUNT)
+    ]
+    lock_entity = fake_datastore.entities[("SlackWorkflowLock", canvas)]
+    workflow_entity = fake_datastore.entities[("SlackWorkflowCanvas", canvas)]
+    assert lock_entity["workflow_version"] == workflow_entity["version"]
+
+
+def test_only_changed_steps_are_written(canvas, invoke, fake_datastore, load_stored):
+    create_steps(invoke, canvas, STEP_COUNT)
+    versions = dict(fake_datastore.versions)
+    invoke(
+        "update-workflow", "--canvas-id", canvas,
+        "--step-id", "step-7", "--step-status", "succeeded",
+    )
+    written = {
+        path for path in get_step_paths(fake_datastore)
+        if fake_datastore.versions[path] != versions[path]
+    }
+    assert written == {("SlackWorkflowCanvas", canvas, "SlackWorkflowStep", "step-7")}
+    assert load_stored(canvas).get_step("step-7").status_str == "succeeded"
+
+
+def test_too_many_removed_steps_for_one_transaction_are_deleted(
+    canvas, invoke, fake_datastore, load_stored
+):
+    create_steps(invoke, canvas, STEP_COUNT)
+    invoke("remove-step", "--canvas-id", canvas, "--step-id", "*")
+    assert get_step_paths(fake_datastore) == []
+    assert load_stored(canvas).steps == []